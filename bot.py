@@ -1,15 +1,38 @@
-﻿import asyncio
+﻿import argparse
+import asyncio
+import bisect
+import contextvars
+import csv
 import datetime
+import difflib
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
 import random
 import re
+import shutil
+import socket
+import sqlite3
 import sys
-from collections import Counter
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
 
 import aiosqlite
 import httpx
+from aiohttp import web
+from pydantic import BaseModel, Field, ValidationError
+from vkbottle import API, Router, VKAPIError
+from vkbottle.http import AiohttpClient
 from vkbottle.bot import Bot, Message
 from vkbottle.dispatch.rules import ABCRule  # Для создания своего правила
 
@@ -22,6 +45,11 @@ try:
 except ImportError:
     AsyncGroq = None
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # ================= НАСТРОЙКИ =================
 VK_TOKEN = os.getenv("VK_TOKEN")
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "").strip().lower()
@@ -80,9 +108,24 @@ CHATBOT_ENABLED = read_bool_env("CHATBOT_ENABLED", default=True)
 CHAT_HISTORY_LIMIT = read_int_env("CHAT_HISTORY_LIMIT", default=6, min_value=0)
 CHAT_MESSAGE_MAX_CHARS = read_int_env("CHAT_MESSAGE_MAX_CHARS", default=300, min_value=0)
 LLM_MAX_TOKENS = read_int_env("LLM_MAX_TOKENS", default=800, min_value=1)
+LLM_STRUCTURED_OUTPUT = read_bool_env("LLM_STRUCTURED_OUTPUT", default=True)
+LLM_REPAIR_MAX_TOKENS = read_int_env("LLM_REPAIR_MAX_TOKENS", default=300, min_value=1)
+LLM_PREFILTER_TOP_K = read_int_env("LLM_PREFILTER_TOP_K", default=0, min_value=0)
+
+GAME_BATCH_ENABLED = read_bool_env("GAME_BATCH_ENABLED", default=False)
+GAME_BATCH_TOKEN_BUDGET = read_int_env("GAME_BATCH_TOKEN_BUDGET", default=6000, min_value=500)
+GAME_BATCH_MAX_CHATS = read_int_env("GAME_BATCH_MAX_CHATS", default=8, min_value=2)
+GAME_BATCH_TOKENS_PER_CHAT = read_int_env("GAME_BATCH_TOKENS_PER_CHAT", default=300, min_value=50)
 CHAT_MAX_TOKENS = read_int_env("CHAT_MAX_TOKENS", default=300, min_value=1)
 CHAT_RESPONSE_MAX_CHARS = read_int_env("CHAT_RESPONSE_MAX_CHARS", default=600, min_value=0)
 
+CHAT_CACHE_ENABLED = read_bool_env("CHAT_CACHE_ENABLED", default=False)
+CHAT_CACHE_TTL = read_int_env("CHAT_CACHE_TTL", default=600, min_value=1)
+CHAT_CACHE_MAX_SIZE = read_int_env("CHAT_CACHE_MAX_SIZE", default=256, min_value=1)
+CHAT_CACHE_MAX_TEMPERATURE = read_float_env("CHAT_CACHE_MAX_TEMPERATURE", default=1.0)
+if CHAT_CACHE_MAX_TEMPERATURE is None:
+    CHAT_CACHE_MAX_TEMPERATURE = 1.0
+
 BOT_REPLY_FULL_LIMIT = read_int_env("CHAT_BOT_FULL_LIMIT", default=2, min_value=0)
 BOT_REPLY_SHORT_LIMIT = read_int_env("CHAT_BOT_SHORT_LIMIT", default=2, min_value=0)
 BOT_REPLY_FULL_MAX_CHARS = read_int_env("CHAT_BOT_FULL_MAX_CHARS", default=800, min_value=0)
@@ -110,34 +153,185 @@ if VENICE_TIMEOUT is None:
 
 VENICE_INCLUDE_SYSTEM_PROMPT = read_bool_env("VENICE_INCLUDE_SYSTEM_PROMPT", default=False)
 
+# Mock: провайдер без сети для нагрузочных прогонов и проверки путей отказа
+MOCK_MODEL = os.getenv("MOCK_MODEL", "mock-small")
+MOCK_TEMPERATURE = read_float_env("MOCK_TEMPERATURE", default=0.9)
+if MOCK_TEMPERATURE is None:
+    MOCK_TEMPERATURE = 0.9
+MOCK_LATENCY = os.getenv("MOCK_LATENCY", "lognormal:0.8,0.5").strip().lower()
+MOCK_RATE_LIMIT_RATE = read_float_env("MOCK_RATE_LIMIT_RATE", default=0.0) or 0.0
+MOCK_TIMEOUT_RATE = read_float_env("MOCK_TIMEOUT_RATE", default=0.0) or 0.0
+MOCK_MALFORMED_RATE = read_float_env("MOCK_MALFORMED_RATE", default=0.0) or 0.0
+MOCK_TIMEOUT = read_float_env("MOCK_TIMEOUT", default=VENICE_TIMEOUT)
+if MOCK_TIMEOUT is None or MOCK_TIMEOUT < 0:
+    MOCK_TIMEOUT = VENICE_TIMEOUT
+MOCK_CHUNK_CHARS = read_int_env("MOCK_CHUNK_CHARS", default=0, min_value=0)
+MOCK_CHUNK_DELAY = read_float_env("MOCK_CHUNK_DELAY", default=0.03)
+if MOCK_CHUNK_DELAY is None or MOCK_CHUNK_DELAY < 0:
+    MOCK_CHUNK_DELAY = 0.03
+MOCK_SEED = os.getenv("MOCK_SEED", "").strip()
+MOCK_REPLIES_FILE = os.getenv("MOCK_REPLIES_FILE", "").strip()
+
+LLM_PROVIDERS = ("groq", "venice", "mock")
+PROVIDER_LABELS = {"groq": "Groq", "venice": "Venice", "mock": "Mock"}
+
+MODEL_CATALOG_TTL = read_int_env("MODEL_CATALOG_TTL", default=3600, min_value=60)
+LLM_CONTEXT_RESERVE_TOKENS = read_int_env("LLM_CONTEXT_RESERVE_TOKENS", default=500, min_value=0)
+
 if not LLM_PROVIDER:
     if VENICE_API_KEY and not GROQ_API_KEY:
         LLM_PROVIDER = "venice"
     else:
         LLM_PROVIDER = "groq"
 
+VK_SEND_RATE = read_float_env("VK_SEND_RATE", default=15.0)
+if not VK_SEND_RATE or VK_SEND_RATE <= 0:
+    VK_SEND_RATE = 15.0
+VK_SEND_BURST = read_int_env("VK_SEND_BURST", default=5, min_value=1)
+VK_SEND_WORKERS = read_int_env("VK_SEND_WORKERS", default=4, min_value=1)
+VK_SEND_RETRIES = read_int_env("VK_SEND_RETRIES", default=3, min_value=0)
+VK_SEND_BACKOFF = read_float_env("VK_SEND_BACKOFF", default=0.5)
+if VK_SEND_BACKOFF is None or VK_SEND_BACKOFF < 0:
+    VK_SEND_BACKOFF = 0.5
+
+VK_EXECUTE_WINDOW_MS = read_int_env("VK_EXECUTE_WINDOW_MS", default=0, min_value=0)
+VK_EXECUTE_METHODS = {"users.get", "messages.send", "groups.getById"}
+VK_EXECUTE_MAX_CALLS = 25
+
+VK_CALLBACK_ENABLED = read_bool_env("VK_CALLBACK_ENABLED", default=False)
+VK_CALLBACK_HOST = os.getenv("VK_CALLBACK_HOST", "0.0.0.0")
+VK_CALLBACK_PORT = read_int_env("VK_CALLBACK_PORT", default=8080, min_value=1)
+VK_CALLBACK_PATH = os.getenv("VK_CALLBACK_PATH", "/callback")
+VK_CALLBACK_SECRET = os.getenv("VK_CALLBACK_SECRET", "")
+VK_CALLBACK_CONFIRMATION = os.getenv("VK_CALLBACK_CONFIRMATION", "")
+VK_CALLBACK_WORKERS = read_int_env("VK_CALLBACK_WORKERS", default=4, min_value=1)
+VK_CALLBACK_QUEUE_SIZE = read_int_env("VK_CALLBACK_QUEUE_SIZE", default=1000, min_value=1)
+
+CLUSTER_WORKERS = read_int_env("CLUSTER_WORKERS", default=1, min_value=1)
+CLUSTER_LEASE_TTL = read_int_env("CLUSTER_LEASE_TTL", default=30, min_value=5)
+CLUSTER_HEARTBEAT = read_int_env("CLUSTER_HEARTBEAT", default=10, min_value=1)
+CLUSTER_SETTINGS_POLL = read_float_env("CLUSTER_SETTINGS_POLL", default=2.0)
+if not CLUSTER_SETTINGS_POLL or CLUSTER_SETTINGS_POLL <= 0:
+    CLUSTER_SETTINGS_POLL = 2.0
+CLUSTER_QUEUE_SIZE = read_int_env("CLUSTER_QUEUE_SIZE", default=10000, min_value=1)
+CLUSTER_NODE_ID = os.getenv("CLUSTER_NODE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+JOB_WORKERS = read_int_env("JOB_WORKERS", default=2, min_value=1)
+JOB_MAX_ATTEMPTS = read_int_env("JOB_MAX_ATTEMPTS", default=5, min_value=1)
+JOB_BACKOFF = read_int_env("JOB_BACKOFF", default=30, min_value=1)
+JOB_VISIBILITY_TIMEOUT = read_int_env("JOB_VISIBILITY_TIMEOUT", default=600, min_value=30)
+JOB_POLL_INTERVAL = read_float_env("JOB_POLL_INTERVAL", default=1.0)
+if not JOB_POLL_INTERVAL or JOB_POLL_INTERVAL <= 0:
+    JOB_POLL_INTERVAL = 1.0
+JOB_RETENTION_DAYS = read_int_env("JOB_RETENTION_DAYS", default=14, min_value=1)
+
+RETENTION_MESSAGES_DAYS = read_int_env("RETENTION_MESSAGES_DAYS", default=0, min_value=0)
+RETENTION_BOT_DIALOGS_DAYS = read_int_env("RETENTION_BOT_DIALOGS_DAYS", default=0, min_value=0)
+RETENTION_TIME = os.getenv("RETENTION_TIME", "04:30")
+RETENTION_BATCH_SIZE = read_int_env("RETENTION_BATCH_SIZE", default=500, min_value=1)
+RETENTION_BATCH_PAUSE = read_float_env("RETENTION_BATCH_PAUSE", default=0.2)
+if RETENTION_BATCH_PAUSE is None or RETENTION_BATCH_PAUSE < 0:
+    RETENTION_BATCH_PAUSE = 0.2
+RETENTION_VACUUM_PAGES = read_int_env("RETENTION_VACUUM_PAGES", default=1000, min_value=1)
+ARCHIVE_ENABLED = read_bool_env("ARCHIVE_ENABLED", default=True)
+
+MAINTENANCE_ENABLED = read_bool_env("MAINTENANCE_ENABLED", default=True)
+MAINTENANCE_WINDOW = os.getenv("MAINTENANCE_WINDOW", "03:00-06:00")
+MAINTENANCE_MAX_WRITE_MS = read_int_env("MAINTENANCE_MAX_WRITE_MS", default=200, min_value=1)
+MAINTENANCE_ANALYZE_DAYS = read_int_env("MAINTENANCE_ANALYZE_DAYS", default=7, min_value=1)
+MAINTENANCE_ANALYSIS_LIMIT = read_int_env("MAINTENANCE_ANALYSIS_LIMIT", default=1000, min_value=0)
+
+BACKUP_INTERVAL_HOURS = read_int_env("BACKUP_INTERVAL_HOURS", default=24, min_value=0)
+BACKUP_KEEP = read_int_env("BACKUP_KEEP", default=7, min_value=1)
+BACKUP_PAGES_PER_STEP = read_int_env("BACKUP_PAGES_PER_STEP", default=256, min_value=1)
+BACKUP_STEP_PAUSE = read_float_env("BACKUP_STEP_PAUSE", default=0.05)
+if BACKUP_STEP_PAUSE is None or BACKUP_STEP_PAUSE < 0:
+    BACKUP_STEP_PAUSE = 0.05
+BACKUP_MAX_RESTARTS = read_int_env("BACKUP_MAX_RESTARTS", default=3, min_value=0)
+
+SEARCH_PAGE_SIZE = read_int_env("SEARCH_PAGE_SIZE", default=5, min_value=1)
+SEARCH_SNIPPET_TOKENS = read_int_env("SEARCH_SNIPPET_TOKENS", default=16, min_value=4)
+STATS_TOP_LIMIT = read_int_env("STATS_TOP_LIMIT", default=10, min_value=1)
+GAME_ANNOUNCE_RECORDS = read_bool_env("GAME_ANNOUNCE_RECORDS", default=False)
+LEADERBOARD_TOP_N = read_int_env("LEADERBOARD_TOP_N", default=10, min_value=1)
+
+BACKFILL_MAX_DAYS = read_int_env("BACKFILL_MAX_DAYS", default=30, min_value=1)
+BACKFILL_MAX_MESSAGES = read_int_env("BACKFILL_MAX_MESSAGES", default=50000, min_value=1)
+BACKFILL_PAGE_SIZE = read_int_env("BACKFILL_PAGE_SIZE", default=200, min_value=1)
+BACKFILL_PAGE_SIZE = min(BACKFILL_PAGE_SIZE, 200)
+BACKFILL_PAGE_DELAY = read_float_env("BACKFILL_PAGE_DELAY", default=0.5)
+if BACKFILL_PAGE_DELAY is None or BACKFILL_PAGE_DELAY < 0:
+    BACKFILL_PAGE_DELAY = 0.5
+BACKFILL_PAGES_PER_JOB = read_int_env("BACKFILL_PAGES_PER_JOB", default=50, min_value=1)
+BACKFILL_ON_START = read_bool_env("BACKFILL_ON_START", default=False)
+
+TEXT_COMPRESSION_ENABLED = read_bool_env("TEXT_COMPRESSION_ENABLED", default=False)
+TEXT_COMPRESS_AFTER_DAYS = read_int_env("TEXT_COMPRESS_AFTER_DAYS", default=7, min_value=0)
+TEXT_COMPRESS_MIN_CHARS = read_int_env("TEXT_COMPRESS_MIN_CHARS", default=32, min_value=3)
+TEXT_COMPRESS_BATCH_SIZE = read_int_env("TEXT_COMPRESS_BATCH_SIZE", default=500, min_value=1)
+TEXT_COMPRESS_MAX_ROWS = read_int_env("TEXT_COMPRESS_MAX_ROWS", default=50000, min_value=1)
+TEXT_COMPRESS_LEVEL = read_int_env("TEXT_COMPRESS_LEVEL", default=9, min_value=1)
+TEXT_COMPRESS_LEVEL = min(TEXT_COMPRESS_LEVEL, 19)
+TEXT_DICT_SIZE = read_int_env("TEXT_DICT_SIZE", default=32768, min_value=1024)
+TEXT_DICT_SAMPLES = read_int_env("TEXT_DICT_SAMPLES", default=20000, min_value=100)
+if TEXT_COMPRESSION_ENABLED and zstandard is None:
+    log.warning("TEXT_COMPRESSION_ENABLED is set but zstandard is not installed, compression disabled")
+    TEXT_COMPRESSION_ENABLED = False
+
+EVENT_RECORD_PATH = os.getenv("EVENT_RECORD_PATH", "").strip()
+EVENT_RECORD_TEXT = os.getenv("EVENT_RECORD_TEXT", "mask").strip().lower()
+if EVENT_RECORD_TEXT not in ("mask", "full"):
+    log.warning("EVENT_RECORD_TEXT must be mask or full, got %s; using mask", EVENT_RECORD_TEXT)
+    EVENT_RECORD_TEXT = "mask"
+EVENT_RECORD_MAX_MB = read_int_env("EVENT_RECORD_MAX_MB", default=200, min_value=1)
+# Соль по умолчанию выводится из токена: id в записях стабильны между перезапусками, но не обратимы без токена
+EVENT_RECORD_SALT = os.getenv("EVENT_RECORD_SALT") or hashlib.sha256(f"event-record:{VK_TOKEN}".encode("utf-8")).hexdigest()
+
+METRICS_ENABLED = read_bool_env("METRICS_ENABLED", default=False)
+# По умолчанию только localhost: /metrics без авторизации и раскрывает нагрузку и ошибки бота
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 — метрики собираются, но HTTP-сервер не поднимается
+METRICS_PORT = read_int_env("METRICS_PORT", default=9108, min_value=0)
+
+TRACE_ENABLED = read_bool_env("TRACE_ENABLED", default=False)
+TRACE_KEEP = read_int_env("TRACE_KEEP", default=20, min_value=1)
+TRACE_MIN_MS = read_int_env("TRACE_MIN_MS", default=0, min_value=0)
+PROFILE_INTERVAL_MS = read_int_env("PROFILE_INTERVAL_MS", default=5, min_value=1)
+PROFILE_MAX_SECONDS = read_int_env("PROFILE_MAX_SECONDS", default=300, min_value=1)
+
 BUILD_DATE = os.getenv("BUILD_DATE", "unknown")
 BUILD_SHA = os.getenv("BUILD_SHA", "")
 BOT_GROUP_ID = None
 
-if not VK_TOKEN:
-    log.error("VK_TOKEN is missing")
-    sys.exit(1)
-
-if LLM_PROVIDER not in ("groq", "venice"):
-    log.error("LLM_PROVIDER must be groq or venice")
-    sys.exit(1)
+def validate_startup_config():
+    # Проверяется только при запуске бота: экспорт и инструменты работают без токена и ключей
+    if not VK_TOKEN:
+        log.error("VK_TOKEN is missing")
+        sys.exit(1)
 
-if LLM_PROVIDER == "groq":
-    if not GROQ_API_KEY:
-        log.error("GROQ_API_KEY is missing while LLM_PROVIDER=groq")
+    if LLM_PROVIDER not in LLM_PROVIDERS:
+        log.error("LLM_PROVIDER must be groq, venice or mock")
         sys.exit(1)
-    if AsyncGroq is None:
-        log.error("groq package is not installed but LLM_PROVIDER=groq")
+
+    if LLM_PROVIDER == "groq":
+        if not GROQ_API_KEY:
+            log.error("GROQ_API_KEY is missing while LLM_PROVIDER=groq")
+            sys.exit(1)
+        if AsyncGroq is None:
+            log.error("groq package is not installed but LLM_PROVIDER=groq")
+            sys.exit(1)
+    elif LLM_PROVIDER == "venice":
+        if not VENICE_API_KEY:
+            log.error("VENICE_API_KEY is missing while LLM_PROVIDER=venice")
+            sys.exit(1)
+
+    if not USER_PROMPT_TEMPLATE:
+        log.error("Missing USER_PROMPT_TEMPLATE in environment")
         sys.exit(1)
-else:
-    if not VENICE_API_KEY:
-        log.error("VENICE_API_KEY is missing while LLM_PROVIDER=venice")
+
+    # Без секрета любой, кто достучится до порта, подделает message_new от ADMIN_USER_ID
+    if VK_CALLBACK_ENABLED and not VK_CALLBACK_SECRET:
+        log.error("VK_CALLBACK_SECRET is required when VK_CALLBACK_ENABLED is set")
         sys.exit(1)
 
 # === Команды ===
@@ -157,8 +351,18 @@ CMD_PROMPT = "/промт"
 CMD_LEADERBOARD = "/лидерборд"
 CMD_LEADERBOARD_TIMER_SET = "/таймер_лидерборда"
 CMD_LEADERBOARD_TIMER_RESET = "/сброс_таймера_лидерборда"
+CMD_DB_STATUS = "/бд"
+CMD_BACKUP = "/бэкап"
+CMD_SEARCH = "/поиск"
+CMD_STATS = "/стата"
+CMD_RECORDS = "/рекорды"
+CMD_BACKFILL = "/бэкфилл"
+CMD_PROFILE = "/профиль"
 
 DB_NAME = os.getenv("DB_PATH", "chat_history.db")
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or os.path.join(os.path.dirname(DB_NAME) or ".", "archive")
+BACKUP_DIR = os.getenv("BACKUP_DIR") or os.path.join(os.path.dirname(DB_NAME) or ".", "backups")
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(os.path.dirname(DB_NAME) or ".", "profiles")
 MSK_TZ = datetime.timezone(datetime.timedelta(hours=3))
 
 def format_build_date(value: str) -> str:
@@ -219,10 +423,6 @@ CHAT_SYSTEM_PROMPT = normalize_prompt(
 )
 USER_PROMPT_TEMPLATE = normalize_prompt(os.getenv("USER_PROMPT_TEMPLATE"))
 
-if not USER_PROMPT_TEMPLATE:
-    log.error("Missing USER_PROMPT_TEMPLATE in environment")
-    sys.exit(1)
-
 def render_user_prompt(context_text: str) -> str:
     prompt = USER_PROMPT_TEMPLATE.replace("{{GAME_TITLE}}", GAME_TITLE)
     if "{{CHAT_LOG}}" in prompt:
@@ -277,6 +477,12 @@ def extract_reply_text(message: Message) -> str:
         reply_text = reply_message.get("text")
     return str(reply_text) if reply_text else ""
 
+USER_MENTION_RE = re.compile(r"\[id(\d+)\|")
+
+def extract_mentioned_user_id(text: str):
+    match = USER_MENTION_RE.search(text or "")
+    return int(match.group(1)) if match else None
+
 def extract_reply_from_id(message: Message):
     reply_message = getattr(message, "reply_message", None)
     if not reply_message:
@@ -294,11 +500,11 @@ async def build_chat_history(peer_id: int, user_id: int) -> list:
 
     user_rows = []
     bot_rows = []
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect_db() as db:
         if CHAT_HISTORY_LIMIT > 0:
             cursor = await db.execute(
-                """
-                SELECT id, text, timestamp
+                f"""
+                SELECT id, {text_sql()}, timestamp
                 FROM bot_dialogs
                 WHERE peer_id = ? AND user_id = ? AND role = 'user'
                 ORDER BY timestamp DESC, id DESC
@@ -309,8 +515,8 @@ async def build_chat_history(peer_id: int, user_id: int) -> list:
             user_rows = await cursor.fetchall()
         if bot_limit > 0:
             cursor = await db.execute(
-                """
-                SELECT id, text, timestamp
+                f"""
+                SELECT id, {text_sql()}, timestamp
                 FROM bot_dialogs
                 WHERE peer_id = ? AND user_id = ? AND role = 'assistant'
                 ORDER BY timestamp DESC, id DESC
@@ -394,6 +600,16 @@ async def ensure_message_allowed(message: Message, action_label: str | None = No
 async def ensure_command_allowed(message: Message, command: str) -> bool:
     return await ensure_message_allowed(message, action_label=f"команде `{command}`")
 
+def is_admin_message(message: Message) -> bool:
+    return bool(ADMIN_USER_ID) and message.from_id == ADMIN_USER_ID
+
+async def ensure_admin_command(message: Message, command: str) -> bool:
+    if is_admin_message(message):
+        return True
+    await send_reply(message, f"⛔ Команда `{command}` доступна только администратору.")
+    log.info("Admin command denied peer_id=%s user_id=%s command=%s", message.peer_id, message.from_id, command)
+    return False
+
 def get_reply_to_id(message: Message):
     if getattr(message, "is_unavailable", False):
         return None
@@ -402,28 +618,839 @@ def get_reply_to_id(message: Message):
         return reply_to
     return None
 
-async def send_reply(message: Message, text: str, **kwargs):
+# ================= МЕТРИКИ =================
+# Реестр в формате Prometheus без внешних зависимостей. На горячем пути только
+# perf_counter и запись в словарь; счетчики, которые бот уже ведет (очередь отправки,
+# execute, кэш чатбота, разбор JSON), читаются в момент запроса /metrics.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SQL_TABLE_RE = re.compile(r"\b(?:FROM|INTO|TABLE|INDEX|TRIGGER|VIEW)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)", re.IGNORECASE)
+SQL_UPDATE_TABLE_RE = re.compile(r"(?:OR\s+\w+\s+)?(\w+)", re.IGNORECASE)
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.families = {}
+        self.collectors = []
+
+    def declare(self, kind: str, name: str, help_text: str, labels: tuple = (), buckets: tuple = METRICS_BUCKETS):
+        self.families[name] = {"kind": kind, "help": help_text, "labels": labels, "buckets": buckets, "series": {}}
+
+    def inc(self, name: str, *labels, value: float = 1):
+        # Для gauge то же самое с value=-1
+        if not self.enabled:
+            return
+        series = self.families[name]["series"]
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, value: float, *labels):
+        if not self.enabled:
+            return
+        family = self.families[name]
+        entry = family["series"].get(labels)
+        if entry is None:
+            entry = family["series"][labels] = [[0] * (len(family["buckets"]) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(family["buckets"], value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    async def render(self) -> str:
+        lines = []
+        for name, family in self.families.items():
+            write_metric_header(lines, name, family["kind"], family["help"])
+            label_names = family["labels"]
+            for labels, value in sorted(family["series"].items()):
+                if family["kind"] != "histogram":
+                    lines.append(f"{name}{format_metric_labels(label_names, labels)} {value}")
+                    continue
+                buckets, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip((*family["buckets"], "+Inf"), buckets):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{format_metric_labels((*label_names, 'le'), (*labels, bound))} {cumulative}")
+                lines.append(f"{name}_sum{format_metric_labels(label_names, labels)} {total:.6f}")
+                lines.append(f"{name}_count{format_metric_labels(label_names, labels)} {count}")
+        for collector in self.collectors:
+            try:
+                families = await collector()
+            except Exception as e:
+                log.warning("Metrics collector %s failed: %s", collector.__name__, e)
+                continue
+            for name, kind, help_text, label_names, samples in families:
+                write_metric_header(lines, name, kind, help_text)
+                for labels, value in samples:
+                    lines.append(f"{name}{format_metric_labels(label_names, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def write_metric_header(lines: list, name: str, kind: str, help_text: str):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+def format_metric_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+@functools.lru_cache(maxsize=512)
+def classify_sql(sql: str) -> str:
+    # Класс запроса — глагол и первая таблица: метка не зависит от параметров и f-строк с плейсхолдерами
+    parts = sql.split(None, 1)
+    if not parts:
+        return "other"
+    verb = parts[0].upper()
+    if verb == "UPDATE" and len(parts) > 1:
+        match = SQL_UPDATE_TABLE_RE.match(parts[1])
+    else:
+        match = SQL_TABLE_RE.search(sql)
+    return f"{verb} {match.group(1).lower()}" if match else verb
+
+def is_rate_limit_error(error: Exception) -> bool:
+    # Venice — RuntimeError из venice_request, Groq — RateLimitError со status_code
+    return getattr(error, "status_code", None) == 429 or str(error).startswith("HTTP 429")
+
+def is_timeout_error(error: Exception) -> bool:
+    return isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException)) or "Timeout" in type(error).__name__
+
+def classify_llm_error(error: Exception) -> str:
+    if is_rate_limit_error(error):
+        return "rate_limited"
+    if is_timeout_error(error):
+        return "timeout"
+    if isinstance(error, (ValueError, ValidationError)):
+        return "invalid_response"
+    return "error"
+
+metrics = MetricsRegistry(METRICS_ENABLED)
+metrics.declare("histogram", "bot_llm_request_seconds", "LLM request latency", ("provider", "model"))
+metrics.declare("counter", "bot_llm_errors_total", "Failed LLM requests by reason", ("provider", "reason"))
+metrics.declare("gauge", "bot_llm_in_flight", "LLM requests in progress")
+metrics.declare("histogram", "bot_vk_api_request_seconds", "VK API call latency as seen by the caller", ("method",))
+metrics.declare("counter", "bot_vk_api_errors_total", "Failed VK API calls", ("method", "code"))
+metrics.declare("histogram", "bot_sql_seconds", "SQLite statement latency by statement class", ("statement",))
+metrics.declare("histogram", "bot_handler_seconds", "Message handler latency", ("handler",))
+metrics.declare("counter", "bot_handler_errors_total", "Exceptions raised by message handlers", ("handler",))
+metrics.declare("gauge", "bot_handlers_in_flight", "Message handlers in progress")
+metrics.declare("counter", "bot_game_fallback_total", "Winner chosen by local scoring after an LLM failure", ("reason",))
+metrics.declare("counter", "bot_game_batch_fallback_total", "Chats retried with a single request after a batch")
+metrics.declare("counter", "bot_scheduler_fires_total", "Jobs enqueued by the scheduler", ("kind",))
+
+async def collect_runtime_metrics() -> list:
+    families = [
+        ("bot_vk_send_total", "counter", "Outgoing VK messages by result", ("result",),
+         [((result,), vk_send_queue.stats[result]) for result in ("sent", "retried", "failed", "reply_fallback")]),
+        ("bot_vk_send_queue_depth", "gauge", "Messages waiting in the send queue", (), [((), vk_send_queue.depth())]),
+        ("bot_vk_execute_total", "counter", "VK execute coalescing", ("kind",),
+         [((kind,), bot.api.execute_stats[kind]) for kind in ("execute", "coalesced", "single", "execute_failed")]),
+        ("bot_vk_execute_pending", "gauge", "Calls waiting for the execute window", (), [((), len(bot.api.pending))]),
+        ("bot_chat_cache_total", "counter", "Chatbot response cache lookups", ("result",),
+         [(("hit",), chat_response_cache.hits), (("miss",), chat_response_cache.misses), (("bypass",), chat_response_cache.bypassed)]),
+        ("bot_chat_cache_entries", "gauge", "Chatbot response cache size", (), [((), len(chat_response_cache.entries))]),
+        ("bot_winner_parse_total", "counter", "Winner JSON parsing outcomes", ("result",),
+         [((result,), WINNER_PARSE_STATS[result]) for result in ("ok", "parse_failed", "repair_ok", "repair_failed")]),
+        ("bot_asyncio_tasks", "gauge", "Pending asyncio tasks", (), [((), len(asyncio.all_tasks()))]),
+    ]
+    if update_queue is not None:
+        families.append(("bot_callback_queue_depth", "gauge", "Callback updates waiting for a consumer", (), [((), update_queue.qsize())]))
+    if cluster_queues:
+        depths = []
+        for index, queue in enumerate(cluster_queues):
+            try:
+                depths.append(((str(index),), queue.qsize()))
+            except NotImplementedError:
+                break
+        families.append(("bot_cluster_queue_depth", "gauge", "Updates waiting for a cluster worker", ("worker",), depths))
+    if LLM_PROVIDER == "mock":
+        families.append(("bot_mock_llm_total", "counter", "Mock provider outcomes", ("result",),
+                         [((result,), MOCK_STATS[result]) for result in ("requests", "ok", "rate_limited", "timeouts", "malformed")]))
+    if cluster_worker_index is not None or not cluster_queues:
+        # Супервизор кластера задачи не выполняет: очередь в базе видят воркеры
+        async with connect_db() as db:
+            cursor = await db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+            counts = dict(await cursor.fetchall())
+        families.append(("bot_jobs", "gauge", "Jobs in the database queue by state", ("state",),
+                         [((state,), counts.get(state, 0)) for state in ("queued", "running", "failed", "done")]))
+    return families
+
+metrics.collectors.append(collect_runtime_metrics)
+
+def instrument_db(db):
+    # Время execute для SELECT — до первой строки: основная работа SQLite приходится на первый шаг
+    def timed(call, fixed_class=None):
+        async def wrapper(sql=None, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                if fixed_class:
+                    return await call()
+                return await call(sql, *args, **kwargs)
+            finally:
+                metrics.observe("bot_sql_seconds", time.perf_counter() - started, fixed_class or classify_sql(sql))
+        return wrapper
+
+    db.execute = timed(db.execute)
+    db.executemany = timed(db.executemany)
+    db.executescript = timed(db.executescript)
+    db.commit = timed(db.commit, "COMMIT")
+
+def instrument_handlers(observe=None):
+    # Оборачиваем handle, а не саму функцию: vkbottle раскладывает аргументы правил по ее __code__.
+    # observe(name, seconds) — дополнительный приемник задержек, например для tools/replay.py
+    for handler in bot.labeler.message_view.handlers:
+        async def timed_handle(event, handle=handler.handle, name=handler.handler.__name__, **context):
+            started = time.perf_counter()
+            metrics.inc("bot_handlers_in_flight")
+            try:
+                return await handle(event, **context)
+            except Exception:
+                metrics.inc("bot_handler_errors_total", name)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                metrics.inc("bot_handlers_in_flight", value=-1)
+                metrics.observe("bot_handler_seconds", elapsed, name)
+                if observe is not None:
+                    observe(name, elapsed)
+
+        handler.handle = timed_handle
+
+async def start_metrics_server(port: int):
+    if not METRICS_ENABLED or not port:
+        return
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        body = await metrics.render()
+        return web.Response(body=body.encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        log.error("Metrics server failed to listen on %s:%s: %s", METRICS_HOST, port, e)
+        return
+    log.info("Metrics listening on %s:%s/metrics", METRICS_HOST, port)
+
+# ================= ТРАССИРОВКА =================
+# Трасса — один запуск игры или ответ чатбота, спаны — его этапы (db, prompt, llm, vk, send).
+# Текущая трасса живет в contextvar и наследуется задачами, созданными внутри нее.
+# Когда трассировка выключена, trace_span стоит одного ContextVar.get.
+TRACE_MAX_SPANS = 200
+current_trace = contextvars.ContextVar("current_trace", default=None)
+trace_depth = contextvars.ContextVar("trace_depth", default=0)
+slow_traces = []
+trace_sequence = itertools.count()
+cpu_profile_task = None
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class TraceSpan:
+    __slots__ = ("trace", "name", "started", "depth", "token")
+
+    def __init__(self, trace: dict, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.depth = trace_depth.get()
+        self.token = trace_depth.set(self.depth + 1)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        finished = time.perf_counter()
+        trace_depth.reset(self.token)
+        spans = self.trace["spans"]
+        if len(spans) < TRACE_MAX_SPANS:
+            spans.append((self.name, (self.started - self.trace["started"]) * 1000, (finished - self.started) * 1000, self.depth))
+        return False
+
+class Trace:
+    def __init__(self, name: str, attrs: dict):
+        self.data = {"name": name, "attrs": attrs, "spans": [], "done": False}
+
+    def __enter__(self):
+        self.data["started"] = time.perf_counter()
+        self.data["started_at"] = time.time()
+        self.token = current_trace.set(self.data)
+        self.depth_token = trace_depth.set(0)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration_ms = (time.perf_counter() - self.data["started"]) * 1000
+        current_trace.reset(self.token)
+        trace_depth.reset(self.depth_token)
+        # Задачи, унаследовавшие контекст, не должны дописывать спаны в закрытую трассу
+        self.data["done"] = True
+        self.data["duration_ms"] = duration_ms
+        if exc_type is not None:
+            self.data["attrs"]["error"] = exc_type.__name__
+        if duration_ms >= TRACE_MIN_MS:
+            entry = (duration_ms, next(trace_sequence), self.data)
+            if len(slow_traces) < TRACE_KEEP:
+                heapq.heappush(slow_traces, entry)
+            elif duration_ms > slow_traces[0][0]:
+                heapq.heapreplace(slow_traces, entry)
+        return False
+
+def start_trace(name: str, **attrs):
+    if not TRACE_ENABLED:
+        return NULL_SPAN
+    return Trace(name, attrs)
+
+def trace_span(name: str):
+    trace = current_trace.get()
+    if trace is None or trace["done"]:
+        return NULL_SPAN
+    return TraceSpan(trace, name)
+
+def format_slow_traces(limit: int = 10) -> str:
+    entries = sorted(slow_traces, reverse=True)[:limit]
+    if not entries:
+        return "Медленных трасс пока нет."
+    lines = [f"🐢 Самые медленные трассы ({len(entries)} из {len(slow_traces)}):"]
+    for index, (duration_ms, _, trace) in enumerate(entries, start=1):
+        started_at = datetime.datetime.fromtimestamp(trace["started_at"], MSK_TZ).strftime("%d.%m %H:%M:%S")
+        attrs = " ".join(f"{key}={value}" for key, value in trace["attrs"].items())
+        lines.append(f"\n{index}. {trace['name']} {duration_ms:.0f} мс, {started_at} {attrs}".rstrip())
+        for name, offset_ms, span_ms, depth in sorted(trace["spans"], key=lambda span: span[1]):
+            lines.append(f"{'  ' * (depth + 1)}{name} +{offset_ms:.0f} {span_ms:.0f} мс")
+    return "\n".join(lines)
+
+# ================= ПРОФИЛИРОВАНИЕ =================
+# Сэмплирующий профайлер: поток раз в PROFILE_INTERVAL_MS снимает стеки всех потоков
+# (event loop и потоки aiosqlite) и пишет их в формате folded stacks для flamegraph.pl и speedscope.
+# Простаивающие вспомогательные потоки пропускаются, простой event loop остается в профиле.
+PROFILE_IDLE_FILES = ("threading.py", "queue.py")
+
+def format_profile_frame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_thread_stacks(seconds: float, interval: float, loop_thread_id: int) -> Counter:
+    stacks = Counter()
+    own_id = threading.get_ident()
+    names = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if thread_id != loop_thread_id and os.path.basename(frame.f_code.co_filename) in PROFILE_IDLE_FILES:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(format_profile_frame(frame))
+                frame = frame.f_back
+            if thread_id not in names:
+                names[thread_id] = "loop" if thread_id == loop_thread_id else next(
+                    (thread.name for thread in threading.enumerate() if thread.ident == thread_id), str(thread_id)
+                )
+            stacks[";".join([names[thread_id], *reversed(frames)])] += 1
+        time.sleep(interval)
+    return stacks
+
+def write_folded_stacks(stacks: Counter) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"cpu-{datetime.datetime.now(MSK_TZ).strftime('%Y%m%d-%H%M%S')}.folded")
+    with open(path, "w", encoding="utf-8") as target:
+        for stack, count in stacks.most_common():
+            target.write(f"{stack} {count}\n")
+    return path
+
+def summarize_profile(stacks: Counter, limit: int = 5) -> list:
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    total = sum(stacks.values()) or 1
+    return [f"{count * 100 / total:.0f}% {frame}" for frame, count in leaves.most_common(limit)]
+
+async def run_cpu_profile(seconds: int) -> dict:
+    started = time.perf_counter()
+    stacks = await asyncio.to_thread(sample_thread_stacks, seconds, PROFILE_INTERVAL_MS / 1000, threading.get_ident())
+    path = await asyncio.to_thread(write_folded_stacks, stacks)
+    log.info("CPU profile written path=%s samples=%s", path, sum(stacks.values()))
+    return {
+        "path": path,
+        "samples": sum(stacks.values()),
+        "elapsed": time.perf_counter() - started,
+        "top": summarize_profile(stacks),
+    }
+
+# ================= ОТПРАВКА В VK =================
+SEND_PRIORITY_GAME = 0
+SEND_PRIORITY_COMMAND = 1
+SEND_PRIORITY_CHAT = 2
+VK_MESSAGE_MAX_CHARS = 4096
+# 1 — неизвестная ошибка, 6 — слишком много запросов в секунду, 10 — внутренняя ошибка VK
+TRANSIENT_VK_ERROR_CODES = {1, 6, 10}
+
+def make_random_id(*parts) -> int:
+    digest = hashlib.sha256("|".join(str(part) for part in parts).encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") & 0x7FFFFFFF or 1
+
+def is_transient_vk_error(error: Exception) -> bool:
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code in TRANSIENT_VK_ERROR_CODES
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError)) or "timeout" in str(error).lower()
+
+def is_reply_to_error(error: Exception) -> bool:
+    error_text = str(error).lower()
+    return "reply_to" in error_text or "forwarded message not found" in error_text
+
+def split_message_text(text: str, limit: int) -> list:
+    """Режет текст по строкам, чтобы упоминания и строки списков не разрывались между сообщениями."""
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class VkSendQueue:
+    """
+    Очередь исходящих сообщений для токена сообщества.
+    Держит лимит запросов в секунду, отдает приоритет игре и повторяет временные ошибки
+    с тем же random_id, чтобы VK не продублировал уже доставленное сообщение.
+    """
+
+    def __init__(self, rate: float, burst: int, workers: int, retries: int, backoff: float):
+        self.bucket = TokenBucket(rate, burst)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = None
+        self.worker_tasks = []
+        self.sequence = itertools.count()
+        self.stats = Counter()
+        self.latency_total = 0.0
+
+    def ensure_started(self):
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+        self.worker_tasks = [task for task in self.worker_tasks if not task.done()]
+        while len(self.worker_tasks) < self.workers:
+            self.worker_tasks.append(asyncio.create_task(self.worker()))
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def send(self, peer_id: int, text: str, priority: int = SEND_PRIORITY_COMMAND, dedupe_key: str | None = None, **params) -> bool:
+        self.ensure_started()
+        if dedupe_key is None:
+            dedupe_key = f"{time.time_ns()}:{next(self.sequence)}"
+        text = text or ""
+        chunks = split_message_text(text, VK_MESSAGE_MAX_CHARS)
+        delivered = True
+        for index, chunk in enumerate(chunks):
+            future = asyncio.get_running_loop().create_future()
+            item = {
+                "peer_id": peer_id,
+                "message": chunk,
+                "random_id": make_random_id(peer_id, dedupe_key, index),
+                "params": dict(params),
+                "future": future,
+                "enqueued_at": time.monotonic(),
+            }
+            await self.queue.put((priority, next(self.sequence), item))
+            delivered = await future and delivered
+        return delivered
+
+    async def worker(self):
+        # Воркер создается из первого send и иначе унаследовал бы его трассу
+        current_trace.set(None)
+        while True:
+            _, _, item = await self.queue.get()
+            try:
+                delivered = await self.deliver(item)
+            except Exception as e:
+                log.exception("VK send worker error peer_id=%s: %s", item["peer_id"], e)
+                delivered = False
+            finally:
+                self.queue.task_done()
+            if not item["future"].done():
+                item["future"].set_result(delivered)
+
+    async def deliver(self, item: dict) -> bool:
+        params = item["params"]
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await bot.api.messages.send(
+                    peer_id=item["peer_id"],
+                    message=item["message"],
+                    random_id=item["random_id"],
+                    **params,
+                )
+                self.stats["sent"] += 1
+                self.latency_total += time.monotonic() - item["enqueued_at"]
+                return True
+            except Exception as e:
+                if params.get("reply_to") and is_reply_to_error(e):
+                    log.warning("send_reply failed with reply_to, retrying without reply_to: %s", e)
+                    params.pop("reply_to", None)
+                    self.stats["reply_fallback"] += 1
+                    continue
+                if attempt >= self.retries or not is_transient_vk_error(e):
+                    self.stats["failed"] += 1
+                    log.warning(
+                        "Failed to send message to peer_id=%s after %s attempts: %s",
+                        item["peer_id"],
+                        attempt + 1,
+                        e,
+                    )
+                    return False
+                delay = self.backoff * (2 ** attempt) + random.uniform(0, self.backoff)
+                attempt += 1
+                self.stats["retried"] += 1
+                log.debug("Transient VK error peer_id=%s attempt=%s retry_in=%.2fs: %s", item["peer_id"], attempt, delay, e)
+                await asyncio.sleep(delay)
+
+    def describe(self) -> str:
+        sent = self.stats["sent"]
+        avg_latency = self.latency_total / sent if sent else 0.0
+        return (
+            f"очередь {self.depth()}, sent={sent} retried={self.stats['retried']} "
+            f"failed={self.stats['failed']} avg={avg_latency * 1000:.0f}ms"
+        )
+
+vk_send_queue = VkSendQueue(VK_SEND_RATE, VK_SEND_BURST, VK_SEND_WORKERS, VK_SEND_RETRIES, VK_SEND_BACKOFF)
+
+async def send_reply(message: Message, text: str, priority: int = SEND_PRIORITY_COMMAND, **kwargs):
     reply_to = get_reply_to_id(message)
     if reply_to:
         kwargs.setdefault("reply_to", reply_to)
-    try:
-        await message.answer(text, **kwargs)
-    except Exception as e:
-        error_text = str(e).lower()
-        if reply_to and ("reply_to" in error_text or "forwarded message not found" in error_text):
-            try:
-                log.warning("send_reply failed with reply_to, retrying without reply_to: %s", e)
-                kwargs.pop("reply_to", None)
-                await message.answer(text, **kwargs)
-                return
-            except Exception as inner:
-                log.exception("send_reply fallback failed: %s", inner)
-                return
-        log.exception("send_reply failed: %s", e)
+        dedupe_key = f"reply:{reply_to}:{hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]}"
+    else:
+        dedupe_key = None
+    with trace_span("send"):
+        return await vk_send_queue.send(message.peer_id, text, priority=priority, dedupe_key=dedupe_key, **kwargs)
+
+# ================= VK EXECUTE =================
+class CoalescingAPI(API):
+    """
+    API VK, который собирает вызовы из короткого окна и отправляет до 25 штук одним `execute`.
+    Ответы и ошибки возвращаются каждому вызывающему по отдельности.
+    """
+
+    def __init__(self, token: str, window: float = 0.0, methods: set | None = None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.window = window
+        self.methods = methods or set()
+        self.pending = []
+        self.flush_handle = None
+        self.execute_stats = Counter()
+
+    async def request(self, method: str, data: dict) -> dict:
+        with trace_span(f"vk:{method}"):
+            return await self.measured_request(method, data)
+
+    async def measured_request(self, method: str, data: dict) -> dict:
+        if not metrics.enabled:
+            return await self.coalesce_request(method, data)
+        started = time.perf_counter()
+        try:
+            return await self.coalesce_request(method, data)
+        except Exception as e:
+            metrics.inc("bot_vk_api_errors_total", method, getattr(e, "code", None) or type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_vk_api_request_seconds", time.perf_counter() - started, method)
+
+    async def coalesce_request(self, method: str, data: dict) -> dict:
+        if self.window <= 0 or method not in self.methods:
+            return await super().request(method, data)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((method, data, future))
+        if len(self.pending) >= VK_EXECUTE_MAX_CALLS:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        while self.pending:
+            batch = self.pending[:VK_EXECUTE_MAX_CALLS]
+            self.pending = self.pending[VK_EXECUTE_MAX_CALLS:]
+            asyncio.create_task(self.dispatch(batch))
+
+    async def dispatch(self, batch: list):
+        if len(batch) == 1:
+            method, data, future = batch[0]
+            await self.forward_single(method, data, future)
+            return
+        try:
+            await self.execute_batch(batch)
+        except Exception as e:
+            log.warning("VK execute failed for %s calls, sending one by one: %s", len(batch), e)
+            self.execute_stats["execute_failed"] += 1
+            await asyncio.gather(
+                *(self.forward_single(method, data, future) for method, data, future in batch if not future.done())
+            )
+
+    async def forward_single(self, method: str, data: dict, future: asyncio.Future):
+        self.execute_stats["single"] += 1
+        try:
+            result = await API.request(self, method, data)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    async def request_execute(self, code: str) -> dict:
+        # Мимо validate_response: VKAPIErrorResponseValidator проверяет `"error" in item` для каждого
+        # элемента списка и падает на числах и false, которыми execute отвечает за messages.send
+        data = await self.validate_request({"code": code})
+        async with self.token_generator as token:
+            raw = await self.http_client.request_text(
+                self.API_URL + "execute",
+                method="POST",
+                data=data,
+                params={"access_token": token, "v": self.API_VERSION},
+            )
+        response = json.loads(raw)
+        if "error" in response:
+            error = dict(response["error"])
+            raise VKAPIError[error.pop("error_code", 1)](**error)
+        if "response" not in response:
+            raise VKAPIError[1](error_msg=f"Unknown response from execute: {raw[:200]}")
+        return response
+
+    async def execute_batch(self, batch: list):
+        calls = []
+        for method, data, _ in batch:
+            params = await self.validate_request(dict(data))
+            calls.append(f"API.{method}({json.dumps(params, ensure_ascii=False)})")
+        code = "return [" + ",".join(calls) + "];"
+        response = await self.request_execute(code)
+        self.execute_stats["execute"] += 1
+        self.execute_stats["coalesced"] += len(batch)
+        results = response.get("response") or []
+        # Упавшие вызовы возвращают false, а ошибки идут списком в том же порядке
+        errors = list(response.get("execute_errors") or [])
+        for index, (method, _, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index >= len(results):
+                future.set_exception(VKAPIError[1](error_msg=f"No result for {method} in execute response"))
+                continue
+            result = results[index]
+            if result is False and errors:
+                error = errors.pop(0)
+                future.set_exception(
+                    VKAPIError[error.get("error_code", 1)](error_msg=error.get("error_msg", "execute error"))
+                )
+            else:
+                future.set_result({"response": result})
+
+    def describe(self) -> str:
+        if self.window <= 0:
+            return "выключен"
+        return (
+            f"окно {self.window * 1000:.0f}ms, execute={self.execute_stats['execute']} "
+            f"calls={self.execute_stats['coalesced']} single={self.execute_stats['single']}"
+        )
+
+# ================= ЗАПИСЬ СОБЫТИЙ =================
+# Входящие события VK пишутся в EVENT_RECORD_PATH (gzip JSONL) для tools/replay.py.
+# id пользователей и чатов заменяются стабильными хэшами, текст по умолчанию маскируется
+# с сохранением длины и команд, вложения сводятся к типу.
+EVENT_RECORD_ID_KEYS = {"from_id", "peer_id", "user_id", "member_id", "admin_author_id", "to_id"}
+EVENT_RECORD_MENTION_RE = re.compile(r"\[(id|club|public)(\d+)\|[^\]]*\]")
+EVENT_RECORD_FLUSH_INTERVAL = 1.0
+event_recorder = None
 
+def anonymize_vk_id(value):
+    if not isinstance(value, int) or value <= 0:
+        # Отрицательные id — сообщества, в том числе сам бот: их оставляем
+        return value
+    digest = int.from_bytes(hashlib.blake2b(f"{EVENT_RECORD_SALT}:{value}".encode("utf-8"), digest_size=8).digest(), "big")
+    if value >= 2000000000:
+        return 2000000001 + digest % 999999
+    return 1 + digest % 999999999
+
+def mask_record_text(text: str) -> str:
+    if not text:
+        return text
+    def replace_mention(match):
+        kind, number = match.group(1), int(match.group(2))
+        if kind == "id":
+            return f"[id{anonymize_vk_id(number)}|user]"
+        return match.group(0)
+    if EVENT_RECORD_TEXT == "full":
+        return EVENT_RECORD_MENTION_RE.sub(replace_mention, text)
+    head = ""
+    stripped = text.lstrip()
+    if stripped.startswith("/"):
+        # Команда остается читаемой, чтобы при повторе сработал тот же обработчик
+        head, _, text = stripped.partition(" ")
+        head += " " if text else ""
+    parts = []
+    position = 0
+    for match in EVENT_RECORD_MENTION_RE.finditer(text):
+        parts.append(re.sub(r"\w", "x", text[position:match.start()]))
+        parts.append(replace_mention(match))
+        position = match.end()
+    parts.append(re.sub(r"\w", "x", text[position:]))
+    return head + "".join(parts)
+
+def anonymize_update(value, key: str | None = None):
+    if isinstance(value, dict):
+        result = {}
+        for item_key, item in value.items():
+            if item_key == "secret":
+                continue
+            if item_key == "attachments" and isinstance(item, list):
+                result[item_key] = [{"type": attachment.get("type")} for attachment in item if isinstance(attachment, dict)]
+                continue
+            result[item_key] = anonymize_update(item, item_key)
+        return result
+    if isinstance(value, list):
+        return [anonymize_update(item, key) for item in value]
+    if key in EVENT_RECORD_ID_KEYS:
+        return anonymize_vk_id(value)
+    if key == "text" and isinstance(value, str):
+        return mask_record_text(value)
+    return value
+
+class EventRecorder:
+    """Пишет события в gzip JSONL. Каждый запуск дописывает новый gzip-член со своим заголовком."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file = None
+        self.last_flush = 0.0
+        self.stats = Counter()
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            log.warning("Event record file %s is over EVENT_RECORD_MAX_MB, recording disabled", self.path)
+            return False
+        self.file = gzip.open(self.path, "ab")
+        self.write({"format": 1, "started_at": time.time(), "group_id": BOT_GROUP_ID, "text": EVENT_RECORD_TEXT})
+        log.info("Recording incoming events to %s (text=%s)", self.path, EVENT_RECORD_TEXT)
+        return True
+
+    def write(self, entry: dict):
+        if self.file is None:
+            return
+        self.file.write((json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8"))
+        self.stats["written"] += 1
+        now = time.monotonic()
+        if now - self.last_flush < EVENT_RECORD_FLUSH_INTERVAL:
+            return
+        self.last_flush = now
+        # Синхронный сброс раз в секунду: после падения файл читается до последнего сброса
+        self.file.flush(zlib.Z_SYNC_FLUSH)
+        if os.path.getsize(self.path) >= self.max_bytes:
+            log.warning("Event record file %s reached EVENT_RECORD_MAX_MB, recording stopped", self.path)
+            self.close()
+
+    def record_update(self, update: dict):
+        try:
+            self.write({"t": round(time.time(), 3), "update": anonymize_update(update)})
+        except Exception as e:
+            self.stats["failed"] += 1
+            log.warning("Failed to record update type=%s: %s", update.get("type"), e)
+
+    def record_timer(self, kind: str, peer_id: int, payload: dict):
+        self.write({"t": round(time.time(), 3), "timer": kind, "peer_id": anonymize_vk_id(peer_id), "payload": payload})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def detach(self):
+        # После fork файл принадлежит родителю: закрытие копии дописало бы в него хвост gzip.
+        # Подменяем дескриптор на /dev/null, и тогда копию можно спокойно отпустить
+        if self.file is None:
+            return
+        null_fd = os.open(os.devnull, os.O_WRONLY)
+        try:
+            os.dup2(null_fd, self.file.fileobj.fileno())
+        finally:
+            os.close(null_fd)
+        self.file = None
+
+    def describe(self) -> str:
+        if self.file is None:
+            return "остановлена"
+        return f"{self.path}, событий {self.stats['written']}"
+
+def start_event_recorder():
+    global event_recorder
+    if not EVENT_RECORD_PATH or event_recorder is not None:
+        return
+    recorder = EventRecorder(EVENT_RECORD_PATH, EVENT_RECORD_MAX_MB * 1024 * 1024)
+    if recorder.open():
+        event_recorder = recorder
+
+class RecordingRouter(Router):
+    """Router, который перед обработкой отдает событие в event_recorder, если запись включена."""
 
-bot = Bot(token=VK_TOKEN)
-groq_client = AsyncGroq(api_key=GROQ_API_KEY) if LLM_PROVIDER == "groq" and AsyncGroq else None
+    async def route(self, event: dict, ctx_api) -> None:
+        if event_recorder is not None:
+            event_recorder.record_update(event)
+        await super().route(event, ctx_api)
+
+bot = Bot(api=CoalescingAPI(VK_TOKEN, window=VK_EXECUTE_WINDOW_MS / 1000, methods=VK_EXECUTE_METHODS), router=RecordingRouter())
+groq_client = AsyncGroq(api_key=GROQ_API_KEY) if LLM_PROVIDER == "groq" and GROQ_API_KEY and AsyncGroq else None
 
 def build_venice_headers() -> dict:
     return {"Authorization": f"Bearer {VENICE_API_KEY}"}
@@ -442,8 +1469,20 @@ async def venice_request(method: str, path: str, **kwargs) -> httpx.Response:
     return response
 
 # ================= БАЗА ДАННЫХ =================
+@asynccontextmanager
+async def connect_db():
+    # Все соединения бота регистрируют text_unzip: сжатые строки читаются прозрачно через text_sql()
+    with trace_span("db"):
+        async with aiosqlite.connect(DB_NAME) as db:
+            await db.create_function("text_unzip", 2, text_unzip, deterministic=True)
+            if metrics.enabled:
+                instrument_db(db)
+            yield db
+
 async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect_db() as db:
+        # Для новой базы режим применяется сразу; старую перестраиваем один раз ниже
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
         await db.execute("CREATE TABLE IF NOT EXISTS messages (user_id INTEGER, peer_id INTEGER, text TEXT, timestamp INTEGER, username TEXT)")
         await db.execute("CREATE TABLE IF NOT EXISTS bot_dialogs (id INTEGER PRIMARY KEY AUTOINCREMENT, peer_id INTEGER, user_id INTEGER, role TEXT, text TEXT, timestamp INTEGER)")
         await db.execute("CREATE INDEX IF NOT EXISTS idx_bot_dialogs_peer_user_time ON bot_dialogs (peer_id, user_id, timestamp)")
@@ -451,11 +1490,272 @@ async def init_db():
         await db.execute("CREATE TABLE IF NOT EXISTS last_winner (peer_id INTEGER PRIMARY KEY, winner_id INTEGER, timestamp INTEGER)")
         await db.execute("CREATE TABLE IF NOT EXISTS leaderboard_schedule (peer_id INTEGER PRIMARY KEY, day INTEGER, time TEXT, last_run_month TEXT)")
         await db.execute("CREATE TABLE IF NOT EXISTS schedules (peer_id INTEGER PRIMARY KEY, time TEXT)")
+        await db.execute("CREATE TABLE IF NOT EXISTS cluster_lease (name TEXT PRIMARY KEY, holder TEXT, expires_at REAL)")
+        await db.execute("CREATE TABLE IF NOT EXISTS runtime_settings (name TEXT PRIMARY KEY, value TEXT, version INTEGER, updated_by TEXT, updated_at INTEGER)")
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                peer_id INTEGER,
+                payload TEXT,
+                dedupe_key TEXT UNIQUE,
+                state TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                run_at REAL NOT NULL,
+                locked_until REAL,
+                locked_by TEXT,
+                last_error TEXT,
+                created_at REAL,
+                updated_at REAL
+            )
+            """
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state_run_at ON jobs (state, run_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bot_dialogs_timestamp ON bot_dialogs (timestamp)")
+        await db.execute("CREATE TABLE IF NOT EXISTS maintenance_state (step TEXT PRIMARY KEY, last_run_at REAL, duration_ms INTEGER, result TEXT)")
+        cursor = await db.execute("PRAGMA table_info(messages)")
+        message_columns = {row[1] for row in await cursor.fetchall()}
+        if "conversation_message_id" not in message_columns:
+            await db.execute("ALTER TABLE messages ADD COLUMN conversation_message_id INTEGER")
+        await add_text_compression_columns(db, "messages", message_columns)
+        cursor = await db.execute("PRAGMA table_info(bot_dialogs)")
+        await add_text_compression_columns(db, "bot_dialogs", {row[1] for row in await cursor.fetchall()})
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS text_dicts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL,
+                dict BLOB NOT NULL,
+                samples INTEGER,
+                rows INTEGER NOT NULL DEFAULT 0,
+                raw_bytes INTEGER NOT NULL DEFAULT 0,
+                compressed_bytes INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        # У старых строк id нет (NULL), уникальность проверяется только для заполненных
+        await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_peer_cmid ON messages (peer_id, conversation_message_id)")
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS backfill_state (
+                peer_id INTEGER PRIMARY KEY,
+                status TEXT,
+                start_cmid INTEGER,
+                newest_cmid INTEGER,
+                stop_cmid INTEGER,
+                pages INTEGER NOT NULL DEFAULT 0,
+                fetched INTEGER NOT NULL DEFAULT 0,
+                inserted INTEGER NOT NULL DEFAULT 0,
+                started_at REAL,
+                updated_at REAL,
+                last_error TEXT
+            )
+            """
+        )
+        fts_created = await init_search_index(db)
+        await init_user_stats(db)
+        await init_game_records(db)
         await db.commit()
+        # WAL позволяет нескольким процессам читать, пока один пишет
+        cursor = await db.execute("PRAGMA journal_mode=WAL")
+        await cursor.fetchall()
+        cursor = await db.execute("PRAGMA auto_vacuum")
+        auto_vacuum = (await cursor.fetchone())[0]
+        if auto_vacuum != 2 and is_retention_enabled():
+            log.warning("Converting database to incremental auto_vacuum, running one-time VACUUM")
+            await db.execute("VACUUM")
+            # VACUUM может перенумеровать rowid в messages, а индекс поиска ссылается на них
+            fts_created = True
+        if fts_created:
+            await rebuild_search_index(db)
+
+async def add_text_compression_columns(db, table: str, columns: set):
+    if "text_z" not in columns:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN text_z BLOB")
+    if "dict_id" not in columns:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN dict_id INTEGER")
+
+async def init_search_index(db) -> bool:
+    """Создает FTS5-индекс поверх messages. Возвращает True, если индекс новый и его нужно заполнить."""
+    cursor = await db.execute("SELECT 1 FROM text_dicts LIMIT 1")
+    # Сжатые строки появляются только после обучения словаря
+    compressed = TEXT_COMPRESSION_ENABLED or bool(await cursor.fetchall())
+    cursor = await db.execute("SELECT sql FROM sqlite_master WHERE name = 'messages_fts'")
+    row = (await cursor.fetchall() or [None])[0]
+    exists = row is not None and ("messages_text" in row[0]) == compressed
+    for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+        await db.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    if row is not None and not exists:
+        await db.execute("DROP TABLE messages_fts")
+    if compressed:
+        # Содержимое индекса берется из представления: для сжатых строк текст распаковывается
+        await db.execute(
+            f"CREATE VIEW IF NOT EXISTS messages_text AS SELECT rowid AS message_rowid, {text_sql()} AS text, peer_id FROM messages"
+        )
+        content = "content='messages_text', content_rowid='message_rowid'"
+    else:
+        await db.execute("DROP VIEW IF EXISTS messages_text")
+        content = "content='messages', content_rowid='rowid'"
+    # peer_id индексируется вместе с текстом, чтобы фильтр по чату тоже шел через MATCH
+    await db.execute(
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, peer_id, {content}, tokenize='unicode61 remove_diacritics 2'
+        )
+        """
+    )
+    await db.execute(
+        """
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text, peer_id) VALUES (new.rowid, new.text, new.peer_id);
+        END
+        """
+    )
+    if not compressed:
+        await db.execute(
+            """
+            CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text, peer_id) VALUES ('delete', old.rowid, old.text, old.peer_id);
+            END
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text, peer_id) VALUES ('delete', old.rowid, old.text, old.peer_id);
+                INSERT INTO messages_fts (rowid, text, peer_id) VALUES (new.rowid, new.text, new.peer_id);
+            END
+            """
+        )
+        return not exists
+    # Триггеры не вызывают text_unzip, чтобы база открывалась и менялась любым клиентом SQLite.
+    # Сжатые строки (text IS NULL) бот убирает из индекса сам, см. delete_compressed_from_search_index
+    await db.execute(
+        """
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages WHEN old.text IS NOT NULL BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text, peer_id) VALUES ('delete', old.rowid, old.text, old.peer_id);
+        END
+        """
+    )
+    # Сжатие обнуляет text, но содержимое не меняется — индекс в этом случае не трогаем
+    await db.execute(
+        """
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF text, peer_id ON messages
+        WHEN old.text IS NOT NULL AND new.text IS NOT NULL BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text, peer_id) VALUES ('delete', old.rowid, old.text, old.peer_id);
+            INSERT INTO messages_fts (rowid, text, peer_id) VALUES (new.rowid, new.text, new.peer_id);
+        END
+        """
+    )
+    return not exists
+
+async def delete_compressed_from_search_index(db, rowids: list):
+    placeholders = ", ".join(["?"] * len(rowids))
+    await db.execute(
+        f"""
+        INSERT INTO messages_fts (messages_fts, rowid, text, peer_id)
+        SELECT 'delete', rowid, {text_sql()}, peer_id FROM messages WHERE rowid IN ({placeholders}) AND text IS NULL
+        """,
+        rowids,
+    )
+
+async def init_user_stats(db):
+    cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE name = 'daily_user_stats'")
+    exists = bool(await cursor.fetchall())
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS daily_user_stats (
+            peer_id INTEGER,
+            date TEXT,
+            user_id INTEGER,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            char_count INTEGER NOT NULL DEFAULT 0,
+            active_hours INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (peer_id, date, user_id)
+        )
+        """
+    )
+    if exists:
+        return
+    # Первичное заполнение из истории; active_hours — битовая маска часов МСК, в которые писал пользователь
+    started = time.perf_counter()
+    await db.execute(
+        f"""
+        INSERT INTO daily_user_stats (peer_id, date, user_id, message_count, char_count, active_hours)
+        SELECT peer_id, date, user_id, SUM(message_count), SUM(char_count), SUM(1 << hour)
+        FROM (
+            SELECT peer_id,
+                   date(timestamp, 'unixepoch', '+3 hours') AS date,
+                   user_id,
+                   CAST(strftime('%H', timestamp, 'unixepoch', '+3 hours') AS INTEGER) AS hour,
+                   COUNT(*) AS message_count,
+                   SUM(length({text_sql()})) AS char_count
+            FROM messages
+            GROUP BY peer_id, date, user_id, hour
+        )
+        GROUP BY peer_id, date, user_id
+        """
+    )
+    log.info("User stats backfilled in %.1fs", time.perf_counter() - started)
+
+async def init_game_records(db):
+    cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE name = 'game_records'")
+    exists = bool(await cursor.fetchall())
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS game_records (
+            peer_id INTEGER,
+            user_id INTEGER,
+            total_wins INTEGER NOT NULL DEFAULT 0,
+            current_streak INTEGER NOT NULL DEFAULT 0,
+            best_streak INTEGER NOT NULL DEFAULT 0,
+            last_win_date TEXT,
+            current_month TEXT,
+            current_month_wins INTEGER NOT NULL DEFAULT 0,
+            best_month TEXT,
+            best_month_wins INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (peer_id, user_id)
+        )
+        """
+    )
+    if not exists:
+        await rebuild_game_records(db)
+
+async def rebuild_search_index(db):
+    started = time.perf_counter()
+    await db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    await db.commit()
+    log.info("Search index rebuilt in %.1fs", time.perf_counter() - started)
 
 # ================= LLM ЗАПРОСЫ =================
-async def fetch_llm_messages(messages: list, max_tokens: int = None) -> str:
+async def fetch_llm_messages(messages: list, max_tokens: int = None, response_schema: dict = None) -> str:
+    with trace_span("llm"):
+        return await measure_llm_messages(messages, max_tokens, response_schema)
+
+async def measure_llm_messages(messages: list, max_tokens: int = None, response_schema: dict = None) -> str:
+    if not metrics.enabled:
+        return await request_llm_messages(messages, max_tokens, response_schema)
+    provider = LLM_PROVIDER
+    model, _ = get_active_llm_settings()
+    started = time.perf_counter()
+    metrics.inc("bot_llm_in_flight")
+    try:
+        return await request_llm_messages(messages, max_tokens, response_schema)
+    except Exception as e:
+        metrics.inc("bot_llm_errors_total", provider, classify_llm_error(e))
+        raise
+    finally:
+        metrics.inc("bot_llm_in_flight", value=-1)
+        metrics.observe("bot_llm_request_seconds", time.perf_counter() - started, provider, model)
+
+async def request_llm_messages(messages: list, max_tokens: int = None, response_schema: dict = None) -> str:
     max_tokens = normalize_max_tokens(max_tokens, LLM_MAX_TOKENS)
+    if LLM_PROVIDER == "mock":
+        log.debug("Sending request to Mock. Model=%s Temp=%s", MOCK_MODEL, MOCK_TEMPERATURE)
+        return await fetch_mock_messages(messages, max_tokens, response_schema)
     if LLM_PROVIDER == "venice":
         log.debug("Sending request to Venice. Model=%s Temp=%s", VENICE_MODEL, VENICE_TEMPERATURE)
         payload = {
@@ -467,6 +1767,11 @@ async def fetch_llm_messages(messages: list, max_tokens: int = None) -> str:
                 "include_venice_system_prompt": VENICE_INCLUDE_SYSTEM_PROMPT,
             },
         }
+        if response_schema:
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": response_schema.get("title", "response"), "strict": True, "schema": response_schema},
+            }
         response = await venice_request("POST", "chat/completions", json=payload)
         response_data = response.json()
         content = (
@@ -481,46 +1786,563 @@ async def fetch_llm_messages(messages: list, max_tokens: int = None) -> str:
     if not groq_client:
         raise RuntimeError("Groq client is not initialized")
     log.debug("Sending request to Groq. Model=%s Temp=%s", GROQ_MODEL, GROQ_TEMPERATURE)
+    extra_params = {}
+    if response_schema:
+        # Groq поддерживает только JSON mode, схему проверяем сами
+        extra_params["response_format"] = {"type": "json_object"}
     completion = await groq_client.chat.completions.create(
         model=GROQ_MODEL,
         messages=messages,
         temperature=GROQ_TEMPERATURE,
         max_tokens=max_tokens,
+        **extra_params,
     )
     content = completion.choices[0].message.content
     if not content:
         raise ValueError("Empty content in Groq response")
     return content
 
-async def fetch_llm_content(system_prompt: str, user_prompt: str) -> str:
+async def fetch_llm_content(system_prompt: str, user_prompt: str, response_schema: dict = None) -> str:
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt},
     ]
-    return await fetch_llm_messages(messages)
+    return await fetch_llm_messages(messages, response_schema=response_schema)
 
+def get_active_llm_settings() -> tuple:
+    if LLM_PROVIDER == "venice":
+        return VENICE_MODEL, VENICE_TEMPERATURE
+    if LLM_PROVIDER == "mock":
+        return MOCK_MODEL, MOCK_TEMPERATURE
+    return GROQ_MODEL, GROQ_TEMPERATURE
 
-async def choose_winner_via_llm(chat_log: list, excluded_user_id=None) -> dict:
-    context_lines = []
-    available_ids = set()
-    alias_map = {}
-    alias_names = {}
-    alias_to_user_id = {}
-    alias_order = []
-    alias_counter = 0
+# ================= MOCK ПРОВАЙДЕР =================
+# Отвечает без сети: валидный JSON победителя для игры и заготовки для чатбота.
+# Задержки, 429, таймауты и битый JSON выпадают с заданной вероятностью, чтобы гонять
+# пути отказа (repair, batch -> single, локальный фолбэк, повтор задачи) без настоящего API.
+MOCK_MODELS = {
+    "mock-small": {"context_length": 8192, "pricing": None},
+    "mock-large": {"context_length": 131072, "pricing": None},
+}
+MOCK_CHAT_REPLIES = (
+    "Ну ты и выдал, конечно.",
+    "Я бы ответил, но мне лень.",
+    "Звучит как план. Плохой, но план.",
+    "Спроси у того, кто вчера был пидором дня.",
+    "Без комментариев. Ладно, один: нет.",
+)
+MOCK_WINNER_REASONS = (
+    "Спамил весь день и ни одной умной мысли.",
+    "Писал капсом, как будто мы глухие.",
+    "Слишком много смайликов для взрослого человека.",
+    "Душнил в каждом втором сообщении.",
+)
+MOCK_ALIAS_RE = re.compile(r"\bU\d+\b")
+MOCK_SECTION_RE = re.compile(r"^### (C\d+)$", re.MULTILINE)
+MOCK_LATENCY_KINDS = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exp": 1}
+MOCK_STATS = Counter()
 
-    def get_alias(uid: int, safe_name: str) -> str:
-        nonlocal alias_counter
-        if uid not in alias_map:
-            alias_counter += 1
-            alias = f"U{alias_counter}"
-            alias_map[uid] = alias
-            alias_names[alias] = safe_name
-            alias_to_user_id[alias] = uid
+def parse_mock_latency(spec: str) -> tuple:
+    # Формат: fixed:0.3 | uniform:0.2,1.5 | normal:0.8,0.2 | lognormal:<медиана>,<sigma> | exp:<среднее>
+    kind, _, raw_params = spec.partition(":")
+    try:
+        params = tuple(float(item) for item in raw_params.split(",") if item.strip())
+    except ValueError:
+        params = ()
+    if MOCK_LATENCY_KINDS.get(kind) != len(params) or any(value < 0 for value in params):
+        log.warning("MOCK_LATENCY has invalid format: %s; using fixed:0", spec)
+        return "fixed", (0.0,)
+    return kind, params
+
+def load_mock_replies(path: str) -> tuple:
+    if not path:
+        return MOCK_CHAT_REPLIES
+    try:
+        with open(path, encoding="utf-8") as source:
+            replies = tuple(line.strip() for line in source if line.strip())
+    except OSError as e:
+        log.warning("Failed to read MOCK_REPLIES_FILE=%s: %s", path, e)
+        return MOCK_CHAT_REPLIES
+    return replies or MOCK_CHAT_REPLIES
+
+mock_latency = parse_mock_latency(MOCK_LATENCY)
+mock_replies = load_mock_replies(MOCK_REPLIES_FILE)
+# Отдельный генератор: MOCK_SEED делает прогоны воспроизводимыми и не трогает random игры
+mock_rng = random.Random(MOCK_SEED or None)
+
+def sample_mock_latency() -> float:
+    kind, params = mock_latency
+    if kind == "uniform":
+        value = mock_rng.uniform(*params)
+    elif kind == "normal":
+        value = mock_rng.gauss(*params)
+    elif kind == "lognormal":
+        median, sigma = params
+        value = mock_rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+    elif kind == "exp":
+        value = mock_rng.expovariate(1 / params[0]) if params[0] > 0 else 0.0
+    else:
+        value = params[0]
+    return max(value, 0.0)
+
+def build_mock_winner(text: str) -> dict:
+    aliases = list(dict.fromkeys(MOCK_ALIAS_RE.findall(text)))
+    return {
+        "user_id": mock_rng.choice(aliases) if aliases else 0,
+        "reason": mock_rng.choice(MOCK_WINNER_REASONS),
+    }
+
+def build_mock_content(messages: list, max_tokens: int, response_schema: dict | None) -> tuple:
+    """Возвращает (текст ответа, это JSON) по виду запроса: пакет, одиночная игра, repair или чат."""
+    system = next((item["content"] for item in messages if item.get("role") == "system"), "")
+    user = "\n".join(item["content"] for item in messages if item.get("role") == "user")
+    title = (response_schema or {}).get("title")
+    if title == "winners" or system == BATCH_SYSTEM_PROMPT:
+        sections = MOCK_SECTION_RE.split(user)
+        result = {key: build_mock_winner(body) for key, body in zip(sections[1::2], sections[2::2])}
+        return json.dumps(result, ensure_ascii=False), True
+    if title == "winner" or system in (SYSTEM_PROMPT, REPAIR_SYSTEM_PROMPT):
+        return json.dumps(build_mock_winner(user), ensure_ascii=False), True
+    # Чатбот: заготовка, обрезанная до max_tokens по той же грубой оценке, что и бюджет промпта
+    return mock_rng.choice(mock_replies)[:max_tokens * 3], False
+
+async def stream_mock_chunks(content: str):
+    for start in range(0, len(content), MOCK_CHUNK_CHARS):
+        if start:
+            await asyncio.sleep(MOCK_CHUNK_DELAY)
+        yield content[start:start + MOCK_CHUNK_CHARS]
+
+async def fetch_mock_messages(messages: list, max_tokens: int, response_schema: dict = None) -> str:
+    MOCK_STATS["requests"] += 1
+    roll = mock_rng.random()
+    if roll < MOCK_RATE_LIMIT_RATE:
+        MOCK_STATS["rate_limited"] += 1
+        # 429 приходит быстро: сервер отказывает до генерации
+        await asyncio.sleep(sample_mock_latency() * 0.1)
+        raise RuntimeError('HTTP 429: {"error": "Rate limit exceeded (mock)"}')
+    if roll < MOCK_RATE_LIMIT_RATE + MOCK_TIMEOUT_RATE:
+        MOCK_STATS["timeouts"] += 1
+        await asyncio.sleep(MOCK_TIMEOUT)
+        raise httpx.ReadTimeout("Mock request timed out")
+
+    content, is_json = build_mock_content(messages, max_tokens, response_schema)
+    if mock_rng.random() < MOCK_MALFORMED_RATE:
+        MOCK_STATS["malformed"] += 1
+        # Обрыв посреди ответа, как при исчерпании max_tokens: JSON без закрывающих скобок
+        content = content[:max(len(content) // 2, 1)] if is_json else ""
+
+    # Задержка до первого токена, дальше куски приходят с паузой, как при stream=true
+    await asyncio.sleep(sample_mock_latency())
+    if MOCK_CHUNK_CHARS:
+        content = "".join([chunk async for chunk in stream_mock_chunks(content)])
+    if not content:
+        raise ValueError("Empty content in Mock response")
+    MOCK_STATS["ok"] += 1
+    return content
+
+def describe_mock_stats() -> str:
+    kind, params = mock_latency
+    return (
+        f"{kind}:{','.join(f'{value:g}' for value in params)} "
+        f"requests={MOCK_STATS['requests']} 429={MOCK_STATS['rate_limited']} "
+        f"timeouts={MOCK_STATS['timeouts']} malformed={MOCK_STATS['malformed']}"
+    )
+
+# ================= КАТАЛОГ МОДЕЛЕЙ =================
+def parse_model_entry(provider: str, item) -> tuple:
+    if provider == "groq":
+        extra = getattr(item, "model_extra", None) or {}
+        context_length = getattr(item, "context_window", None) or extra.get("context_window")
+        return item.id, {"context_length": context_length, "pricing": None}
+    spec = item.get("model_spec") or {}
+    context_length = spec.get("availableContextTokens") or item.get("context_length")
+    pricing = spec.get("pricing") or item.get("pricing")
+    return item.get("id"), {"context_length": context_length, "pricing": pricing}
+
+async def fetch_provider_models(provider: str) -> dict:
+    if provider == "mock":
+        return dict(MOCK_MODELS)
+    if provider == "groq":
+        if not GROQ_API_KEY:
+            raise RuntimeError("Не найден GROQ_API_KEY")
+        if AsyncGroq is None:
+            raise RuntimeError("Пакет groq не установлен")
+        client = groq_client or AsyncGroq(api_key=GROQ_API_KEY)
+        models_response = await client.models.list()
+        items = models_response.data
+    else:
+        if not VENICE_API_KEY:
+            raise RuntimeError("Не найден VENICE_API_KEY")
+        response = await venice_request("GET", "models")
+        items = response.json().get("data", [])
+    models = {}
+    for item in items:
+        model_id, meta = parse_model_entry(provider, item)
+        if model_id:
+            models[model_id] = meta
+    return models
+
+class ModelCatalog:
+    """Кэш списка моделей по провайдерам: отдаем устаревшие данные сразу и обновляем их в фоне."""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.entries = {}
+        self.refresh_tasks = {}
+        self.last_errors = {}
+
+    def is_stale(self, provider: str) -> bool:
+        entry = self.entries.get(provider)
+        return entry is None or time.monotonic() - entry["fetched_at"] > self.ttl
+
+    async def refresh(self, provider: str):
+        try:
+            models = await fetch_provider_models(provider)
+        except Exception as e:
+            self.last_errors[provider] = str(e)
+            log.warning("Model catalog refresh failed provider=%s: %s", provider, e)
+            return
+        if not models:
+            self.last_errors[provider] = "empty model list"
+            log.warning("Model catalog refresh returned no models provider=%s", provider)
+            return
+        self.entries[provider] = {"models": models, "fetched_at": time.monotonic()}
+        self.last_errors.pop(provider, None)
+        log.info("Model catalog refreshed provider=%s models=%s", provider, len(models))
+
+    def schedule_refresh(self, provider: str) -> asyncio.Task:
+        task = self.refresh_tasks.get(provider)
+        if task is None or task.done():
+            task = asyncio.create_task(self.refresh(provider))
+            self.refresh_tasks[provider] = task
+        return task
+
+    async def get(self, provider: str) -> dict | None:
+        entry = self.entries.get(provider)
+        if entry is None:
+            await self.schedule_refresh(provider)
+            entry = self.entries.get(provider)
+            return entry["models"] if entry else None
+        if self.is_stale(provider):
+            self.schedule_refresh(provider)
+        return entry["models"]
+
+    def invalidate(self, provider: str):
+        self.entries.pop(provider, None)
+
+    def lookup(self, provider: str, model_id: str) -> dict | None:
+        entry = self.entries.get(provider)
+        if not entry:
+            return None
+        return entry["models"].get(model_id)
+
+model_catalog = ModelCatalog(MODEL_CATALOG_TTL)
+
+def format_context_length(value) -> str:
+    if not value:
+        return ""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return ""
+    return f"{value // 1000}k" if value >= 1000 else str(value)
+
+def get_model_context_tokens() -> int | None:
+    model, _ = get_active_llm_settings()
+    meta = model_catalog.lookup(LLM_PROVIDER, model)
+    if not meta or not meta.get("context_length"):
+        return None
+    try:
+        return int(meta["context_length"])
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(text: str) -> int:
+    # Грубая оценка для кириллицы: ~3 символа на токен
+    return len(text) // 3 + 1
+
+def get_prompt_token_budget(max_tokens: int) -> int | None:
+    context_tokens = get_model_context_tokens()
+    if not context_tokens:
+        return None
+    return max(context_tokens - max_tokens - LLM_CONTEXT_RESERVE_TOKENS, 0)
+
+# ================= КЭШ ОТВЕТОВ ЧАТБОТА =================
+class ResponseCache:
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @staticmethod
+    def make_key(provider: str, model: str, temperature: float, messages: list) -> str:
+        payload = json.dumps(
+            [provider, model, temperature, messages],
+            ensure_ascii=False,
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: str):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def describe(self) -> str:
+        return (
+            f"{len(self.entries)}/{self.max_size}, hit rate {self.hit_rate():.0%} "
+            f"(hits={self.hits} misses={self.misses} bypass={self.bypassed})"
+        )
+
+chat_response_cache = ResponseCache(CHAT_CACHE_MAX_SIZE, CHAT_CACHE_TTL)
+
+async def fetch_chat_response(messages: list, max_tokens: int = None) -> str:
+    if not CHAT_CACHE_ENABLED:
+        return await fetch_llm_messages(messages, max_tokens=max_tokens)
+    model, temperature = get_active_llm_settings()
+    if temperature > CHAT_CACHE_MAX_TEMPERATURE:
+        chat_response_cache.bypassed += 1
+        return await fetch_llm_messages(messages, max_tokens=max_tokens)
+    key = ResponseCache.make_key(LLM_PROVIDER, model, temperature, messages)
+    cached = chat_response_cache.get(key)
+    if cached is not None:
+        log.debug("Chat cache hit key=%s hit_rate=%.2f", key[:12], chat_response_cache.hit_rate())
+        return cached
+    content = await fetch_llm_messages(messages, max_tokens=max_tokens)
+    chat_response_cache.put(key, content)
+    return content
+
+# ================= СТРУКТУРИРОВАННЫЙ ОТВЕТ =================
+class WinnerDecision(BaseModel):
+    user_id: int | str
+    reason: str = Field(min_length=1)
+
+WINNER_RESPONSE_SCHEMA = {
+    "title": "winner",
+    "type": "object",
+    "properties": {
+        "user_id": {"anyOf": [{"type": "integer"}, {"type": "string"}]},
+        "reason": {"type": "string"},
+    },
+    "required": ["user_id", "reason"],
+    "additionalProperties": False,
+}
+REPAIR_SYSTEM_PROMPT = (
+    "Исправь невалидный JSON. Верни только объект вида "
+    "{\"user_id\": 123, \"reason\": \"...\"} без текста вне JSON."
+)
+REPAIR_INPUT_MAX_CHARS = 2000
+WINNER_PARSE_STATS = Counter()
+
+def parse_winner_json(content: str) -> WinnerDecision:
+    try:
+        result = json.loads(content)
+    except json.JSONDecodeError:
+        if "{" in content and "}" in content:
+            start = content.find("{")
+            end = content.rfind("}") + 1
+            result = json.loads(content[start:end])
+        else:
+            raise
+    return WinnerDecision.model_validate(result)
+
+async def parse_winner_with_repair(content: str) -> WinnerDecision:
+    try:
+        decision = parse_winner_json(content)
+        WINNER_PARSE_STATS["ok"] += 1
+        return decision
+    except (ValueError, ValidationError) as e:
+        WINNER_PARSE_STATS["parse_failed"] += 1
+        log.warning("Winner JSON parse failed, trying repair: %s", e)
+
+    # Одна дешевая попытка: отправляем только сломанный ответ, без лога чата
+    repaired = await fetch_llm_messages(
+        [
+            {"role": "system", "content": REPAIR_SYSTEM_PROMPT},
+            {"role": "user", "content": (content or "")[:REPAIR_INPUT_MAX_CHARS]},
+        ],
+        max_tokens=LLM_REPAIR_MAX_TOKENS,
+        response_schema=WINNER_RESPONSE_SCHEMA if LLM_STRUCTURED_OUTPUT else None,
+    )
+    try:
+        decision = parse_winner_json(repaired)
+    except (ValueError, ValidationError):
+        WINNER_PARSE_STATS["repair_failed"] += 1
+        raise
+    WINNER_PARSE_STATS["repair_ok"] += 1
+    log.info("Winner JSON repaired stats=%s", dict(WINNER_PARSE_STATS))
+    return decision
+
+def describe_winner_parse_stats() -> str:
+    return (
+        f"ok={WINNER_PARSE_STATS['ok']} fail={WINNER_PARSE_STATS['parse_failed']} "
+        f"repair_ok={WINNER_PARSE_STATS['repair_ok']} repair_fail={WINNER_PARSE_STATS['repair_failed']}"
+    )
+
+# ================= ЛОКАЛЬНЫЙ СКОРИНГ =================
+CAPS_RE = re.compile(r"[A-ZА-ЯЁ]")
+LETTER_RE = re.compile(r"[^\W\d_]")
+EMOJI_RE = re.compile("[\U0001F300-\U0001FAFF\u2600-\u27BF]")
+PROFANITY_RE = re.compile(
+    r"\b(?:ху[йеёяи]|пизд|бля|еба|ёба|еби|ёб|сук[аи]|мудак|мудил|пидор|пидр|залуп|говн|дерьм|жоп)",
+    re.IGNORECASE,
+)
+SCORE_WEIGHTS = {
+    "count": 0.3,
+    "avg_len": 0.1,
+    "caps": 0.15,
+    "emoji": 0.1,
+    "profanity": 0.2,
+    "chains": 0.15,
+}
+LOCAL_REASON_TEMPLATES = {
+    "count": "Настрочил {count} сообщений и нихуя умного. Поздравляю, ты душный.",
+    "avg_len": "Катал простыни по {avg_len} символов, которые никто не дочитал. Графоман дня.",
+    "caps": "Орал капсом в {caps_pct}% букв. Тише, истеричка.",
+    "emoji": "Вместо слов — {emoji} эмодзи. Словарный запас закончился еще в школе.",
+    "profanity": "Выдал {profanity} матюков за день. Рот с мылом, победитель.",
+    "chains": "Устроил {chains} перепалок и всех задолбал. Любитель поспорить с собой.",
+}
+
+def score_chat_log(chat_log: list, excluded_user_id=None) -> list:
+    """Считает признаки по всем сообщениям за один проход и возвращает рейтинг кандидатов."""
+    stats = {}
+    prev_uid = None
+    prev_prev_uid = None
+    for uid, text, name in chat_log:
+        stripped = text.strip()
+        if len(stripped) < 3 or (excluded_user_id is not None and uid == excluded_user_id):
+            prev_prev_uid, prev_uid = prev_uid, uid
+            continue
+        item = stats.get(uid)
+        if item is None:
+            item = stats[uid] = {
+                "name": name or "Unknown",
+                "count": 0,
+                "chars": 0,
+                "letters": 0,
+                "caps": 0,
+                "emoji": 0,
+                "profanity": 0,
+                "chains": 0,
+            }
+        item["count"] += 1
+        item["chars"] += len(stripped)
+        item["letters"] += len(LETTER_RE.findall(stripped))
+        item["caps"] += len(CAPS_RE.findall(stripped))
+        item["emoji"] += len(EMOJI_RE.findall(stripped))
+        item["profanity"] += len(PROFANITY_RE.findall(stripped))
+        # Цепочка ответов: A -> B -> A
+        if prev_uid is not None and prev_uid != uid and prev_prev_uid == uid:
+            item["chains"] += 1
+        prev_prev_uid, prev_uid = prev_uid, uid
+
+    if not stats:
+        return []
+
+    features = {}
+    for uid, item in stats.items():
+        count = item["count"]
+        features[uid] = {
+            "count": count,
+            "avg_len": item["chars"] / count,
+            "caps": item["caps"] / item["letters"] if item["letters"] else 0.0,
+            "emoji": item["emoji"] / count,
+            "profanity": item["profanity"] / count,
+            "chains": item["chains"],
+        }
+    maxima = {
+        key: max(values[key] for values in features.values()) or 1
+        for key in SCORE_WEIGHTS
+    }
+
+    ranking = []
+    for uid, values in features.items():
+        contributions = {
+            key: weight * values[key] / maxima[key]
+            for key, weight in SCORE_WEIGHTS.items()
+        }
+        dominant = max(contributions.items(), key=lambda x: x[1])[0]
+        ranking.append({
+            "user_id": uid,
+            "name": stats[uid]["name"],
+            "score": sum(contributions.values()),
+            "dominant": dominant,
+            "totals": stats[uid],
+            "features": values,
+        })
+    ranking.sort(key=lambda x: (-x["score"], -x["features"]["count"], x["user_id"]))
+    return ranking
+
+def build_local_reason(entry: dict) -> str:
+    totals = entry["totals"]
+    features = entry["features"]
+    template = LOCAL_REASON_TEMPLATES[entry["dominant"]]
+    return template.format(
+        count=totals["count"],
+        avg_len=int(features["avg_len"]),
+        caps_pct=int(features["caps"] * 100),
+        emoji=totals["emoji"],
+        profanity=totals["profanity"],
+        chains=totals["chains"],
+    )
+
+def prefilter_chat_log(chat_log: list, excluded_user_id=None, top_k: int = 0) -> list:
+    if top_k <= 0:
+        return chat_log
+    ranking = score_chat_log(chat_log, excluded_user_id=excluded_user_id)
+    if len(ranking) <= top_k:
+        return chat_log
+    shortlist = {entry["user_id"] for entry in ranking[:top_k]}
+    log.debug("Prefilter kept %s of %s candidates", len(shortlist), len(ranking))
+    return [row for row in chat_log if row[0] in shortlist]
+
+
+def build_winner_context(chat_log: list, excluded_user_id=None) -> dict:
+    context_lines = []
+    available_ids = set()
+    alias_map = {}
+    alias_names = {}
+    alias_to_user_id = {}
+    alias_order = []
+    alias_counter = 0
+
+    def get_alias(uid: int, safe_name: str) -> str:
+        nonlocal alias_counter
+        if uid not in alias_map:
+            alias_counter += 1
+            alias = f"U{alias_counter}"
+            alias_map[uid] = alias
+            alias_names[alias] = safe_name
+            alias_to_user_id[alias] = uid
             alias_order.append(alias)
         return alias_map[uid]
-    
-    for uid, text, name in chat_log:
+
+    llm_log = prefilter_chat_log(chat_log, excluded_user_id=excluded_user_id, top_k=LLM_PREFILTER_TOP_K)
+    for uid, text, name in llm_log:
         if excluded_user_id is not None and uid == excluded_user_id:
             continue
         if len(text.strip()) < 3:
@@ -530,98 +2352,200 @@ async def choose_winner_via_llm(chat_log: list, excluded_user_id=None) -> dict:
         context_lines.append(f"{alias}: {text}")
         available_ids.add(uid)
 
-    if not context_lines:
-        return {"user_id": 0, "reason": "Все молчат. Скучные натуралы."}
+    prompt_budget = get_prompt_token_budget(LLM_MAX_TOKENS)
+    if prompt_budget:
+        overhead = estimate_tokens(SYSTEM_PROMPT + USER_PROMPT_TEMPLATE) + len(alias_order) * 10
+        total = overhead + sum(estimate_tokens(line) for line in context_lines)
+        dropped = 0
+        # Старые сообщения отбрасываем первыми, чтобы запрос влез в контекст модели
+        while total > prompt_budget and dropped < len(context_lines) - 1:
+            total -= estimate_tokens(context_lines[dropped])
+            dropped += 1
+        if dropped:
+            log.debug("Trimmed %s oldest lines to fit context budget=%s", dropped, prompt_budget)
+            context_lines = context_lines[dropped:]
 
     alias_parts = [
         f"{alias}={alias_to_user_id[alias]}|{alias_names[alias]}"
         for alias in alias_order
     ]
     alias_map_line = "USERS: " + "; ".join(alias_parts)
-    context_text = f"{alias_map_line}\n" + "\n".join(context_lines)
+    return {
+        "chat_log": chat_log,
+        "excluded_user_id": excluded_user_id,
+        "available_ids": available_ids,
+        "alias_to_user_id": alias_to_user_id,
+        "context_text": f"{alias_map_line}\n" + "\n".join(context_lines) if context_lines else "",
+    }
+
+def resolve_winner_decision(decision: WinnerDecision, context: dict) -> dict:
+    result = decision.model_dump()
+    available_ids = context["available_ids"]
+    alias_to_user_id = context["alias_to_user_id"]
+
+    user_id_raw = result.get("user_id", 0)
+    user_id = None
+    if isinstance(user_id_raw, str):
+        raw = user_id_raw.strip()
+        if raw:
+            alias_key = raw.upper()
+            if alias_key in alias_to_user_id:
+                user_id = alias_to_user_id[alias_key]
+            elif raw.isdigit():
+                user_id = int(raw)
+    elif isinstance(user_id_raw, (int, float)):
+        user_id = int(user_id_raw)
+
+    if user_id not in available_ids:
+        result['user_id'] = random.choice(list(available_ids))
+    else:
+        result['user_id'] = user_id
+    return result
+
+def local_winner_decision(context: dict) -> dict:
+    log.warning("Using fallback selection after LLM failure")
+    if context["available_ids"]:
+        ranking = score_chat_log(context["chat_log"], excluded_user_id=context["excluded_user_id"])
+        if ranking:
+            return {"user_id": ranking[0]["user_id"], "reason": build_local_reason(ranking[0])}
+
+    return {"user_id": 0, "reason": "Чат мертв, и вы все мертвы внутри."}
+
+async def choose_winner_via_llm(chat_log: list, excluded_user_id=None, context: dict = None) -> dict:
+    with trace_span("prompt"):
+        if context is None:
+            context = build_winner_context(chat_log, excluded_user_id=excluded_user_id)
+        user_prompt = render_user_prompt(context["context_text"])
+    if not context["context_text"]:
+        return {"user_id": 0, "reason": "Все молчат. Скучные натуралы."}
+
+    try:
+        content = await fetch_llm_content(
+            SYSTEM_PROMPT,
+            user_prompt,
+            response_schema=WINNER_RESPONSE_SCHEMA if LLM_STRUCTURED_OUTPUT else None,
+        )
+        decision = await parse_winner_with_repair(content)
+        return resolve_winner_decision(decision, context)
 
-    user_prompt = render_user_prompt(context_text)
+    except Exception as e:
+        log.exception("LLM API error (%s): %s", LLM_PROVIDER, e)
+        metrics.inc("bot_game_fallback_total", classify_llm_error(e))
+
+    # Fallback
+    return local_winner_decision(context)
+
+# ================= ПАКЕТНЫЙ ВЫБОР =================
+BATCH_SYSTEM_PROMPT = (
+    "В запросе несколько независимых чатов, каждый в своей секции `### C<номер>`. "
+    "Выбери победителя отдельно для каждого чата, только из пользователей этого чата.\n"
+    "Формат ответа — строго валидный JSON, только объект и только двойные кавычки. "
+    "Ключи — идентификаторы чатов, значения — объекты с user_id и reason.\n"
+    "Пример: {\"C1\": {\"user_id\": \"U2\", \"reason\": \"...\"}, \"C2\": {\"user_id\": \"U1\", \"reason\": \"...\"}}\n"
+    "Никакого текста вне JSON.\n"
+)
 
+def build_batch_response_schema(keys: list) -> dict:
+    winner_schema = {key: value for key, value in WINNER_RESPONSE_SCHEMA.items() if key != "title"}
+    return {
+        "title": "winners",
+        "type": "object",
+        "properties": {key: winner_schema for key in keys},
+        "required": list(keys),
+        "additionalProperties": False,
+    }
+
+def get_batch_token_budget() -> int:
+    budget = GAME_BATCH_TOKEN_BUDGET
+    context_tokens = get_model_context_tokens()
+    if context_tokens:
+        budget = min(budget, context_tokens - GAME_BATCH_TOKENS_PER_CHAT * GAME_BATCH_MAX_CHATS - LLM_CONTEXT_RESERVE_TOKENS)
+    return budget
+
+def group_batch_contexts(contexts: list) -> list:
+    budget = get_batch_token_budget() - estimate_tokens(BATCH_SYSTEM_PROMPT + USER_PROMPT_TEMPLATE)
+    groups = []
+    current = []
+    current_tokens = 0
+    for context in sorted(contexts, key=lambda item: len(item["context_text"])):
+        tokens = estimate_tokens(context["context_text"])
+        if current and (current_tokens + tokens > budget or len(current) >= GAME_BATCH_MAX_CHATS):
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(context)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+async def choose_winners_batch(contexts: list) -> dict:
+    """Один запрос на группу чатов. Возвращает peer_id -> решение; упавшие чаты считаются отдельно."""
+    keyed = {f"C{idx}": context for idx, context in enumerate(contexts, start=1)}
+    sections = "\n\n".join(f"### {key}\n{context['context_text']}" for key, context in keyed.items())
+    decisions = {}
     try:
-        content = await fetch_llm_content(SYSTEM_PROMPT, user_prompt)
-        
+        content = await fetch_llm_messages(
+            [
+                {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                {"role": "user", "content": render_user_prompt(sections)},
+            ],
+            max_tokens=GAME_BATCH_TOKENS_PER_CHAT * len(keyed),
+            response_schema=build_batch_response_schema(list(keyed)) if LLM_STRUCTURED_OUTPUT else None,
+        )
         try:
             result = json.loads(content)
         except json.JSONDecodeError:
-            if "{" in content and "}" in content:
-                start = content.find("{")
-                end = content.rfind("}") + 1
-                json_str = content[start:end]
-                result = json.loads(json_str)
-            else:
-                raise
-        
+            start = content.find("{")
+            end = content.rfind("}") + 1
+            result = json.loads(content[start:end]) if start >= 0 and end > start else {}
         if not isinstance(result, dict):
-            raise ValueError("Result is not a dictionary")
-            
-        user_id_raw = result.get("user_id", 0)
-        user_id = None
-        if isinstance(user_id_raw, str):
-            raw = user_id_raw.strip()
-            if raw:
-                alias_key = raw.upper()
-                if alias_key in alias_to_user_id:
-                    user_id = alias_to_user_id[alias_key]
-                elif raw.isdigit():
-                    user_id = int(raw)
-        elif isinstance(user_id_raw, (int, float)):
-            user_id = int(user_id_raw)
-
-        if user_id not in available_ids:
-            result['user_id'] = random.choice(list(available_ids))
-        else:
-            result['user_id'] = user_id
-            
-        return result
-
+            raise ValueError("Batch result is not a dictionary")
+        for key, context in keyed.items():
+            try:
+                decision = WinnerDecision.model_validate(result.get(key))
+            except ValidationError as e:
+                log.warning("Batch result invalid for peer_id=%s key=%s: %s", context["peer_id"], key, e)
+                continue
+            decisions[context["peer_id"]] = resolve_winner_decision(decision, context)
     except Exception as e:
-        log.exception("LLM API error (%s): %s", LLM_PROVIDER, e)
-    
-    # Fallback
-    log.warning("Using fallback selection after LLM failure")
-    if available_ids:
-        user_counts = Counter([uid for uid, _, _ in chat_log if uid in available_ids])
-        if user_counts:
-            most_active = max(user_counts.items(), key=lambda x: x[1])[0]
-            fallback_reasons = [
-                f"Настрочил {user_counts[most_active]} сообщений и нихуя умного. Поздравляю, ты душный.",
-                f"За {user_counts[most_active]} сообщений спама. ИИ сломался от твоей тупости, поэтому победа твоя.",
-                "ИИ отказался работать с таким контингентом, поэтому ты пидор просто по факту существования."
-            ]
-            return {"user_id": most_active, "reason": random.choice(fallback_reasons)}
-    
-    return {"user_id": 0, "reason": "Чат мертв, и вы все мертвы внутри."}
+        log.exception("Batch LLM request failed (%s): %s", LLM_PROVIDER, e)
+
+    for context in contexts:
+        if context["peer_id"] not in decisions:
+            log.info("Batch fallback to single request peer_id=%s", context["peer_id"])
+            metrics.inc("bot_game_batch_fallback_total")
+            decisions[context["peer_id"]] = await choose_winner_via_llm(
+                context["chat_log"],
+                excluded_user_id=context["excluded_user_id"],
+                context=context,
+            )
+    return decisions
 
 # ================= ИГРОВАЯ ЛОГИКА =================
-async def run_game_logic(peer_id: int, reset_if_exists: bool = False):
+async def send_peer_message(peer_id: int, text: str, dedupe_key: str | None = None, priority: int = SEND_PRIORITY_GAME) -> bool:
+    with trace_span("send"):
+        return await vk_send_queue.send(peer_id, text, priority=priority, dedupe_key=dedupe_key)
+
+async def prepare_game_round(peer_id: int, reset_if_exists: bool = False):
     """
-    reset_if_exists=True: Если игра запускается таймером, мы удаляем старый результат и выбираем заново.
-    reset_if_exists=False: (По умолчанию) Если играем вручную, бот скажет 'Уже выбрали'.
+    Проверяет, нужен ли выбор, и собирает лог чата.
+    Возвращает None, если ответ уже отправлен (победитель есть или мало сообщений).
     """
     if ALLOWED_PEER_IDS is not None and peer_id not in ALLOWED_PEER_IDS:
         log.info("Game logic skipped for peer_id=%s (not in allowed list)", peer_id)
-        return
+        return None
     log.debug("Game logic start peer_id=%s reset_if_exists=%s", peer_id, reset_if_exists)
     today = datetime.datetime.now(MSK_TZ).date().isoformat()
+    run_id = f"game:{peer_id}:{today}:{time.time_ns()}"
     last_winner_id = None
     exclude_user_id = None
-    
-    async def send_msg(text):
-        try:
-            await bot.api.messages.send(peer_id=peer_id, message=text, random_id=0)
-        except Exception as e:
-            log.warning("Failed to send message to peer_id=%s: %s", peer_id, e)
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect_db() as db:
         # ЛОГИКА АВТО-СБРОСА
         if reset_if_exists:
             # Если это авто-запуск, сначала удаляем старую запись
-            await db.execute("DELETE FROM daily_game WHERE peer_id = ? AND date = ?", (peer_id, today))
+            await delete_game_result(db, peer_id, today)
             await db.commit()
 
         # Проверяем, есть ли победитель (если сбросили выше, то тут уже ничего не найдет)
@@ -636,8 +2560,12 @@ async def run_game_logic(peer_id: int, reset_if_exists: bool = False):
             except Exception as e:
                 log.warning("Failed to resolve winner name peer_id=%s user_id=%s: %s", peer_id, winner_id, e)
                 name = "Unknown"
-            await send_msg(f"Уже определили!\n{GAME_TITLE}: [id{winner_id}|{name}]\n\n📝 {reason}\n\n(Чтобы сбросить: {CMD_RESET})")
-            return
+            await send_peer_message(
+                peer_id,
+                f"Уже определили!\n{GAME_TITLE}: [id{winner_id}|{name}]\n\n📝 {reason}\n\n(Чтобы сбросить: {CMD_RESET})",
+                dedupe_key=f"{run_id}:exists",
+            )
+            return None
 
         # Сбор сообщений
         cursor = await db.execute(
@@ -662,12 +2590,13 @@ async def run_game_logic(peer_id: int, reset_if_exists: bool = False):
         start_ts = int(day_start.timestamp())
         end_ts = int(day_end.timestamp())
 
-        cursor = await db.execute("""
-            SELECT user_id, text, username 
+        # Сжимаются только длинные строки, поэтому text_z IS NOT NULL уже проходит фильтр длины
+        cursor = await db.execute(f"""
+            SELECT user_id, {text_sql()}, username 
             FROM messages 
             WHERE peer_id = ? 
             AND timestamp >= ? AND timestamp < ?
-            AND LENGTH(TRIM(text)) > 2
+            AND (text_z IS NOT NULL OR LENGTH(TRIM(text)) > 2)
             ORDER BY timestamp DESC 
             LIMIT 200
         """, (peer_id, start_ts, end_ts))
@@ -678,12 +2607,12 @@ async def run_game_logic(peer_id: int, reset_if_exists: bool = False):
         if len(rows) < soft_min_messages:
             remaining = soft_min_messages - len(rows)
             before_count = len(rows)
-            cursor = await db.execute("""
-                SELECT user_id, text, username 
+            cursor = await db.execute(f"""
+                SELECT user_id, {text_sql()}, username 
                 FROM messages 
                 WHERE peer_id = ? 
                 AND timestamp < ?
-                AND LENGTH(TRIM(text)) > 2
+                AND (text_z IS NOT NULL OR LENGTH(TRIM(text)) > 2)
                 ORDER BY timestamp DESC 
                 LIMIT ?
             """, (peer_id, start_ts, remaining))
@@ -697,8 +2626,12 @@ async def run_game_logic(peer_id: int, reset_if_exists: bool = False):
 
         if len(rows) < 3:
             log.info("Not enough messages for peer_id=%s: %s", peer_id, len(rows))
-            await send_msg("Мало сообщений. Пишите больше, чтобы я мог выбрать худшего.")
-            return
+            await send_peer_message(
+                peer_id,
+                "Мало сообщений. Пишите больше, чтобы я мог выбрать худшего.",
+                dedupe_key=f"{run_id}:empty",
+            )
+            return None
 
         chat_log = list(reversed(rows))
         candidate_ids = {uid for uid, text, _ in chat_log if len(text.strip()) >= 3}
@@ -712,21 +2645,26 @@ async def run_game_logic(peer_id: int, reset_if_exists: bool = False):
         len(chat_log),
         exclude_user_id,
     )
-    await send_msg(f"🎲 Изучаю {len(chat_log)} сообщений... Кто же сегодня опозорится?")
-    
-    try:
-        decision = await choose_winner_via_llm(chat_log, excluded_user_id=exclude_user_id)
-        winner_id = decision['user_id']
-        reason = decision.get('reason', 'Нет причины')
-        
-        if winner_id == 0:
-            await send_msg("Ошибка выбора. Попробуйте позже.")
-            return
+    await send_peer_message(
+        peer_id,
+        f"🎲 Изучаю {len(chat_log)} сообщений... Кто же сегодня опозорится?",
+        dedupe_key=f"{run_id}:start",
+    )
+    return {
+        "run_id": run_id,
+        "peer_id": peer_id,
+        "today": today,
+        "chat_log": chat_log,
+        "exclude_user_id": exclude_user_id,
+    }
 
-    except Exception as e:
-        log.exception("Error in game logic for peer_id=%s: %s", peer_id, e)
-        await send_msg("Ошибка при выборе победителя.")
-        return
+async def finish_game_round(game: dict, decision: dict) -> bool:
+    peer_id = game["peer_id"]
+    winner_id = decision['user_id']
+    reason = decision.get('reason', 'Нет причины')
+    if winner_id == 0:
+        await send_peer_message(peer_id, "Ошибка выбора. Попробуйте позже.", dedupe_key=f"{game['run_id']}:error")
+        return False
 
     try:
         user_data = await bot.api.users.get(user_ids=[winner_id])
@@ -736,22 +2674,112 @@ async def run_game_logic(peer_id: int, reset_if_exists: bool = False):
         winner_name = "Жертва"
     log.info("Winner selected peer_id=%s user_id=%s", peer_id, winner_id)
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect_db() as db:
         await db.execute(
             "INSERT INTO daily_game (peer_id, date, winner_id, reason) VALUES (?, ?, ?, ?)", 
-            (peer_id, today, winner_id, reason)
+            (peer_id, game["today"], winner_id, reason)
         )
         await db.execute(
             "INSERT OR REPLACE INTO last_winner (peer_id, winner_id, timestamp) VALUES (?, ?, ?)",
             (peer_id, winner_id, int(datetime.datetime.now(MSK_TZ).timestamp()))
         )
+        record = await update_game_records(db, peer_id, winner_id, game["today"])
         await db.commit()
 
-    await send_msg(
+    records_text = f"\n\n{format_record_announcement(record)}" if GAME_ANNOUNCE_RECORDS else ""
+    return await send_peer_message(
+        peer_id,
         f"🏳 {GAME_TITLE.upper()} ВЫБРАН!\n"
         f"Победитель (сегодня): [id{winner_id}|{winner_name}]\n\n"
-        f"📝 Причина:\n{reason}"
+        f"📝 Причина:\n{reason}{records_text}",
+        dedupe_key=f"{game['run_id']}:winner",
+    )
+
+async def run_game_logic(peer_id: int, reset_if_exists: bool = False) -> bool:
+    """
+    reset_if_exists=True: Если игра запускается таймером, мы удаляем старый результат и выбираем заново.
+    reset_if_exists=False: (По умолчанию) Если играем вручную, бот скажет 'Уже выбрали'.
+    Возвращает False, если победитель не выбран или объявление не доставлено.
+    """
+    with start_trace("game", peer_id=peer_id):
+        game = await prepare_game_round(peer_id, reset_if_exists=reset_if_exists)
+        if game is None:
+            return True
+        try:
+            decision = await choose_winner_via_llm(game["chat_log"], excluded_user_id=game["exclude_user_id"])
+        except Exception as e:
+            log.exception("Error in game logic for peer_id=%s: %s", peer_id, e)
+            await send_peer_message(peer_id, "Ошибка при выборе победителя.", dedupe_key=f"{game['run_id']}:error")
+            return False
+        return await finish_game_round(game, decision)
+
+async def run_game_batch(peer_ids: list) -> dict:
+    """
+    Авто-запуск для нескольких чатов одной минуты: маленькие логи уходят в LLM одним запросом.
+    Возвращает peer_id -> успех, как run_game_logic.
+    """
+    with start_trace("game_batch", chats=len(peer_ids)):
+        return await run_game_batch_rounds(peer_ids)
+
+async def run_game_batch_rounds(peer_ids: list) -> dict:
+    prepared = await asyncio.gather(
+        *(prepare_game_round(peer_id, reset_if_exists=True) for peer_id in peer_ids),
+        return_exceptions=True,
+    )
+    games = {}
+    contexts = []
+    outcomes = {}
+    for peer_id, game in zip(peer_ids, prepared):
+        if isinstance(game, Exception):
+            log.error("Game preparation failed peer_id=%s: %s", peer_id, game)
+            outcomes[peer_id] = False
+            continue
+        if game is None:
+            outcomes[peer_id] = True
+            continue
+        with trace_span("prompt"):
+            context = build_winner_context(game["chat_log"], excluded_user_id=game["exclude_user_id"])
+        context["peer_id"] = peer_id
+        games[peer_id] = game
+        contexts.append(context)
+
+    decisions = {}
+    single_contexts = []
+    batch_contexts = []
+    for context in contexts:
+        if context["context_text"] and estimate_tokens(context["context_text"]) <= get_batch_token_budget():
+            batch_contexts.append(context)
+        else:
+            single_contexts.append(context)
+    groups = group_batch_contexts(batch_contexts)
+    log.info(
+        "Batch game run chats=%s groups=%s single=%s",
+        len(contexts),
+        len(groups),
+        len(single_contexts),
+    )
+    for group in groups:
+        if len(group) == 1:
+            single_contexts.extend(group)
+            continue
+        decisions.update(await choose_winners_batch(group))
+    for context in single_contexts:
+        decisions[context["peer_id"]] = await choose_winner_via_llm(
+            context["chat_log"],
+            excluded_user_id=context["excluded_user_id"],
+            context=context,
+        )
+
+    finished = await asyncio.gather(
+        *(finish_game_round(games[peer_id], decision) for peer_id, decision in decisions.items()),
+        return_exceptions=True,
     )
+    for peer_id, result in zip(decisions, finished):
+        if isinstance(result, Exception):
+            log.error("Game finish failed peer_id=%s: %s", peer_id, result)
+        outcomes[peer_id] = result is True
+    return outcomes
+
 # ================= УТИЛИТЫ =================
 # ================= ЛОГИКА: ЛИДЕРБОРД =================
 def last_day_of_month(year: int, month: int) -> int:
@@ -761,140 +2789,1603 @@ def last_day_of_month(year: int, month: int) -> int:
         next_month = datetime.date(year, month + 1, 1)
     return (next_month - datetime.timedelta(days=1)).day
 
-async def build_leaderboard_text(peer_id: int) -> str:
+async def resolve_user_names(user_ids) -> dict:
+    user_ids = [uid for uid in dict.fromkeys(user_ids) if uid and uid > 0]
+    name_map = {}
+    if not user_ids:
+        return name_map
+    try:
+        for i in range(0, len(user_ids), 1000):
+            chunk = user_ids[i:i + 1000]
+            users = await bot.api.users.get(user_ids=chunk)
+            name_map.update({u.id: f"{u.first_name} {u.last_name}" for u in users})
+    except Exception as e:
+        log.exception("Failed to fetch user names: %s", e)
+    return name_map
+
+async def fetch_leaderboard_page(db, peer_id: int, since: str, until: str, first: int, last: int, requester_id: int | None) -> tuple:
+    """Возвращает строки страницы (и строку запросившего, если она вне страницы) и общее число участников."""
+    cursor = await db.execute(
+        """
+        WITH ranked AS (
+            SELECT winner_id,
+                   COUNT(*) AS wins,
+                   ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC, winner_id ASC) AS place,
+                   COUNT(*) OVER () AS total
+            FROM daily_game
+            WHERE peer_id = ? AND date >= ? AND date < ?
+            GROUP BY winner_id
+        )
+        SELECT winner_id, wins, place, total
+        FROM ranked
+        WHERE place BETWEEN ? AND ? OR winner_id = ?
+        ORDER BY place
+        """,
+        (peer_id, since, until, first, last, requester_id),
+    )
+    rows = await cursor.fetchall()
+    total = rows[0][3] if rows else 0
+    return [(uid, wins, place) for uid, wins, place, _ in rows], total
+
+async def build_leaderboard_text(peer_id: int, page: int = 1, requester_id: int | None = None) -> str:
     today = datetime.datetime.now(MSK_TZ).date()
     month_start = today.replace(day=1)
     if today.month == 12:
         next_month = datetime.date(today.year + 1, 1, 1)
     else:
         next_month = datetime.date(today.year, today.month + 1, 1)
+    first = (page - 1) * LEADERBOARD_TOP_N + 1
+    last = page * LEADERBOARD_TOP_N
 
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute(
-            """
-            SELECT winner_id, COUNT(*) as wins
-            FROM daily_game
-            WHERE peer_id = ? AND date >= ? AND date < ?
-            GROUP BY winner_id
-            ORDER BY wins DESC, winner_id ASC
-            """,
-            (peer_id, month_start.isoformat(), next_month.isoformat())
+    async with connect_db() as db:
+        month_rows, month_total = await fetch_leaderboard_page(
+            db, peer_id, month_start.isoformat(), next_month.isoformat(), first, last, requester_id
         )
-        month_rows = await cursor.fetchall()
-
-        cursor = await db.execute(
-            """
-            SELECT winner_id, COUNT(*) as wins
-            FROM daily_game
-            WHERE peer_id = ?
-            GROUP BY winner_id
-            ORDER BY wins DESC, winner_id ASC
-            """,
-            (peer_id,)
+        all_rows, all_total = await fetch_leaderboard_page(
+            db, peer_id, "", "9999-12-31", first, last, requester_id
         )
-        all_rows = await cursor.fetchall()
 
-    user_ids = list({uid for uid, _ in (month_rows + all_rows)})
-    name_map = {}
-    if user_ids:
-        try:
-            for i in range(0, len(user_ids), 1000):
-                chunk = user_ids[i:i + 1000]
-                users = await bot.api.users.get(user_ids=chunk)
-                name_map.update({u.id: f"{u.first_name} {u.last_name}" for u in users})
-        except Exception as e:
-            log.exception("Failed to fetch leaderboard user names: %s", e)
-            name_map = {}
+    name_map = await resolve_user_names(uid for uid, _, _ in (month_rows + all_rows))
 
-    def format_rows(rows):
-        if not rows:
+    def format_row(uid, wins, place):
+        name = name_map.get(uid, f"id{uid}")
+        medal = {1: "🥇", 2: "🥈", 3: "🥉"}.get(place)
+        prefix = f"{place}. {medal}" if medal else f"{place}."
+        return f"{prefix} [id{uid}|{name}] — ×{wins}"
+
+    def format_rows(rows, total):
+        if not total:
             return "Нет данных."
-        medals = {1: "🥇", 2: "🥈", 3: "🥉"}
-        lines = []
-        for idx, (uid, wins) in enumerate(rows, start=1):
-            name = name_map.get(uid, f"id{uid}")
-            medal = medals.get(idx)
-            prefix = f"{idx}. {medal}" if medal else f"{idx}."
-            lines.append(f"{prefix} [id{uid}|{name}] — ×{wins}")
+        page_rows = [row for row in rows if first <= row[2] <= last]
+        if not page_rows:
+            return f"На этой странице никого нет (всего участников: {total})."
+        lines = [format_row(*row) for row in page_rows]
+        own_rows = [row for row in rows if row[2] < first or row[2] > last]
+        if own_rows:
+            lines.append("…")
+            lines.append(f"Вы: {format_row(*own_rows[0])}")
         return "\n".join(lines)
 
     month_label = today.strftime("%m.%Y")
-    return (
+    text = (
         f"{LEADERBOARD_TITLE}\n\n"
-        f"🗓 За {month_label}:\n{format_rows(month_rows)}\n\n"
-        f"🏆 За все время:\n{format_rows(all_rows)}"
+        f"🗓 За {month_label}:\n{format_rows(month_rows, month_total)}\n\n"
+        f"🏆 За все время:\n{format_rows(all_rows, all_total)}"
     )
+    pages = (max(month_total, all_total) + LEADERBOARD_TOP_N - 1) // LEADERBOARD_TOP_N
+    if pages > 1:
+        text += f"\n\nСтраница {page}/{pages}"
+        if page < pages:
+            text += f", дальше: {CMD_LEADERBOARD} {page + 1}"
+    return text
 
-async def post_leaderboard(peer_id: int, month_key: str):
+async def post_leaderboard(peer_id: int, month_key: str) -> bool:
     if ALLOWED_PEER_IDS is not None and peer_id not in ALLOWED_PEER_IDS:
         log.info("Leaderboard skipped for peer_id=%s (not in allowed list)", peer_id)
-        return
+        return True
     try:
         text = await build_leaderboard_text(peer_id)
-        await bot.api.messages.send(peer_id=peer_id, message=text, random_id=0)
-        log.info("Leaderboard posted peer_id=%s month=%s", peer_id, month_key)
+        delivered = await send_peer_message(peer_id, text, dedupe_key=f"leaderboard:{peer_id}:{month_key}")
     except Exception as e:
         log.exception("Failed to send leaderboard to peer_id=%s: %s", peer_id, e)
-        return
-    async with aiosqlite.connect(DB_NAME) as db:
+        return False
+    if not delivered:
+        log.warning("Leaderboard was not delivered peer_id=%s month=%s", peer_id, month_key)
+        return False
+    log.info("Leaderboard posted peer_id=%s month=%s", peer_id, month_key)
+    async with connect_db() as db:
         await db.execute(
             "UPDATE leaderboard_schedule SET last_run_month = ? WHERE peer_id = ?",
             (month_key, peer_id)
         )
         await db.commit()
+    return True
 
-async def scheduler_loop():
-    log.info("Scheduler started")
-    while True:
-        try:
-            now = datetime.datetime.now(MSK_TZ)
-            now_time = now.strftime("%H:%M")
-            month_key = now.strftime("%Y-%m")
-            last_day = last_day_of_month(now.year, now.month)
-            async with aiosqlite.connect(DB_NAME) as db:
-                if ALLOWED_PEER_IDS is not None:
-                    placeholders = ", ".join(["?"] * len(ALLOWED_PEER_IDS))
-                    cursor = await db.execute(
-                        f"SELECT peer_id FROM schedules WHERE time = ? AND peer_id IN ({placeholders})",
-                        (now_time, *ALLOWED_PEER_IDS)
-                    )
-                else:
-                    cursor = await db.execute("SELECT peer_id FROM schedules WHERE time = ?", (now_time,))
-                rows = await cursor.fetchall()
-                if rows:
-                    log.debug("Triggering scheduled games for time %s: %s chats", now_time, len(rows))
-                    for (peer_id,) in rows:
-                        asyncio.create_task(run_game_logic(peer_id, reset_if_exists=True))
-                if ALLOWED_PEER_IDS is not None:
-                    placeholders = ", ".join(["?"] * len(ALLOWED_PEER_IDS))
-                    cursor = await db.execute(
-                        f"SELECT peer_id, day, time, last_run_month FROM leaderboard_schedule WHERE time = ? AND peer_id IN ({placeholders})",
-                        (now_time, *ALLOWED_PEER_IDS)
-                    )
-                else:
-                    cursor = await db.execute(
-                        "SELECT peer_id, day, time, last_run_month FROM leaderboard_schedule WHERE time = ?",
-                        (now_time,)
-                    )
-                lb_rows = await cursor.fetchall()
-                if lb_rows:
-                    for peer_id, day, _, last_run_month in lb_rows:
-                        try:
-                            day_int = int(day)
-                        except (TypeError, ValueError):
-                            continue
-                        effective_day = min(day_int, last_day)
-                        if now.day != effective_day:
-                            continue
-                        if last_run_month == month_key:
-                            continue
-                        log.debug(
-                            "Triggering leaderboard for peer_id=%s month=%s day=%s",
-                            peer_id,
-                            month_key,
-                            effective_day,
-                        )
-                        asyncio.create_task(post_leaderboard(peer_id, month_key))
+# ================= РЕКОРДЫ ИГРЫ =================
+# game_records обновляется на каждую победу за O(1) в той же транзакции, что и daily_game.
+# Удаление результата (сброс) откатить инкрементально нельзя, поэтому чат пересчитывается из истории.
+def get_previous_date(date_value: str) -> str:
+    return (datetime.date.fromisoformat(date_value) - datetime.timedelta(days=1)).isoformat()
+
+def apply_game_win(record: dict, date_value: str) -> dict:
+    month = date_value[:7]
+    if record.get("last_win_date") == get_previous_date(date_value):
+        record["current_streak"] = record.get("current_streak", 0) + 1
+    else:
+        record["current_streak"] = 1
+    record["new_best_streak"] = record["current_streak"] > record.get("best_streak", 0) and record["current_streak"] > 1
+    record["best_streak"] = max(record.get("best_streak", 0), record["current_streak"])
+    record["total_wins"] = record.get("total_wins", 0) + 1
+    if record.get("current_month") == month:
+        record["current_month_wins"] = record.get("current_month_wins", 0) + 1
+    else:
+        record["current_month"] = month
+        record["current_month_wins"] = 1
+    if record["current_month_wins"] > record.get("best_month_wins", 0):
+        record["best_month"] = month
+        record["best_month_wins"] = record["current_month_wins"]
+    record["last_win_date"] = date_value
+    return record
+
+GAME_RECORD_COLUMNS = (
+    "total_wins",
+    "current_streak",
+    "best_streak",
+    "last_win_date",
+    "current_month",
+    "current_month_wins",
+    "best_month",
+    "best_month_wins",
+)
+
+async def save_game_record(db, peer_id: int, user_id: int, record: dict):
+    values = [record.get(column) for column in GAME_RECORD_COLUMNS]
+    await db.execute(
+        f"""
+        INSERT OR REPLACE INTO game_records (peer_id, user_id, {', '.join(GAME_RECORD_COLUMNS)})
+        VALUES (?, ?, {', '.join(['?'] * len(GAME_RECORD_COLUMNS))})
+        """,
+        (peer_id, user_id, *values),
+    )
+
+async def update_game_records(db, peer_id: int, winner_id: int, date_value: str) -> dict:
+    cursor = await db.execute(
+        f"SELECT {', '.join(GAME_RECORD_COLUMNS)} FROM game_records WHERE peer_id = ? AND user_id = ?",
+        (peer_id, winner_id),
+    )
+    row = await cursor.fetchone()
+    record = dict(zip(GAME_RECORD_COLUMNS, row)) if row else {}
+    apply_game_win(record, date_value)
+    # В чате один победитель в день, так что прерывается максимум одна чужая серия
+    await db.execute(
+        "UPDATE game_records SET current_streak = 0 WHERE peer_id = ? AND user_id != ? AND current_streak > 0",
+        (peer_id, winner_id),
+    )
+    await save_game_record(db, peer_id, winner_id, record)
+    return record
+
+async def rebuild_game_records(db, peer_id: int | None = None) -> int:
+    if peer_id is None:
+        cursor = await db.execute("SELECT peer_id, date, winner_id FROM daily_game ORDER BY peer_id, date")
+    else:
+        cursor = await db.execute("SELECT peer_id, date, winner_id FROM daily_game WHERE peer_id = ? ORDER BY date", (peer_id,))
+    rows = await cursor.fetchall()
+    records = {}
+    last_holder = {}
+    for row_peer_id, date_value, winner_id in rows:
+        if not winner_id:
+            continue
+        previous = last_holder.get(row_peer_id)
+        if previous is not None and previous != winner_id:
+            records[(row_peer_id, previous)]["current_streak"] = 0
+        apply_game_win(records.setdefault((row_peer_id, winner_id), {}), date_value)
+        last_holder[row_peer_id] = winner_id
+    if peer_id is None:
+        await db.execute("DELETE FROM game_records")
+    else:
+        await db.execute("DELETE FROM game_records WHERE peer_id = ?", (peer_id,))
+    for (row_peer_id, user_id), record in records.items():
+        await save_game_record(db, row_peer_id, user_id, record)
+    return len(records)
+
+async def delete_game_result(db, peer_id: int, date_value: str) -> bool:
+    cursor = await db.execute("DELETE FROM daily_game WHERE peer_id = ? AND date = ?", (peer_id, date_value))
+    if cursor.rowcount <= 0:
+        return False
+    await rebuild_game_records(db, peer_id)
+    return True
+
+def format_days_ago(date_value: str) -> str:
+    days = (datetime.datetime.now(MSK_TZ).date() - datetime.date.fromisoformat(date_value)).days
+    if days <= 0:
+        return "сегодня"
+    return f"{days} дн. назад"
+
+def format_record_announcement(record: dict) -> str:
+    lines = [f"🏅 Побед всего: {record['total_wins']}"]
+    if record["current_streak"] > 1:
+        lines.append(f"🔥 Серия: {record['current_streak']} дн. подряд")
+    if record.get("new_best_streak"):
+        lines.append("📏 Новый личный рекорд серии!")
+    return "\n".join(lines)
+
+async def build_records_text(peer_id: int, requester_id: int) -> str:
+    # Серия жива, пока победа была вчера или сегодня: сегодняшняя игра могла еще не пройти
+    yesterday = get_previous_date(datetime.datetime.now(MSK_TZ).date().isoformat())
+    async with connect_db() as db:
+        cursor = await db.execute(
+            """
+            SELECT user_id, current_streak, last_win_date FROM game_records
+            WHERE peer_id = ? AND current_streak > 1 AND last_win_date >= ?
+            ORDER BY current_streak DESC LIMIT 1
+            """,
+            (peer_id, yesterday),
+        )
+        current_row = await cursor.fetchone()
+        cursor = await db.execute(
+            "SELECT user_id, best_streak FROM game_records WHERE peer_id = ? ORDER BY best_streak DESC, last_win_date DESC LIMIT 3",
+            (peer_id,),
+        )
+        streak_rows = await cursor.fetchall()
+        cursor = await db.execute(
+            "SELECT user_id, best_month_wins, best_month FROM game_records WHERE peer_id = ? ORDER BY best_month_wins DESC, best_month DESC LIMIT 3",
+            (peer_id,),
+        )
+        month_rows = await cursor.fetchall()
+        cursor = await db.execute(
+            "SELECT user_id, last_win_date FROM game_records WHERE peer_id = ? ORDER BY last_win_date ASC LIMIT 3",
+            (peer_id,),
+        )
+        drought_rows = await cursor.fetchall()
+        cursor = await db.execute(
+            f"SELECT {', '.join(GAME_RECORD_COLUMNS)} FROM game_records WHERE peer_id = ? AND user_id = ?",
+            (peer_id, requester_id),
+        )
+        own_row = await cursor.fetchone()
+    if not streak_rows:
+        return "🏆 Рекордов пока нет: игра еще не выбрала ни одного победителя."
+    user_ids = [row[0] for row in streak_rows + month_rows + drought_rows]
+    if current_row:
+        user_ids.append(current_row[0])
+    name_map = await resolve_user_names(user_ids + [requester_id])
+
+    def mention(uid):
+        return f"[id{uid}|{name_map.get(uid, f'id{uid}')}]"
+
+    lines = [f"🏆 Рекорды: {GAME_TITLE}", ""]
+    if current_row:
+        lines.append(f"🔥 Текущая серия: {mention(current_row[0])} — {current_row[1]} дн.")
+    lines.append("📏 Самые длинные серии:")
+    lines.extend(f"{index}. {mention(uid)} — {streak} дн." for index, (uid, streak) in enumerate(streak_rows, start=1))
+    lines.append("📅 Больше всего побед за месяц:")
+    lines.extend(
+        f"{index}. {mention(uid)} — ×{wins} ({month[5:]}.{month[:4]})"
+        for index, (uid, wins, month) in enumerate(month_rows, start=1)
+    )
+    lines.append("⏳ Дольше всех без победы:")
+    lines.extend(
+        f"{index}. {mention(uid)} — {format_days_ago(last_win)}"
+        for index, (uid, last_win) in enumerate(drought_rows, start=1)
+    )
+    lines.append("")
+    if own_row:
+        own = dict(zip(GAME_RECORD_COLUMNS, own_row))
+        lines.append(
+            f"👤 {mention(requester_id)}: побед {own['total_wins']}, лучшая серия {own['best_streak']} дн., "
+            f"последняя победа {format_days_ago(own['last_win_date'])}"
+        )
+    else:
+        lines.append(f"👤 {mention(requester_id)}: побед пока нет")
+    return "\n".join(lines)
+
+# ================= СТАТИСТИКА =================
+# Все ответы /стата строятся по daily_user_stats: одна строка на пользователя в день,
+# поэтому время ответа не зависит от объема messages.
+STATS_PERIODS = {
+    "день": "за сегодня",
+    "месяц": "за месяц",
+    "всё": "за все время",
+}
+
+def parse_stats_period(value: str):
+    value = value.replace("все", "всё")
+    return value if value in STATS_PERIODS else None
+
+def get_stats_since(period: str) -> str:
+    today = datetime.datetime.now(MSK_TZ).date()
+    if period == "день":
+        return today.isoformat()
+    if period == "месяц":
+        return today.replace(day=1).isoformat()
+    return ""
+
+def get_message_time_parts(timestamp: int):
+    moment = datetime.datetime.fromtimestamp(timestamp, MSK_TZ)
+    return moment.date().isoformat(), moment.hour
+
+async def record_user_activity(db, peer_id: int, user_id: int, text: str, timestamp: int):
+    date, hour = get_message_time_parts(timestamp)
+    await db.execute(
+        """
+        INSERT INTO daily_user_stats (peer_id, date, user_id, message_count, char_count, active_hours)
+        VALUES (?, ?, ?, 1, ?, ?)
+        ON CONFLICT (peer_id, date, user_id) DO UPDATE SET
+            message_count = message_count + 1,
+            char_count = char_count + excluded.char_count,
+            active_hours = active_hours | excluded.active_hours
+        """,
+        (peer_id, date, user_id, len(text), 1 << hour),
+    )
+
+async def record_user_activity_batch(db, peer_id: int, rows: list):
+    """То же, что record_user_activity, но для пачки (user_id, text, timestamp) одним executemany."""
+    totals = {}
+    for user_id, text, timestamp in rows:
+        date, hour = get_message_time_parts(timestamp)
+        entry = totals.setdefault((date, user_id), [0, 0, 0])
+        entry[0] += 1
+        entry[1] += len(text)
+        entry[2] |= 1 << hour
+    await db.executemany(
+        """
+        INSERT INTO daily_user_stats (peer_id, date, user_id, message_count, char_count, active_hours)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (peer_id, date, user_id) DO UPDATE SET
+            message_count = message_count + excluded.message_count,
+            char_count = char_count + excluded.char_count,
+            active_hours = active_hours | excluded.active_hours
+        """,
+        [(peer_id, date, user_id, *entry) for (date, user_id), entry in totals.items()],
+    )
+
+def format_active_hours(hour_days: list, limit: int = 3) -> str:
+    ranked = sorted((count, -hour) for hour, count in enumerate(hour_days) if count)
+    top = [-hour for _, hour in reversed(ranked[-limit:])]
+    if not top:
+        return "нет данных"
+    return ", ".join(f"{hour:02d}:00" for hour in top)
+
+async def build_chat_stats_text(peer_id: int, period: str) -> str:
+    since = get_stats_since(period)
+    async with connect_db() as db:
+        cursor = await db.execute(
+            """
+            SELECT COALESCE(SUM(message_count), 0), COALESCE(SUM(char_count), 0), COUNT(DISTINCT user_id)
+            FROM daily_user_stats
+            WHERE peer_id = ? AND date >= ?
+            """,
+            (peer_id, since),
+        )
+        total_messages, total_chars, total_users = await cursor.fetchone()
+        cursor = await db.execute(
+            """
+            SELECT user_id, SUM(message_count) AS messages, SUM(char_count)
+            FROM daily_user_stats
+            WHERE peer_id = ? AND date >= ?
+            GROUP BY user_id
+            ORDER BY messages DESC, user_id
+            LIMIT ?
+            """,
+            (peer_id, since, STATS_TOP_LIMIT),
+        )
+        rows = await cursor.fetchall()
+    if not total_messages:
+        return f"📈 Статистика {STATS_PERIODS[period]}: сообщений пока нет."
+    name_map = await resolve_user_names(uid for uid, _, _ in rows)
+    lines = [
+        f"📈 Статистика чата {STATS_PERIODS[period]}",
+        f"Сообщений: {total_messages}, символов: {total_chars}, участников: {total_users}",
+        "",
+        "🗣 Больше всех пишут:",
+    ]
+    for index, (uid, messages, chars) in enumerate(rows, start=1):
+        name = name_map.get(uid, f"id{uid}")
+        lines.append(f"{index}. [id{uid}|{name}] — {messages} сообщ., {chars} симв.")
+    return "\n".join(lines)
+
+async def build_user_stats_text(peer_id: int, user_id: int, period: str) -> str:
+    since = get_stats_since(period)
+    async with connect_db() as db:
+        cursor = await db.execute(
+            """
+            SELECT message_count, char_count, active_hours
+            FROM daily_user_stats
+            WHERE peer_id = ? AND date >= ? AND user_id = ?
+            """,
+            (peer_id, since, user_id),
+        )
+        days = await cursor.fetchall()
+        messages = sum(row[0] for row in days)
+        rank = None
+        if messages:
+            cursor = await db.execute(
+                """
+                SELECT COUNT(*) + 1 FROM (
+                    SELECT SUM(message_count) AS messages
+                    FROM daily_user_stats
+                    WHERE peer_id = ? AND date >= ?
+                    GROUP BY user_id
+                    HAVING messages > ?
+                )
+                """,
+                (peer_id, since, messages),
+            )
+            rank = (await cursor.fetchone())[0]
+    name = (await resolve_user_names([user_id])).get(user_id, f"id{user_id}")
+    header = f"📈 [id{user_id}|{name}] {STATS_PERIODS[period]}"
+    if not messages:
+        return f"{header}: сообщений нет."
+    chars = sum(row[1] for row in days)
+    hour_days = [0] * 24
+    for _, _, active_hours in days:
+        for hour in range(24):
+            if active_hours & (1 << hour):
+                hour_days[hour] += 1
+    return (
+        f"{header}\n"
+        f"Сообщений: {messages} (место в чате: {rank})\n"
+        f"Символов: {chars}, в среднем {chars // messages} на сообщение\n"
+        f"Активных дней: {len(days)}\n"
+        f"Любимые часы (МСК): {format_active_hours(hour_days)}"
+    )
+
+# ================= ХРАНЕНИЕ ДАННЫХ =================
+# Старые строки выгружаются в ARCHIVE_DIR/<таблица>/<дата>.jsonl.gz и удаляются пачками,
+# чтобы запись новых сообщений не ждала одну длинную транзакцию.
+RETENTION_TABLES = {
+    "messages": ("user_id", "peer_id", "text", "timestamp", "username"),
+    "bot_dialogs": ("id", "peer_id", "user_id", "role", "text", "timestamp"),
+}
+last_retention_result = None
+
+def get_retention_days(table: str) -> int:
+    if table == "messages":
+        return RETENTION_MESSAGES_DAYS
+    return RETENTION_BOT_DIALOGS_DAYS
+
+def is_retention_enabled() -> bool:
+    return any(get_retention_days(table) > 0 for table in RETENTION_TABLES)
+
+def write_archive_rows(table: str, rows: list):
+    partitions = {}
+    for row in rows:
+        day = datetime.datetime.fromtimestamp(row["timestamp"] or 0, MSK_TZ).date().isoformat()
+        partitions.setdefault(day, []).append(row)
+    table_dir = os.path.join(ARCHIVE_DIR, table)
+    os.makedirs(table_dir, exist_ok=True)
+    for day, day_rows in partitions.items():
+        # gzip допускает дописывание новых членов в конец файла
+        with gzip.open(os.path.join(table_dir, f"{day}.jsonl.gz"), "at", encoding="utf-8") as archive:
+            for row in day_rows:
+                archive.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+async def prune_table(table: str, days: int) -> int:
+    columns = RETENTION_TABLES[table]
+    select = ", ".join(text_sql() if column == "text" else column for column in columns)
+    cutoff = int(time.time()) - days * 86400
+    removed = 0
+    while True:
+        async with connect_db() as db:
+            cursor = await db.execute(
+                f"SELECT rowid, {select} FROM {table} WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+                (cutoff, RETENTION_BATCH_SIZE),
+            )
+            rows = await cursor.fetchall()
+            if not rows:
+                break
+            if ARCHIVE_ENABLED:
+                await asyncio.to_thread(
+                    write_archive_rows,
+                    table,
+                    [dict(zip(columns, row[1:])) for row in rows],
+                )
+            rowids = [row[0] for row in rows]
+            placeholders = ", ".join(["?"] * len(rowids))
+            if table == "messages":
+                await delete_compressed_from_search_index(db, rowids)
+            await db.execute(f"DELETE FROM {table} WHERE rowid IN ({placeholders})", rowids)
+            await db.commit()
+        removed += len(rows)
+        if len(rows) < RETENTION_BATCH_SIZE:
+            break
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+    return removed
+
+async def reclaim_free_pages() -> int:
+    freed = 0
+    while True:
+        async with connect_db() as db:
+            cursor = await db.execute("PRAGMA auto_vacuum")
+            if (await cursor.fetchone())[0] != 2:
+                break
+            cursor = await db.execute("PRAGMA freelist_count")
+            free_pages = (await cursor.fetchone())[0]
+            if not free_pages:
+                break
+            # execute() делает один шаг прагмы (одну страницу), executescript() доводит ее до конца
+            await db.executescript(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES});")
+        freed += min(free_pages, RETENTION_VACUUM_PAGES)
+        if free_pages <= RETENTION_VACUUM_PAGES:
+            break
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+    if freed:
+        # В WAL файл базы укорачивается только при переносе страниц из журнала
+        async with connect_db() as db:
+            await db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    return freed
+
+async def run_retention() -> dict:
+    global last_retention_result
+    started = time.perf_counter()
+    removed = {}
+    for table in RETENTION_TABLES:
+        days = get_retention_days(table)
+        if days <= 0:
+            continue
+        removed[table] = await prune_table(table, days)
+    freed_pages = await reclaim_free_pages() if removed else 0
+    last_retention_result = {
+        "at": datetime.datetime.now(MSK_TZ).strftime("%Y-%m-%d %H:%M"),
+        "removed": removed,
+        "freed_pages": freed_pages,
+    }
+    log.info(
+        "Retention finished removed=%s freed_pages=%s duration=%.1fs",
+        removed,
+        freed_pages,
+        time.perf_counter() - started,
+    )
+    return last_retention_result
+
+def format_bytes(size: int) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+async def collect_table_sizes() -> list:
+    async with connect_db() as db:
+        cursor = await db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")
+        tables = [row[0] for row in await cursor.fetchall()]
+        sizes = {}
+        try:
+            cursor = await db.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")
+            sizes = dict(await cursor.fetchall())
+        except aiosqlite.Error:
+            # dbstat есть не во всех сборках SQLite — тогда показываем только строки
+            pass
+        result = []
+        for table in tables:
+            cursor = await db.execute(f"SELECT COUNT(*) FROM {table}")
+            count = (await cursor.fetchone())[0]
+            result.append({"table": table, "rows": count, "bytes": sizes.get(table)})
+    return result
+
+# ================= ОБСЛУЖИВАНИЕ БД =================
+# Раз в час в тихие часы ставится задача обслуживания. Каждый шаг выполняется, только если
+# подошел его интервал, поэтому прерванный проход просто продолжится в следующем часе.
+MAINTENANCE_STEPS = (
+    ("checkpoint", 3600),
+    ("optimize", 86400),
+    ("compress", 3600),
+    ("vacuum", 86400),
+    ("analyze", MAINTENANCE_ANALYZE_DAYS * 86400),
+)
+
+def parse_maintenance_window(value: str):
+    try:
+        start, end = value.split("-", 1)
+        start_time = datetime.datetime.strptime(start.strip(), "%H:%M").time()
+        end_time = datetime.datetime.strptime(end.strip(), "%H:%M").time()
+    except ValueError:
+        log.warning("MAINTENANCE_WINDOW is not valid: %s", value)
+        return None
+    return start_time, end_time
+
+MAINTENANCE_WINDOW_RANGE = parse_maintenance_window(MAINTENANCE_WINDOW)
+
+def is_quiet_time(now: datetime.datetime) -> bool:
+    if MAINTENANCE_WINDOW_RANGE is None:
+        return False
+    start, end = MAINTENANCE_WINDOW_RANGE
+    current = now.time()
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+async def load_timer_minutes() -> set:
+    async with connect_db() as db:
+        cursor = await db.execute("SELECT time FROM schedules UNION SELECT time FROM leaderboard_schedule")
+        return {row[0] for row in await cursor.fetchall() if row[0]}
+
+def is_timer_minute(now: datetime.datetime, timer_minutes: set) -> bool:
+    # Свою минуту и соседние оставляем таймерам: игра тоже пишет в базу
+    for offset in (-1, 0, 1):
+        minute = (now + datetime.timedelta(minutes=offset)).strftime("%H:%M")
+        if minute in timer_minutes:
+            return True
+    return False
+
+async def probe_write_latency() -> float:
+    started = time.perf_counter()
+    async with connect_db() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO maintenance_state (step, last_run_at, duration_ms, result) VALUES ('probe', ?, 0, 'ok')",
+            (time.time(),),
+        )
+        await db.commit()
+    return (time.perf_counter() - started) * 1000
+
+async def should_pause_maintenance(timer_minutes: set) -> str | None:
+    now = datetime.datetime.now(MSK_TZ)
+    if not is_quiet_time(now):
+        return "window closed"
+    if is_timer_minute(now, timer_minutes):
+        return "timer minute"
+    latency_ms = await probe_write_latency()
+    if latency_ms > MAINTENANCE_MAX_WRITE_MS:
+        return f"write latency {latency_ms:.0f}ms"
+    return None
+
+async def run_maintenance_step(step: str, timer_minutes: set) -> str:
+    if step == "compress":
+        if not TEXT_COMPRESSION_ENABLED:
+            return "disabled"
+        result = await run_text_compression(lambda: should_pause_maintenance(timer_minutes))
+        return " ".join(f"{key}={value}" for key, value in result.items())
+    if step == "vacuum":
+        freed = await reclaim_free_pages()
+        return f"freed {freed} pages"
+    async with connect_db() as db:
+        if step == "checkpoint":
+            cursor = await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            busy, wal_pages, moved_pages = await cursor.fetchone()
+            return f"busy={busy} wal={wal_pages} moved={moved_pages}"
+        if step == "optimize":
+            await db.executescript("PRAGMA optimize;")
+            return "ok"
+        if step == "analyze":
+            if MAINTENANCE_ANALYSIS_LIMIT:
+                await db.execute(f"PRAGMA analysis_limit={MAINTENANCE_ANALYSIS_LIMIT}")
+            await db.execute("ANALYZE")
+            await db.commit()
+            return "ok"
+    raise ValueError(f"unknown maintenance step {step}")
+
+async def run_maintenance() -> list:
+    async with connect_db() as db:
+        cursor = await db.execute("SELECT step, last_run_at FROM maintenance_state")
+        last_runs = dict(await cursor.fetchall())
+    timer_minutes = await load_timer_minutes()
+    done = []
+    for step, interval in MAINTENANCE_STEPS:
+        if time.time() - (last_runs.get(step) or 0) < interval:
+            continue
+        reason = await should_pause_maintenance(timer_minutes)
+        if reason:
+            log.info("Maintenance paused before step=%s: %s", step, reason)
+            break
+        started = time.perf_counter()
+        result = await run_maintenance_step(step, timer_minutes)
+        duration_ms = int((time.perf_counter() - started) * 1000)
+        async with connect_db() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO maintenance_state (step, last_run_at, duration_ms, result) VALUES (?, ?, ?, ?)",
+                (step, time.time(), duration_ms, result),
+            )
+            await db.commit()
+        log.info("Maintenance step=%s finished in %sms: %s", step, duration_ms, result)
+        done.append(step)
+    return done
+
+async def collect_storage_stats() -> dict:
+    async with connect_db() as db:
+        stats = {}
+        for pragma in ("page_size", "page_count", "freelist_count", "auto_vacuum"):
+            cursor = await db.execute(f"PRAGMA {pragma}")
+            stats[pragma] = (await cursor.fetchone())[0]
+        cursor = await db.execute("SELECT step, last_run_at, duration_ms, result FROM maintenance_state WHERE step != 'probe' ORDER BY step")
+        stats["steps"] = await cursor.fetchall()
+    wal_path = f"{DB_NAME}-wal"
+    stats["wal_bytes"] = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    return stats
+
+# ================= СЖАТИЕ ТЕКСТА =================
+# Старые сообщения хранятся в text_z как zstd со словарем, обученным на текстах этой же базы:
+# короткие реплики без словаря почти не сжимаются. Сжатие идет шагом обслуживания в тихие
+# часы; text у сжатой строки становится NULL, а чтение идет через text_sql().
+TEXT_COMPRESS_TABLES = ("messages", "bot_dialogs")
+TEXT_DICT_MIN_SAMPLES = 500
+text_dicts = {}
+text_decoders = threading.local()
+text_compress_cursor = {}
+# Распаковка вызывается из потоков соединений aiosqlite, поэтому счетчики приблизительные
+text_decode_stats = Counter()
+
+def text_sql(prefix: str = "") -> str:
+    return f"COALESCE({prefix}text, text_unzip({prefix}text_z, {prefix}dict_id))"
+
+def load_text_dict(dict_id: int):
+    text_dict = text_dicts.get(dict_id)
+    if text_dict is None:
+        # Словарь мог обучить другой процесс кластера: читаем его отдельным соединением
+        connection = sqlite3.connect(DB_NAME)
+        try:
+            row = connection.execute("SELECT dict FROM text_dicts WHERE id = ?", (dict_id,)).fetchone()
+        finally:
+            connection.close()
+        if row is None:
+            raise ValueError(f"text dictionary {dict_id} not found")
+        text_dict = zstandard.ZstdCompressionDict(row[0])
+        text_dicts[dict_id] = text_dict
+    return text_dict
+
+def text_unzip(blob, dict_id):
+    if blob is None:
+        return None
+    if zstandard is None:
+        raise RuntimeError("zstandard is required to read compressed text")
+    started = time.perf_counter()
+    # Декомпрессор zstandard нельзя делить между потоками — у каждого потока свой
+    decoders = getattr(text_decoders, "by_dict", None)
+    if decoders is None:
+        decoders = text_decoders.by_dict = {}
+    decoder = decoders.get(dict_id)
+    if decoder is None:
+        decoder = zstandard.ZstdDecompressor(dict_data=load_text_dict(dict_id))
+        decoders[dict_id] = decoder
+    text = decoder.decompress(blob).decode("utf-8")
+    text_decode_stats["count"] += 1
+    text_decode_stats["ns"] += int((time.perf_counter() - started) * 1e9)
+    return text
+
+def train_text_dict(samples: list) -> bytes:
+    encoded = [sample.encode("utf-8") for sample in samples]
+    return zstandard.train_dictionary(TEXT_DICT_SIZE, encoded, level=TEXT_COMPRESS_LEVEL).as_bytes()
+
+async def ensure_text_dict() -> int | None:
+    async with connect_db() as db:
+        cursor = await db.execute("SELECT MAX(id) FROM text_dicts")
+        dict_id = (await cursor.fetchone())[0]
+        if dict_id is not None:
+            return dict_id
+        cursor = await db.execute(
+            """
+            SELECT text FROM (
+                SELECT text FROM messages WHERE text IS NOT NULL AND length(text) >= ?
+                UNION ALL
+                SELECT text FROM bot_dialogs WHERE text IS NOT NULL AND length(text) >= ?
+            )
+            ORDER BY random()
+            LIMIT ?
+            """,
+            (TEXT_COMPRESS_MIN_CHARS, TEXT_COMPRESS_MIN_CHARS, TEXT_DICT_SAMPLES),
+        )
+        samples = [row[0] for row in await cursor.fetchall()]
+    if len(samples) < TEXT_DICT_MIN_SAMPLES:
+        log.info("Not enough text to train compression dictionary: %s samples", len(samples))
+        return None
+    started = time.perf_counter()
+    try:
+        dict_data = await asyncio.to_thread(train_text_dict, samples)
+    except zstandard.ZstdError as e:
+        log.warning("Compression dictionary training failed: %s", e)
+        return None
+    async with connect_db() as db:
+        cursor = await db.execute(
+            "INSERT INTO text_dicts (created_at, dict, samples) VALUES (?, ?, ?)",
+            (time.time(), dict_data, len(samples)),
+        )
+        await db.commit()
+        dict_id = cursor.lastrowid
+    log.info(
+        "Compression dictionary id=%s trained on %s samples size=%s in %.1fs",
+        dict_id,
+        len(samples),
+        len(dict_data),
+        time.perf_counter() - started,
+    )
+    return dict_id
+
+def compress_text_rows(rows: list, dict_id: int) -> list:
+    compressor = zstandard.ZstdCompressor(level=TEXT_COMPRESS_LEVEL, dict_data=load_text_dict(dict_id))
+    result = []
+    for rowid, text in rows:
+        raw = text.encode("utf-8")
+        blob = compressor.compress(raw)
+        # Несжимаемые строки оставляем как есть: распаковка стоила бы больше, чем экономия
+        if len(blob) < len(raw):
+            result.append((blob, dict_id, rowid, len(raw), len(blob)))
+    return result
+
+async def compress_table_batch(table: str, dict_id: int, cutoff: int) -> tuple:
+    last_rowid = text_compress_cursor.get(table, 0)
+    async with connect_db() as db:
+        cursor = await db.execute(
+            f"""
+            SELECT rowid, text FROM {table}
+            WHERE rowid > ? AND text IS NOT NULL AND timestamp < ? AND length(text) >= ?
+            ORDER BY rowid
+            LIMIT ?
+            """,
+            (last_rowid, cutoff, TEXT_COMPRESS_MIN_CHARS, TEXT_COMPRESS_BATCH_SIZE),
+        )
+        rows = await cursor.fetchall()
+        if not rows:
+            return 0, 0, True
+        text_compress_cursor[table] = rows[-1][0]
+        updates = await asyncio.to_thread(compress_text_rows, rows, dict_id)
+        if updates:
+            await db.executemany(
+                f"UPDATE {table} SET text = NULL, text_z = ?, dict_id = ? WHERE rowid = ? AND text IS NOT NULL",
+                [update[:3] for update in updates],
+            )
+            await db.execute(
+                "UPDATE text_dicts SET rows = rows + ?, raw_bytes = raw_bytes + ?, compressed_bytes = compressed_bytes + ? WHERE id = ?",
+                (len(updates), sum(update[3] for update in updates), sum(update[4] for update in updates), dict_id),
+            )
+            await db.commit()
+    return len(rows), len(updates), len(rows) < TEXT_COMPRESS_BATCH_SIZE
+
+async def run_text_compression(should_pause=None) -> dict:
+    dict_id = await ensure_text_dict()
+    if dict_id is None:
+        return {"dict": "none"}
+    cutoff = int(time.time()) - TEXT_COMPRESS_AFTER_DAYS * 86400
+    result = {"scanned": 0, "compressed": 0}
+    for table in TEXT_COMPRESS_TABLES:
+        while result["scanned"] < TEXT_COMPRESS_MAX_ROWS:
+            scanned, compressed, finished = await compress_table_batch(table, dict_id, cutoff)
+            result["scanned"] += scanned
+            result["compressed"] += compressed
+            if finished:
+                # Следующий проход начнет таблицу сначала: за это время состарились новые строки
+                text_compress_cursor.pop(table, None)
+                break
+            reason = await should_pause() if should_pause else None
+            if reason:
+                log.info("Text compression paused: %s", reason)
+                return result
+            await asyncio.sleep(RETENTION_BATCH_PAUSE)
+    return result
+
+async def collect_compression_stats() -> dict:
+    async with connect_db() as db:
+        cursor = await db.execute("SELECT COUNT(*), MAX(id), SUM(rows), SUM(raw_bytes), SUM(compressed_bytes) FROM text_dicts")
+        dict_count, dict_id, rows, raw_bytes, compressed_bytes = await cursor.fetchone()
+    decoded = text_decode_stats["count"]
+    return {
+        "dicts": dict_count,
+        "dict_id": dict_id,
+        "rows": rows or 0,
+        "raw_bytes": raw_bytes or 0,
+        "compressed_bytes": compressed_bytes or 0,
+        "decoded": decoded,
+        "decode_us": text_decode_stats["ns"] / decoded / 1000 if decoded else None,
+    }
+
+def format_compression_stats(stats: dict) -> str:
+    if not stats["rows"]:
+        if not TEXT_COMPRESSION_ENABLED:
+            return "Сжатие текста: выключено"
+        if not stats["dicts"]:
+            return "Сжатие текста: словарь еще не обучен"
+        return "Сжатие текста: сжатых строк пока нет"
+    ratio = stats["raw_bytes"] / stats["compressed_bytes"] if stats["compressed_bytes"] else 0
+    line = (
+        f"Сжатие текста: {stats['rows']} строк, {format_bytes(stats['raw_bytes'])} → "
+        f"{format_bytes(stats['compressed_bytes'])} (×{ratio:.1f}), словарь #{stats['dict_id']}"
+    )
+    if stats["decode_us"] is not None:
+        line += f"; распаковка {stats['decode_us']:.1f} мкс × {stats['decoded']}"
+    return line
+
+# ================= ПОИСК =================
+SEARCH_TERM_RE = re.compile(r"\w+\*?")
+
+def build_search_query(peer_id: int, query: str) -> str | None:
+    # Каждое слово берем в кавычки: операторы FTS5 из пользовательского ввода не выполняются
+    terms = []
+    for term in SEARCH_TERM_RE.findall(query.lower()):
+        prefix = term.endswith("*")
+        word = term.rstrip("*")
+        if word:
+            terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    if not terms:
+        return None
+    return f'peer_id : "{peer_id}" AND text : ({" ".join(terms)})'
+
+async def search_messages(peer_id: int, query: str, page: int = 1) -> dict | None:
+    # Свежие сначала: сортировка по rowid идет по индексу, а bm25 пришлось бы считать для всех совпадений
+    match = build_search_query(peer_id, query)
+    if match is None:
+        return None
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    async with connect_db() as db:
+        cursor = await db.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?", (match,))
+        total = (await cursor.fetchone())[0]
+        cursor = await db.execute(
+            f"""
+            SELECT m.user_id, m.username, m.timestamp,
+                   snippet(messages_fts, 0, '«', '»', '…', {SEARCH_SNIPPET_TOKENS})
+            FROM messages_fts
+            JOIN messages m ON m.rowid = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ? OFFSET ?
+            """,
+            (match, SEARCH_PAGE_SIZE, offset),
+        )
+        rows = await cursor.fetchall()
+    return {"total": total, "page": page, "rows": rows}
+
+def format_search_results(query: str, result: dict) -> str:
+    total = result["total"]
+    if not total:
+        return f"🔎 По запросу «{query}» ничего не найдено."
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    if not result["rows"]:
+        return f"🔎 Страница {result['page']} пуста, всего страниц: {pages}."
+    lines = [f"🔎 «{query}»: {total} совпадений, страница {result['page']}/{pages}", ""]
+    start = (result["page"] - 1) * SEARCH_PAGE_SIZE
+    for index, (user_id, username, timestamp, snippet) in enumerate(result["rows"], start=start + 1):
+        date_label = datetime.datetime.fromtimestamp(timestamp or 0, MSK_TZ).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"{index}. [id{user_id}|{username or 'Unknown'}], {date_label}")
+        lines.append(snippet)
+    if result["page"] < pages:
+        lines.append("")
+        lines.append(f"Дальше: `{CMD_SEARCH} {result['page'] + 1} {query}`")
+    return "\n".join(lines)
+
+# ================= БЭКФИЛЛ ИСТОРИИ =================
+# Догружает историю чата через messages.getHistory от новых сообщений к старым.
+# Позиция (start_cmid) сохраняется в backfill_state после каждой страницы, поэтому
+# прерванный бэкфилл продолжается с того же места. Одна задача обрабатывает
+# BACKFILL_PAGES_PER_JOB страниц и ставит продолжение, чтобы не держать воркер очереди.
+async def fetch_history_page(peer_id: int, start_cmid: int | None) -> dict:
+    params = {"peer_id": peer_id, "count": BACKFILL_PAGE_SIZE, "extended": 1}
+    if start_cmid is not None:
+        # offset=1 пропускает само сообщение start_cmid, оно уже обработано
+        params.update({"start_cmid": start_cmid, "offset": 1})
+    response = await bot.api.request("messages.getHistory", params)
+    return response.get("response", response)
+
+async def store_history_items(peer_id: int, items: list, names: dict) -> int:
+    rows = []
+    for item in items:
+        user_id = item.get("from_id") or 0
+        text = item.get("text") or ""
+        cmid = item.get("conversation_message_id")
+        if user_id <= 0 or not text or text.startswith("/") or not cmid:
+            continue
+        rows.append((user_id, text, item.get("date") or 0, cmid))
+    if not rows:
+        return 0
+    cmids = [row[3] for row in rows]
+    timestamps = [row[2] for row in rows]
+    async with connect_db() as db:
+        # IMMEDIATE: между проверкой и вставкой logger не должен успеть записать те же сообщения
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute(
+            "SELECT conversation_message_id FROM messages WHERE peer_id = ? AND conversation_message_id BETWEEN ? AND ?",
+            (peer_id, min(cmids), max(cmids)),
+        )
+        known = {row[0] for row in await cursor.fetchall()}
+        cursor = await db.execute(
+            "SELECT COUNT(*) FROM messages WHERE timestamp BETWEEN ? AND ? AND peer_id = ? AND conversation_message_id IS NULL",
+            (min(timestamps), max(timestamps), peer_id),
+        )
+        has_legacy = (await cursor.fetchone())[0] > 0
+        new_rows = []
+        for user_id, text, timestamp, cmid in rows:
+            if cmid in known:
+                continue
+            if has_legacy:
+                # Строки, сохраненные до появления conversation_message_id, сопоставляем по автору, времени и тексту
+                cursor = await db.execute(
+                    f"""
+                    UPDATE messages SET conversation_message_id = ?
+                    WHERE rowid = (
+                        SELECT rowid FROM messages
+                        WHERE timestamp = ? AND peer_id = ? AND user_id = ? AND conversation_message_id IS NULL
+                        AND {text_sql()} = ?
+                        LIMIT 1
+                    )
+                    """,
+                    (cmid, timestamp, peer_id, user_id, text),
+                )
+                if cursor.rowcount > 0:
+                    continue
+            new_rows.append((user_id, peer_id, text, timestamp, names.get(user_id, "Unknown"), cmid))
+        await db.executemany(
+            "INSERT OR IGNORE INTO messages (user_id, peer_id, text, timestamp, username, conversation_message_id) VALUES (?, ?, ?, ?, ?, ?)",
+            new_rows,
+        )
+        await record_user_activity_batch(db, peer_id, [(row[0], row[2], row[3]) for row in new_rows])
+        await db.commit()
+    return len(new_rows)
+
+async def load_backfill_state(peer_id: int) -> dict | None:
+    async with connect_db() as db:
+        db.row_factory = aiosqlite.Row
+        cursor = await db.execute("SELECT * FROM backfill_state WHERE peer_id = ?", (peer_id,))
+        row = await cursor.fetchone()
+    return dict(row) if row else None
+
+async def save_backfill_state(state: dict):
+    state["updated_at"] = time.time()
+    columns = list(state)
+    async with connect_db() as db:
+        await db.execute(
+            f"INSERT OR REPLACE INTO backfill_state ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})",
+            [state[column] for column in columns],
+        )
+        await db.commit()
+
+def get_backfill_job_key(state: dict) -> str:
+    # Один ключ на звено цепочки: повторный /бэкфилл попадает в уже поставленную задачу, а не запускает вторую цепочку
+    return f"backfill:{state['peer_id']}:{int(state['started_at'])}:{state['pages']}"
+
+async def enqueue_backfill_slice(state: dict) -> bool:
+    key = get_backfill_job_key(state)
+    if await enqueue_job("backfill", state["peer_id"], {}, dedupe_key=key):
+        return True
+    # Звено уже есть. Если оно в очереди или выполняется, цепочка жива; если упало — перезапускаем его же
+    async with connect_db() as db:
+        cursor = await db.execute(
+            """
+            UPDATE jobs SET state = 'queued', attempts = 0, run_at = ?, locked_until = NULL, last_error = NULL, updated_at = ?
+            WHERE dedupe_key = ? AND state IN ('failed', 'done')
+            """,
+            (time.time(), time.time(), key),
+        )
+        await db.commit()
+        resumed = cursor.rowcount > 0
+    if resumed:
+        log.info("Backfill resumed peer_id=%s key=%s", state["peer_id"], key)
+    return resumed
+
+async def start_backfill(peer_id: int, reason: str) -> bool:
+    """Ставит бэкфилл в очередь. False — цепочка для чата уже идет."""
+    state = await load_backfill_state(peer_id)
+    if state and state["status"] == "running":
+        return await enqueue_backfill_slice(state)
+    # Повторный запуск (например, после простоя) идет только до места, где закончился прошлый
+    stop_cmid = state["newest_cmid"] if state and state["status"] == "done" else None
+    state = {
+        "peer_id": peer_id,
+        "status": "running",
+        "start_cmid": None,
+        "newest_cmid": None,
+        "stop_cmid": stop_cmid,
+        "pages": 0,
+        "fetched": 0,
+        "inserted": 0,
+        "started_at": time.time(),
+        "last_error": None,
+    }
+    await save_backfill_state(state)
+    log.info("Backfill started peer_id=%s reason=%s", peer_id, reason)
+    return await enqueue_backfill_slice(state)
+
+async def run_backfill_slice(peer_id: int):
+    state = await load_backfill_state(peer_id)
+    if not state or state["status"] != "running":
+        return
+    cutoff = time.time() - BACKFILL_MAX_DAYS * 86400
+    finished = False
+    for _ in range(BACKFILL_PAGES_PER_JOB):
+        try:
+            page = await fetch_history_page(peer_id, state["start_cmid"])
+        except VKAPIError as e:
+            state["status"] = "failed"
+            state["last_error"] = str(e)[:300]
+            await save_backfill_state(state)
+            log.error("Backfill failed peer_id=%s: %s", peer_id, e)
+            return
+        items = page.get("items") or []
+        names = {
+            profile["id"]: f"{profile.get('first_name', '')} {profile.get('last_name', '')}".strip()
+            for profile in page.get("profiles") or []
+        }
+        fresh = [item for item in items if (item.get("date") or 0) >= cutoff]
+        inserted = await store_history_items(peer_id, fresh, names)
+        cmids = [item["conversation_message_id"] for item in items if item.get("conversation_message_id")]
+        state["pages"] += 1
+        state["fetched"] += len(fresh)
+        state["inserted"] += inserted
+        if cmids:
+            state["start_cmid"] = min(cmids)
+            state["newest_cmid"] = max(state["newest_cmid"] or 0, max(cmids))
+        if len(items) < BACKFILL_PAGE_SIZE or len(fresh) < len(items) or not cmids or state["fetched"] >= BACKFILL_MAX_MESSAGES:
+            finished = True
+        elif state["stop_cmid"] and state["start_cmid"] <= state["stop_cmid"]:
+            finished = True
+        await save_backfill_state(state)
+        if finished:
+            break
+        await asyncio.sleep(BACKFILL_PAGE_DELAY)
+    if finished:
+        state["status"] = "done"
+        await save_backfill_state(state)
+        log.info(
+            "Backfill finished peer_id=%s pages=%s fetched=%s inserted=%s",
+            peer_id,
+            state["pages"],
+            state["fetched"],
+            state["inserted"],
+        )
+        return
+    await enqueue_backfill_slice(state)
+
+async def describe_backfills() -> list:
+    async with connect_db() as db:
+        cursor = await db.execute(
+            "SELECT peer_id, status, pages, fetched, inserted, start_cmid, updated_at, last_error FROM backfill_state ORDER BY updated_at DESC"
+        )
+        rows = await cursor.fetchall()
+    if not rows:
+        return ["📥 Бэкфилл еще не запускался."]
+    lines = ["📥 **Бэкфилл:**"]
+    for peer_id, status, pages, fetched, inserted, start_cmid, updated_at, last_error in rows:
+        updated_label = datetime.datetime.fromtimestamp(updated_at, MSK_TZ).strftime("%Y-%m-%d %H:%M")
+        line = (
+            f"• `{peer_id}`: {status}, страниц {pages}, получено {fetched}, добавлено {inserted}, "
+            f"позиция cmid {start_cmid or '—'}, {updated_label}"
+        )
+        if last_error:
+            line += f"\n  Ошибка: {last_error}"
+        lines.append(line)
+    return lines
+
+# ================= РЕЗЕРВНЫЕ КОПИИ =================
+# Онлайн-бэкап через SQLite backup API: страницы копируются маленькими шагами с паузами
+# в потоке aiosqlite, поэтому event loop и запись новых сообщений не ждут копирования.
+class BackupRestartLimit(Exception):
+    pass
+
+def get_backup_prefix() -> str:
+    return os.path.splitext(os.path.basename(DB_NAME))[0] + "-"
+
+def list_backups() -> list:
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    prefix = get_backup_prefix()
+    names = [
+        name for name in os.listdir(BACKUP_DIR)
+        if name.startswith(prefix) and name.endswith(".db.gz")
+    ]
+    return sorted(os.path.join(BACKUP_DIR, name) for name in names)
+
+def compress_backup(source_path: str, target_path: str):
+    with open(source_path, "rb") as source, gzip.open(target_path + ".part", "wb", compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    os.replace(target_path + ".part", target_path)
+
+def rotate_backups() -> int:
+    backups = list_backups()
+    removed = 0
+    for path in backups[:-BACKUP_KEEP]:
+        os.remove(path)
+        removed += 1
+    return removed
+
+async def copy_database(target_path: str):
+    state = {"remaining": None, "restarts": 0}
+
+    def on_progress(status, remaining, total):
+        # Если источник изменился другим соединением, SQLite начинает копирование заново
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > BACKUP_MAX_RESTARTS:
+                raise BackupRestartLimit()
+        state["remaining"] = remaining
+        if remaining and BACKUP_STEP_PAUSE:
+            time.sleep(BACKUP_STEP_PAUSE)
+
+    async with connect_db() as source:
+        async with aiosqlite.connect(target_path) as target:
+            try:
+                await source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=on_progress)
+            except BackupRestartLimit:
+                # База пишется слишком часто: копируем за один шаг внутри одной читающей транзакции
+                log.info("Backup restarted %s times, copying in a single step", state["restarts"])
+                await source.backup(target, pages=-1)
+    return state["restarts"]
+
+async def run_backup() -> dict:
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    started = time.perf_counter()
+    stamp = datetime.datetime.now(MSK_TZ).strftime("%Y%m%d-%H%M%S")
+    base_path = os.path.join(BACKUP_DIR, f"{get_backup_prefix()}{stamp}.db")
+    raw_path = base_path + ".tmp"
+    try:
+        restarts = await copy_database(raw_path)
+        async with aiosqlite.connect(raw_path) as snapshot:
+            # Настройки кластера живут до перезапуска и в копии не нужны; secure_delete затирает страницы
+            await snapshot.execute("PRAGMA secure_delete=ON")
+            await snapshot.execute("DELETE FROM runtime_settings")
+            await snapshot.commit()
+            cursor = await snapshot.execute("PRAGMA integrity_check")
+            integrity = [row[0] for row in await cursor.fetchall()]
+        if integrity != ["ok"]:
+            raise RuntimeError(f"integrity check failed: {'; '.join(integrity[:3])}")
+        raw_size = os.path.getsize(raw_path)
+        await asyncio.to_thread(compress_backup, raw_path, base_path + ".gz")
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    removed = await asyncio.to_thread(rotate_backups)
+    result = {
+        "path": base_path + ".gz",
+        "raw_bytes": raw_size,
+        "bytes": os.path.getsize(base_path + ".gz"),
+        "restarts": restarts,
+        "rotated": removed,
+        "duration": time.perf_counter() - started,
+    }
+    log.info(
+        "Backup finished path=%s size=%s compressed=%s restarts=%s rotated=%s duration=%.1fs",
+        result["path"],
+        result["raw_bytes"],
+        result["bytes"],
+        restarts,
+        removed,
+        result["duration"],
+    )
+    return result
+
+async def describe_backups() -> list:
+    backups = list_backups()
+    lines = [f"💾 **Бэкапы:** `{len(backups)}` из `{BACKUP_KEEP}`, папка `{BACKUP_DIR}`"]
+    if backups:
+        latest = backups[-1]
+        latest_at = datetime.datetime.fromtimestamp(os.path.getmtime(latest), MSK_TZ).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"Последний: `{os.path.basename(latest)}` ({format_bytes(os.path.getsize(latest))}, {latest_at})")
+    async with connect_db() as db:
+        cursor = await db.execute(
+            "SELECT state, attempts, last_error, updated_at FROM jobs WHERE kind = 'backup' ORDER BY id DESC LIMIT 1"
+        )
+        row = await cursor.fetchone()
+    if row:
+        state, attempts, last_error, updated_at = row
+        updated_label = datetime.datetime.fromtimestamp(updated_at, MSK_TZ).strftime("%Y-%m-%d %H:%M")
+        job_line = f"Задача: `{state}`, попыток {attempts}, {updated_label}"
+        if last_error:
+            job_line += f"\nОшибка: {last_error}"
+        lines.append(job_line)
+    if BACKUP_INTERVAL_HOURS:
+        lines.append(f"Авто-бэкап: каждые {BACKUP_INTERVAL_HOURS} ч.")
+    else:
+        lines.append("Авто-бэкап: выключен")
+    return lines
+
+# ================= ОЧЕРЕДЬ ЗАДАЧ =================
+# Задачи таймеров хранятся в SQLite: переживают падение и редеплой, повторяются с задержкой,
+# а зависшие (locked_until в прошлом) забирает любой свободный воркер.
+job_worker_tasks = []
+
+async def enqueue_job(kind: str, peer_id: int | None = None, payload: dict | None = None, dedupe_key: str | None = None, max_attempts: int | None = None) -> bool:
+    now = time.time()
+    async with connect_db() as db:
+        cursor = await db.execute(
+            """
+            INSERT OR IGNORE INTO jobs (kind, peer_id, payload, dedupe_key, state, attempts, max_attempts, run_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)
+            """,
+            (
+                kind,
+                peer_id,
+                json.dumps(payload or {}, ensure_ascii=False),
+                dedupe_key,
+                max_attempts or JOB_MAX_ATTEMPTS,
+                now,
+                now,
+                now,
+            ),
+        )
+        await db.commit()
+        created = cursor.rowcount > 0
+    if created:
+        log.debug("Job enqueued kind=%s peer_id=%s key=%s", kind, peer_id, dedupe_key)
+    return created
+
+async def claim_jobs(kind: str | None = None, limit: int = 1) -> list:
+    now = time.time()
+    kind_filter = "AND kind = ?" if kind else ""
+    params = [now + JOB_VISIBILITY_TIMEOUT, CLUSTER_NODE_ID, now, now, now]
+    if kind:
+        params.append(kind)
+    params.append(limit)
+    async with connect_db() as db:
+        cursor = await db.execute(
+            f"""
+            UPDATE jobs
+            SET state = 'running', attempts = attempts + 1, locked_until = ?, locked_by = ?, updated_at = ?
+            WHERE id IN (
+                SELECT id FROM jobs
+                WHERE ((state = 'queued' AND run_at <= ?) OR (state = 'running' AND locked_until < ?)) {kind_filter}
+                ORDER BY run_at, id
+                LIMIT ?
+            )
+            RETURNING id, kind, peer_id, payload, attempts, max_attempts
+            """,
+            params,
+        )
+        rows = await cursor.fetchall()
+        await db.commit()
+    return [
+        {
+            "id": job_id,
+            "kind": job_kind,
+            "peer_id": peer_id,
+            "payload": json.loads(payload or "{}"),
+            "attempts": attempts,
+            "max_attempts": max_attempts,
+        }
+        for job_id, job_kind, peer_id, payload, attempts, max_attempts in rows
+    ]
+
+async def complete_job(job: dict):
+    async with connect_db() as db:
+        await db.execute(
+            "UPDATE jobs SET state = 'done', locked_until = NULL, last_error = NULL, updated_at = ? WHERE id = ?",
+            (time.time(), job["id"]),
+        )
+        await db.commit()
+
+async def fail_job(job: dict, error: str):
+    now = time.time()
+    if job["attempts"] >= job["max_attempts"]:
+        state = "failed"
+        run_at = now
+        log.error(
+            "Job failed permanently id=%s kind=%s peer_id=%s attempts=%s: %s",
+            job["id"],
+            job["kind"],
+            job["peer_id"],
+            job["attempts"],
+            error,
+        )
+    else:
+        state = "queued"
+        run_at = now + JOB_BACKOFF * (2 ** (job["attempts"] - 1))
+        log.warning(
+            "Job attempt failed id=%s kind=%s peer_id=%s attempt=%s retry_in=%ss: %s",
+            job["id"],
+            job["kind"],
+            job["peer_id"],
+            job["attempts"],
+            int(run_at - now),
+            error,
+        )
+    async with connect_db() as db:
+        await db.execute(
+            "UPDATE jobs SET state = ?, run_at = ?, locked_until = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+            (state, run_at, error[:500], now, job["id"]),
+        )
+        await db.commit()
+
+async def recover_jobs():
+    """При старте все running-задачи принадлежат умершему процессу — возвращаем их в очередь."""
+    async with connect_db() as db:
+        cursor = await db.execute(
+            "UPDATE jobs SET state = 'queued', locked_until = NULL, run_at = ?, updated_at = ? WHERE state = 'running'",
+            (time.time(), time.time()),
+        )
+        await db.commit()
+        if cursor.rowcount:
+            log.warning("Recovered %s in-flight jobs after restart", cursor.rowcount)
+
+async def prune_jobs():
+    cutoff = time.time() - JOB_RETENTION_DAYS * 86400
+    async with connect_db() as db:
+        await db.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+        await db.commit()
+
+async def run_game_job(job: dict):
+    # Сброс только в первой попытке: повтор после сбоя доставки покажет уже выбранного победителя
+    reset = bool(job["payload"].get("reset")) and job["attempts"] == 1
+    if not await run_game_logic(job["peer_id"], reset_if_exists=reset):
+        raise RuntimeError("game round was not completed")
+
+async def run_leaderboard_job(job: dict):
+    if not await post_leaderboard(job["peer_id"], job["payload"]["month"]):
+        raise RuntimeError("leaderboard was not delivered")
+
+async def run_retention_job(job: dict):
+    await run_retention()
+
+async def run_backfill_job(job: dict):
+    await run_backfill_slice(job["peer_id"])
+
+async def run_maintenance_job(job: dict):
+    await run_maintenance()
+
+async def run_backup_job(job: dict):
+    try:
+        result = await run_backup()
+    except Exception as e:
+        if job["peer_id"] and job["attempts"] >= job["max_attempts"]:
+            await send_peer_message(job["peer_id"], f"❌ Бэкап не удался: {e}", dedupe_key=f"backup:{job['id']}:error")
+        raise
+    if job["peer_id"]:
+        await send_peer_message(
+            job["peer_id"],
+            f"✅ Бэкап готов: `{os.path.basename(result['path'])}`\n"
+            f"Размер: {format_bytes(result['raw_bytes'])} → {format_bytes(result['bytes'])}, "
+            f"{result['duration']:.1f} с, integrity_check ok",
+            dedupe_key=f"backup:{job['id']}:done",
+            priority=SEND_PRIORITY_COMMAND,
+        )
+
+JOB_HANDLERS = {
+    "game": run_game_job,
+    "leaderboard": run_leaderboard_job,
+    "retention": run_retention_job,
+    "maintenance": run_maintenance_job,
+    "backup": run_backup_job,
+    "backfill": run_backfill_job,
+}
+
+async def run_claimed_jobs(jobs: list):
+    game_jobs = [job for job in jobs if job["kind"] == "game"]
+    if GAME_BATCH_ENABLED and len(game_jobs) > 1:
+        first_attempt = [job for job in game_jobs if job["attempts"] == 1 and job["payload"].get("reset")]
+        if len(first_attempt) > 1:
+            try:
+                outcomes = await run_game_batch([job["peer_id"] for job in first_attempt])
+            except Exception as e:
+                log.exception("Batch game job failed: %s", e)
+                outcomes = {}
+            for job in first_attempt:
+                if outcomes.get(job["peer_id"]):
+                    await complete_job(job)
+                else:
+                    await fail_job(job, "batch game round was not completed")
+            jobs = [job for job in jobs if job not in first_attempt]
+    for job in jobs:
+        handler = JOB_HANDLERS.get(job["kind"])
+        if handler is None:
+            await fail_job(job, f"unknown job kind {job['kind']}")
+            continue
+        try:
+            await handler(job)
+        except Exception as e:
+            await fail_job(job, str(e) or e.__class__.__name__)
+            continue
+        await complete_job(job)
+
+async def job_worker(index: int):
+    while True:
+        try:
+            jobs = await claim_jobs()
+            if not jobs:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            if GAME_BATCH_ENABLED and jobs[0]["kind"] == "game":
+                jobs.extend(await claim_jobs(kind="game", limit=GAME_BATCH_MAX_CHATS - 1))
+            log.debug("Job worker %s claimed %s jobs", index, len(jobs))
+            await run_claimed_jobs(jobs)
+        except Exception as e:
+            log.exception("Job worker %s error: %s", index, e)
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+async def job_maintenance_loop():
+    while True:
+        try:
+            await prune_jobs()
+        except Exception as e:
+            log.warning("Job pruning failed: %s", e)
+        await asyncio.sleep(3600)
+
+def start_job_workers():
+    for index in range(JOB_WORKERS):
+        job_worker_tasks.append(asyncio.create_task(job_worker(index)))
+    asyncio.create_task(job_maintenance_loop())
+
+async def describe_jobs() -> str:
+    async with connect_db() as db:
+        cursor = await db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+        counts = dict(await cursor.fetchall())
+    return (
+        f"queued={counts.get('queued', 0)} running={counts.get('running', 0)} "
+        f"failed={counts.get('failed', 0)} done={counts.get('done', 0)}"
+    )
+
+# ================= ТАЙМЕРЫ =================
+async def scheduler_tick(now: datetime.datetime):
+    now_time = now.strftime("%H:%M")
+    month_key = now.strftime("%Y-%m")
+    last_day = last_day_of_month(now.year, now.month)
+    async with connect_db() as db:
+        if ALLOWED_PEER_IDS is not None:
+            placeholders = ", ".join(["?"] * len(ALLOWED_PEER_IDS))
+            cursor = await db.execute(
+                f"SELECT peer_id FROM schedules WHERE time = ? AND peer_id IN ({placeholders})",
+                (now_time, *ALLOWED_PEER_IDS)
+            )
+        else:
+            cursor = await db.execute("SELECT peer_id FROM schedules WHERE time = ?", (now_time,))
+        rows = await cursor.fetchall()
+        if ALLOWED_PEER_IDS is not None:
+            placeholders = ", ".join(["?"] * len(ALLOWED_PEER_IDS))
+            cursor = await db.execute(
+                f"SELECT peer_id, day, time, last_run_month FROM leaderboard_schedule WHERE time = ? AND peer_id IN ({placeholders})",
+                (now_time, *ALLOWED_PEER_IDS)
+            )
+        else:
+            cursor = await db.execute(
+                "SELECT peer_id, day, time, last_run_month FROM leaderboard_schedule WHERE time = ?",
+                (now_time,)
+            )
+        lb_rows = await cursor.fetchall()
+
+    if is_retention_enabled() and now_time == RETENTION_TIME:
+        if await enqueue_job("retention", payload={}, dedupe_key=f"retention:{now.date().isoformat()}", max_attempts=1):
+            metrics.inc("bot_scheduler_fires_total", "retention")
+    timer_minutes = await load_timer_minutes()
+    if BACKUP_INTERVAL_HOURS and not is_timer_minute(now, timer_minutes):
+        slot = int(now.timestamp()) // (BACKUP_INTERVAL_HOURS * 3600)
+        if await enqueue_job("backup", payload={}, dedupe_key=f"backup:{slot}", max_attempts=2):
+            metrics.inc("bot_scheduler_fires_total", "backup")
+    if MAINTENANCE_ENABLED and is_quiet_time(now) and not is_timer_minute(now, timer_minutes):
+        created = await enqueue_job(
+            "maintenance",
+            payload={},
+            dedupe_key=f"maintenance:{now.date().isoformat()}:{now.hour:02d}",
+            max_attempts=1,
+        )
+        if created:
+            metrics.inc("bot_scheduler_fires_total", "maintenance")
+
+    if rows:
+        log.debug("Triggering scheduled games for time %s: %s chats", now_time, len(rows))
+        for (peer_id,) in rows:
+            created = await enqueue_job(
+                "game",
+                peer_id,
+                {"reset": True},
+                dedupe_key=f"game:{peer_id}:{now.date().isoformat()}:{now_time}",
+            )
+            if created:
+                metrics.inc("bot_scheduler_fires_total", "game")
+            if created and event_recorder is not None:
+                event_recorder.record_timer("game", peer_id, {"reset": True})
+    for peer_id, day, _, last_run_month in lb_rows:
+        try:
+            day_int = int(day)
+        except (TypeError, ValueError):
+            continue
+        effective_day = min(day_int, last_day)
+        if now.day != effective_day:
+            continue
+        if last_run_month == month_key:
+            continue
+        log.debug(
+            "Triggering leaderboard for peer_id=%s month=%s day=%s",
+            peer_id,
+            month_key,
+            effective_day,
+        )
+        created = await enqueue_job(
+            "leaderboard",
+            peer_id,
+            {"month": month_key},
+            dedupe_key=f"leaderboard:{peer_id}:{month_key}",
+        )
+        if created:
+            metrics.inc("bot_scheduler_fires_total", "leaderboard")
+        if created and event_recorder is not None:
+            event_recorder.record_timer("leaderboard", peer_id, {"month": month_key})
+
+async def scheduler_loop():
+    log.info("Scheduler started")
+    while True:
+        try:
+            if is_scheduler_leader():
+                await scheduler_tick(datetime.datetime.now(MSK_TZ))
             await asyncio.sleep(60)
         except Exception as e:
             log.exception("Error in scheduler: %s", e)
@@ -907,11 +4398,15 @@ async def show_settings(message: Message):
     if not await ensure_command_allowed(message, CMD_SETTINGS):
         return
     log.debug("Settings requested peer_id=%s user_id=%s", message.peer_id, message.from_id)
-    provider_label = "Groq" if LLM_PROVIDER == "groq" else "Venice"
+    provider_label = PROVIDER_LABELS[LLM_PROVIDER]
     if LLM_PROVIDER == "groq":
         key_short = GROQ_API_KEY[:5] + "..." if GROQ_API_KEY else "не задан"
         active_model = GROQ_MODEL
         active_temperature = GROQ_TEMPERATURE
+    elif LLM_PROVIDER == "mock":
+        key_short = "не нужен"
+        active_model = MOCK_MODEL
+        active_temperature = MOCK_TEMPERATURE
     else:
         key_short = VENICE_API_KEY[:5] + "..." if VENICE_API_KEY else "не задан"
         active_model = VENICE_MODEL
@@ -928,10 +4423,24 @@ async def show_settings(message: Message):
         else:
             access_line = f"{peers_label}, ЛС admin не настроены"
     chatbot_status = "включен" if CHATBOT_ENABLED else "выключен"
+    context_label = format_context_length(get_model_context_tokens())
+    model_label = f"{active_model} ({context_label})" if context_label else active_model
+    structured_status = "JSON mode" if LLM_STRUCTURED_OUTPUT else "текст"
+    send_queue_status = vk_send_queue.describe()
+    execute_status = bot.api.describe()
+    if cluster_worker_index is None:
+        cluster_status = "один процесс"
+    else:
+        leader_label = "лидер" if is_scheduler_leader() else "ведомый"
+        cluster_status = f"воркер {cluster_worker_index + 1}/{CLUSTER_WORKERS}, {leader_label}"
+    if CHAT_CACHE_ENABLED:
+        cache_status = chat_response_cache.describe()
+    else:
+        cache_status = "выключен"
     schedule_time = None
     leaderboard_day = None
     leaderboard_time = None
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect_db() as db:
         cursor = await db.execute("SELECT time FROM schedules WHERE peer_id = ?", (message.peer_id,))
         row = await cursor.fetchone()
         if row:
@@ -940,6 +4449,9 @@ async def show_settings(message: Message):
         row = await cursor.fetchone()
         if row:
             leaderboard_day, leaderboard_time = row
+    jobs_status = await describe_jobs()
+    record_status = event_recorder.describe() if event_recorder is not None else "выключена"
+    mock_line = f"🧪 **Mock:** `{describe_mock_stats()}`\n" if LLM_PROVIDER == "mock" else ""
     if schedule_time:
         schedule_line = f"Таймер (МСК): `{schedule_time}`\n"
     else:
@@ -951,27 +4463,38 @@ async def show_settings(message: Message):
     text = (
         f"🎛 **Настройки игры**\n\n"
         f"🤖 **Провайдер:** `{provider_label}`\n"
-        f"📦 **Доступные провайдеры:** `groq`, `venice`\n"
+        f"📦 **Доступные провайдеры:** `groq`, `venice`, `mock`\n"
         f"🔒 **Доступ:** {access_line}\n"
         f"🧭 **Peer ID:** `{message.peer_id}`\n"
         f"💬 **Чатбот:** `{chatbot_status}`\n"
-        f"🎯 **Модель:** `{active_model}`\n"
+        f"🗃 **Кэш чатбота:** `{cache_status}`\n"
+        f"🧩 **Ответ игры:** `{structured_status}`, `{describe_winner_parse_stats()}`\n"
+        f"📤 **Отправка VK:** `{send_queue_status}`\n"
+        f"📦 **VK execute:** `{execute_status}`\n"
+        f"🧱 **Кластер:** `{cluster_status}`\n"
+        f"🗂 **Задачи:** `{jobs_status}`\n"
+        f"🎥 **Запись событий:** `{record_status}`\n"
+        f"🎯 **Модель:** `{model_label}`\n"
         f"🔑 **Ключ:** `{key_short}`\n"
         f"🌡 **Температура:** `{active_temperature}`\n"
+        f"{mock_line}"
         f"Последнее обновление: {format_build_date(BUILD_DATE)}\n"
         f"{schedule_line}\n"
         f"{leaderboard_line}\n"
         f"**⚙ Команды:**\n"
-        f"• `{CMD_SET_PROVIDER} groq|venice` - Выбрать провайдера\n"
+        f"• `{CMD_SET_PROVIDER} groq|venice|mock` - Выбрать провайдера\n"
         f"• `{CMD_SET_MODEL} <провайдер> <id>` - Сменить модель\n"
         f"• `{CMD_SET_KEY} <провайдер> <ключ>` - Новый API ключ\n"
         f"• `{CMD_SET_TEMPERATURE} <0.0-2.0>` - Установить температуру\n"
-        f"• `{CMD_LIST_MODELS} <провайдер>` - Список моделей (Live)\n\n"
+        f"• `{CMD_LIST_MODELS} <провайдер>` - Список моделей\n\n"
         f"• `{CMD_PROMPT}` или `{CMD_PROMPT} <текст>` - Показать/обновить user prompt\n\n"
         f"**🎮 Игра:**\n"
         f"• `{CMD_RUN}` - Найти пидора дня\n"
         f"• `{CMD_RESET}` - Сброс результата сегодня\n"
         f"• `{CMD_LEADERBOARD}` - Лидерборд месяца и все время\n"
+        f"• `{CMD_SEARCH} <запрос>` - Поиск по истории чата\n"
+        f"• `{CMD_STATS} [день|месяц|всё] [я]` - Кто сколько пишет\n"
+        f"• `{CMD_RECORDS}` - Серии и рекорды игры\n"
         f"• `{CMD_TIME_SET} 14:00` - Установить авто-поиск (МСК)\n"
         f"• `{CMD_TIME_RESET}` - Удалить таймер\n"
         f"• `{CMD_LEADERBOARD_TIMER_SET} 05-18-30` - Таймер лидерборда (МСК)\n"
@@ -984,64 +4507,40 @@ async def list_models_handler(message: Message):
         return
     args = strip_command(message.text, CMD_LIST_MODELS).lower()
     if not args:
-        await send_reply(message, f"❌ Укажи провайдера: groq или venice.\nПример: `{CMD_LIST_MODELS} groq`")
+        await send_reply(message, f"❌ Укажи провайдера: groq, venice или mock.\nПример: `{CMD_LIST_MODELS} groq`")
         return
     provider = args
-    if provider not in ("groq", "venice"):
-        await send_reply(message, "❌ Неверный провайдер. Используй: groq или venice.")
+    if provider not in LLM_PROVIDERS:
+        await send_reply(message, "❌ Неверный провайдер. Используй: groq, venice или mock.")
         return
     log.info("List models request peer_id=%s user_id=%s provider=%s", message.peer_id, message.from_id, provider)
-    if provider == "groq":
-        await send_reply(message, "🔄 Связываюсь с API Groq...")
-        try:
-            if not GROQ_API_KEY:
-                raise RuntimeError("Не найден GROQ_API_KEY")
-            if AsyncGroq is None:
-                raise RuntimeError("Пакет groq не установлен")
-            client = groq_client or AsyncGroq(api_key=GROQ_API_KEY)
-            models_response = await client.models.list()
-            active_models = sorted([m.id for m in models_response.data], key=lambda x: (not x.startswith("llama"), x))
-
-            if not active_models:
-                await send_reply(message, "❌ Список моделей пуст (возможно проблема с ключом).")
-                return
-
-            models_text = "\n".join([f"• `{m}`" for m in active_models[:20]])
-            example_model = active_models[0] if active_models else "model_id"
-
-            await send_reply(message, 
-                f"📦 **Доступные модели (Live API):**\n\n{models_text}\n\n"
-                f"Чтобы выбрать модель, отправь ID в формате:\n"
-                f"{CMD_SET_MODEL} groq {example_model}"
-            )
-        except Exception as e:
-            log.exception("Groq models list failed: %s", e)
-            await send_reply(message, f"❌ Ошибка API:\n{e}")
+    provider_label = PROVIDER_LABELS[provider]
+    if provider not in model_catalog.entries:
+        await send_reply(message, f"🔄 Связываюсь с API {provider_label}...")
+    models = await model_catalog.get(provider)
+    if models is None:
+        error = model_catalog.last_errors.get(provider, "неизвестная ошибка")
+        await send_reply(message, f"❌ Ошибка API:\n{error}")
         return
 
-    await send_reply(message, "🔄 Связываюсь с API Venice...")
-    try:
-        if not VENICE_API_KEY:
-            raise RuntimeError("Не найден VENICE_API_KEY")
-        response = await venice_request("GET", "models")
-        models_response = response.json()
-        model_ids = sorted({m.get("id") for m in models_response.get("data", []) if m.get("id")})
-
-        if not model_ids:
-            await send_reply(message, "❌ Список моделей пуст (возможно проблема с ключом).")
-            return
+    if provider == "groq":
+        model_ids = sorted(models, key=lambda x: (not x.startswith("llama"), x))
+    else:
+        model_ids = sorted(models)
 
-        models_text = "\n".join([f"• `{m}`" for m in model_ids[:20]])
-        example_model = model_ids[0] if model_ids else "model_id"
+    lines = []
+    for model_id in model_ids[:20]:
+        context_label = format_context_length(models[model_id].get("context_length"))
+        suffix = f" — {context_label}" if context_label else ""
+        lines.append(f"• `{model_id}`{suffix}")
+    models_text = "\n".join(lines)
+    example_model = model_ids[0] if model_ids else "model_id"
 
-        await send_reply(message, 
-            f"📦 **Доступные модели (Live API):**\n\n{models_text}\n\n"
-            f"Чтобы выбрать модель, отправь ID в формате:\n"
-            f"{CMD_SET_MODEL} venice {example_model}"
-        )
-    except Exception as e:
-        log.exception("Venice models list failed: %s", e)
-        await send_reply(message, f"❌ Ошибка API:\n{e}")
+    await send_reply(message,
+        f"📦 **Доступные модели ({provider_label}):**\n\n{models_text}\n\n"
+        f"Чтобы выбрать модель, отправь ID в формате:\n"
+        f"{CMD_SET_MODEL} {provider} {example_model}"
+    )
 
 # ================= USER PROMPT =================
 
@@ -1064,6 +4563,7 @@ async def prompt_handler(message: Message):
         return
     USER_PROMPT_TEMPLATE = updated
     os.environ["USER_PROMPT_TEMPLATE"] = updated
+    await publish_runtime_setting("USER_PROMPT_TEMPLATE", updated)
     log.info(
         "Prompt updated peer_id=%s user_id=%s length=%s",
         message.peer_id,
@@ -1073,19 +4573,107 @@ async def prompt_handler(message: Message):
     await send_reply(message, "✅ USER_PROMPT_TEMPLATE обновлен (в памяти).")
 
 # Лидерборд по текущему чату
-@bot.on.message(EqualsRule(CMD_LEADERBOARD))
+@bot.on.message(StartswithRule(CMD_LEADERBOARD))
 async def leaderboard_handler(message: Message):
     if not await ensure_command_allowed(message, CMD_LEADERBOARD):
         return
-    log.info("Leaderboard requested peer_id=%s user_id=%s", message.peer_id, message.from_id)
-    text = await build_leaderboard_text(message.peer_id)
+    args = (message.text or "").strip()[len(CMD_LEADERBOARD):].strip()
+    if args and not args.isdigit():
+        await send_reply(message, f"Использование: `{CMD_LEADERBOARD}` или `{CMD_LEADERBOARD} <страница>`")
+        return
+    page = max(int(args), 1) if args else 1
+    log.info("Leaderboard requested peer_id=%s user_id=%s page=%s", message.peer_id, message.from_id, page)
+    text = await build_leaderboard_text(message.peer_id, page=page, requester_id=message.from_id)
+    await send_reply(message, text)
+
+@bot.on.message(StartswithRule(CMD_SEARCH))
+async def search_handler(message: Message):
+    if not await ensure_command_allowed(message, CMD_SEARCH):
+        return
+    args = (message.text or "").strip()[len(CMD_SEARCH):].strip()
+    page = 1
+    first, _, rest = args.partition(" ")
+    if first.isdigit() and rest.strip():
+        page = max(int(first), 1)
+        args = rest.strip()
+    if not args:
+        await send_reply(message, f"Использование: `{CMD_SEARCH} <запрос>` или `{CMD_SEARCH} <страница> <запрос>`")
+        return
+    started = time.perf_counter()
+    result = await search_messages(message.peer_id, args, page)
+    if result is None:
+        await send_reply(message, "🔎 В запросе нет слов для поиска.")
+        return
+    log.info(
+        "Search peer_id=%s user_id=%s page=%s total=%s duration=%.1fms",
+        message.peer_id,
+        message.from_id,
+        page,
+        result["total"],
+        (time.perf_counter() - started) * 1000,
+    )
+    await send_reply(message, format_search_results(args, result))
+
+@bot.on.message(StartswithRule(CMD_STATS))
+async def stats_handler(message: Message):
+    if not await ensure_command_allowed(message, CMD_STATS):
+        return
+    args = (message.text or "").strip()[len(CMD_STATS):].strip()
+    period = "месяц"
+    target_id = extract_mentioned_user_id(args) or extract_reply_from_id(message)
+    args = re.sub(r"\[id\d+\|[^\]]*\]", " ", args)
+    for part in args.split():
+        parsed = parse_stats_period(part.lower())
+        if parsed:
+            period = parsed
+        elif part.lower() == "я":
+            target_id = message.from_id
+        else:
+            await send_reply(
+                message,
+                f"Использование: `{CMD_STATS} [день|месяц|всё] [я|@пользователь]` или ответом на сообщение",
+            )
+            return
+    started = time.perf_counter()
+    if target_id and target_id > 0:
+        text = await build_user_stats_text(message.peer_id, target_id, period)
+    else:
+        text = await build_chat_stats_text(message.peer_id, period)
+    log.info(
+        "Stats requested peer_id=%s user_id=%s target=%s period=%s duration=%.1fms",
+        message.peer_id,
+        message.from_id,
+        target_id,
+        period,
+        (time.perf_counter() - started) * 1000,
+    )
     await send_reply(message, text)
 
+@bot.on.message(StartswithRule(CMD_RECORDS))
+async def records_handler(message: Message):
+    if not await ensure_command_allowed(message, CMD_RECORDS):
+        return
+    args = (message.text or "").strip()[len(CMD_RECORDS):].strip().lower()
+    if args == "пересчитать":
+        if not await ensure_admin_command(message, f"{CMD_RECORDS} пересчитать"):
+            return
+        async with connect_db() as db:
+            count = await rebuild_game_records(db)
+            await db.commit()
+        log.info("Game records rebuilt by user_id=%s rows=%s", message.from_id, count)
+        await send_reply(message, f"✅ Рекорды пересчитаны из истории: {count} записей.")
+        return
+    if args:
+        await send_reply(message, f"Использование: `{CMD_RECORDS}`")
+        return
+    log.info("Records requested peer_id=%s user_id=%s", message.peer_id, message.from_id)
+    await send_reply(message, await build_records_text(message.peer_id, message.from_id))
+
 @bot.on.message(StartswithRule(CMD_SET_MODEL))
 async def set_model_handler(message: Message):
     if not await ensure_command_allowed(message, CMD_SET_MODEL):
         return
-    global GROQ_MODEL, VENICE_MODEL
+    global GROQ_MODEL, VENICE_MODEL, MOCK_MODEL
     args = strip_command(message.text, CMD_SET_MODEL)
     if not args:
         await send_reply(message, f"❌ Укажи провайдера и модель!\nПример: `{CMD_SET_MODEL} groq llama-3.3-70b-versatile`")
@@ -1095,12 +4683,23 @@ async def set_model_handler(message: Message):
         await send_reply(message, f"❌ Укажи провайдера и модель!\nПример: `{CMD_SET_MODEL} venice venice-uncensored`")
         return
     provider, model_id = parts[0].lower(), parts[1].strip()
-    if provider not in ("groq", "venice"):
-        await send_reply(message, "❌ Неверный провайдер. Доступно: groq или venice.")
+    if provider not in LLM_PROVIDERS:
+        await send_reply(message, "❌ Неверный провайдер. Доступно: groq, venice или mock.")
+        return
+    models = await model_catalog.get(provider)
+    if models is not None and model_id not in models:
+        suggestions = difflib.get_close_matches(model_id, list(models), n=3, cutoff=0.5)
+        hint = ""
+        if suggestions:
+            hint = "\nВозможно, имелось в виду: " + ", ".join(f"`{item}`" for item in suggestions)
+        await send_reply(message, f"❌ Модель `{model_id}` не найдена у провайдера {provider}.{hint}\nСписок: `{CMD_LIST_MODELS} {provider}`")
         return
+    if models is None:
+        log.warning("Model catalog unavailable, accepting model=%s without validation", model_id)
     if provider == "groq":
         GROQ_MODEL = model_id
         os.environ["GROQ_MODEL"] = model_id
+        await publish_runtime_setting("GROQ_MODEL", model_id)
         log.info(
             "Groq model updated peer_id=%s user_id=%s model=%s",
             message.peer_id,
@@ -1109,8 +4708,21 @@ async def set_model_handler(message: Message):
         )
         await send_reply(message, f"✅ Модель Groq изменена на: `{GROQ_MODEL}`")
         return
+    if provider == "mock":
+        MOCK_MODEL = model_id
+        os.environ["MOCK_MODEL"] = model_id
+        await publish_runtime_setting("MOCK_MODEL", model_id)
+        log.info(
+            "Mock model updated peer_id=%s user_id=%s model=%s",
+            message.peer_id,
+            message.from_id,
+            MOCK_MODEL,
+        )
+        await send_reply(message, f"✅ Модель Mock изменена на: `{MOCK_MODEL}`")
+        return
     VENICE_MODEL = model_id
     os.environ["VENICE_MODEL"] = model_id
+    await publish_runtime_setting("VENICE_MODEL", model_id)
     log.info(
         "Venice model updated peer_id=%s user_id=%s model=%s",
         message.peer_id,
@@ -1128,8 +4740,8 @@ async def set_provider_handler(message: Message):
     if not args:
         await send_reply(message, f"❌ Укажи провайдера!\nПример: `{CMD_SET_PROVIDER} groq`")
         return
-    if args not in ("groq", "venice"):
-        await send_reply(message, "❌ Неверный провайдер. Доступно: groq или venice.")
+    if args not in LLM_PROVIDERS:
+        await send_reply(message, "❌ Неверный провайдер. Доступно: groq, venice или mock.")
         return
     if args == "groq":
         if not GROQ_API_KEY:
@@ -1139,6 +4751,8 @@ async def set_provider_handler(message: Message):
             await send_reply(message, "❌ Пакет groq не установлен.")
             return
         groq_client = AsyncGroq(api_key=GROQ_API_KEY)
+    elif args == "mock":
+        groq_client = None
     else:
         if not VENICE_API_KEY:
             await send_reply(message, "❌ Не найден VENICE_API_KEY. Сначала задай ключ.")
@@ -1146,6 +4760,8 @@ async def set_provider_handler(message: Message):
         groq_client = None
     LLM_PROVIDER = args
     os.environ["LLM_PROVIDER"] = args
+    await publish_runtime_setting("LLM_PROVIDER", args)
+    model_catalog.schedule_refresh(args)
     log.info(
         "Provider updated peer_id=%s user_id=%s provider=%s",
         message.peer_id,
@@ -1168,6 +4784,9 @@ async def set_key_handler(message: Message):
         await send_reply(message, f"❌ Укажи провайдера и ключ!\nПример: `{CMD_SET_KEY} venice vnk_***`")
         return
     provider, key = parts[0].lower(), parts[1].strip()
+    if provider == "mock":
+        await send_reply(message, "❌ Провайдеру mock ключ не нужен.")
+        return
     if provider not in ("groq", "venice"):
         await send_reply(message, "❌ Неверный провайдер. Доступно: groq или venice.")
         return
@@ -1177,6 +4796,8 @@ async def set_key_handler(message: Message):
             return
         GROQ_API_KEY = key
         os.environ["GROQ_API_KEY"] = key
+        await publish_runtime_setting("GROQ_API_KEY", key)
+        model_catalog.invalidate("groq")
         log.info(
             "Groq API key updated peer_id=%s user_id=%s length=%s",
             message.peer_id,
@@ -1191,6 +4812,8 @@ async def set_key_handler(message: Message):
         return
     VENICE_API_KEY = key
     os.environ["VENICE_API_KEY"] = key
+    await publish_runtime_setting("VENICE_API_KEY", key)
+    model_catalog.invalidate("venice")
     log.info(
         "Venice API key updated peer_id=%s user_id=%s length=%s",
         message.peer_id,
@@ -1205,7 +4828,7 @@ async def set_key_handler(message: Message):
 async def set_temperature_handler(message: Message):
     if not await ensure_command_allowed(message, CMD_SET_TEMPERATURE):
         return
-    global GROQ_TEMPERATURE, VENICE_TEMPERATURE
+    global GROQ_TEMPERATURE, VENICE_TEMPERATURE, MOCK_TEMPERATURE
     args = strip_command(message.text, CMD_SET_TEMPERATURE)
     if not args:
         await send_reply(message, f"❌ Укажи температуру!\nПример: `{CMD_SET_TEMPERATURE} 0.9`")
@@ -1221,6 +4844,7 @@ async def set_temperature_handler(message: Message):
     if LLM_PROVIDER == "groq":
         GROQ_TEMPERATURE = value
         os.environ["GROQ_TEMPERATURE"] = str(value)
+        await publish_runtime_setting("GROQ_TEMPERATURE", value)
         log.info(
             "Groq temperature updated peer_id=%s user_id=%s value=%s",
             message.peer_id,
@@ -1229,8 +4853,21 @@ async def set_temperature_handler(message: Message):
         )
         await send_reply(message, f"✅ Температура Groq установлена: `{GROQ_TEMPERATURE}`")
         return
+    if LLM_PROVIDER == "mock":
+        MOCK_TEMPERATURE = value
+        os.environ["MOCK_TEMPERATURE"] = str(value)
+        await publish_runtime_setting("MOCK_TEMPERATURE", value)
+        log.info(
+            "Mock temperature updated peer_id=%s user_id=%s value=%s",
+            message.peer_id,
+            message.from_id,
+            MOCK_TEMPERATURE,
+        )
+        await send_reply(message, f"✅ Температура Mock установлена: `{MOCK_TEMPERATURE}`")
+        return
     VENICE_TEMPERATURE = value
     os.environ["VENICE_TEMPERATURE"] = str(value)
+    await publish_runtime_setting("VENICE_TEMPERATURE", value)
     log.info(
         "Venice temperature updated peer_id=%s user_id=%s value=%s",
         message.peer_id,
@@ -1245,8 +4882,8 @@ async def reset_daily_game(message: Message):
         return
     peer_id = message.peer_id
     today = datetime.datetime.now(MSK_TZ).date().isoformat()
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM daily_game WHERE peer_id = ? AND date = ?", (peer_id, today))
+    async with connect_db() as db:
+        await delete_game_result(db, peer_id, today)
         await db.commit()
     log.info("Daily game reset peer_id=%s user_id=%s date=%s", peer_id, message.from_id, today)
     await send_reply(message, f"✅ Результат сброшен! Можно начинать заново.\nКоманда {CMD_RUN} снова выберет пидора дня.")
@@ -1265,7 +4902,7 @@ async def set_schedule(message: Message):
     try:
         args = strip_command(message.text, CMD_TIME_SET)
         datetime.datetime.strptime(args, "%H:%M")
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with connect_db() as db:
             await db.execute(
                 "INSERT OR REPLACE INTO schedules (peer_id, time) VALUES (?, ?)", 
                 (message.peer_id, args)
@@ -1283,7 +4920,7 @@ async def set_schedule(message: Message):
 async def unset_schedule(message: Message):
     if not await ensure_command_allowed(message, CMD_TIME_RESET):
         return
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect_db() as db:
         await db.execute("DELETE FROM schedules WHERE peer_id = ?", (message.peer_id,))
         await db.commit()
     log.info("Schedule reset peer_id=%s user_id=%s", message.peer_id, message.from_id)
@@ -1305,7 +4942,7 @@ async def set_leaderboard_timer(message: Message):
         await send_reply(message, "❌ Неверная дата/время. Формат: ДД-ЧЧ-ММ (МСК)")
         return
     time_str = f"{hour:02d}:{minute:02d}"
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect_db() as db:
         await db.execute(
             "INSERT OR REPLACE INTO leaderboard_schedule (peer_id, day, time, last_run_month) VALUES (?, ?, ?, NULL)",
             (message.peer_id, day, time_str)
@@ -1324,13 +4961,169 @@ async def set_leaderboard_timer(message: Message):
 async def reset_leaderboard_timer(message: Message):
     if not await ensure_command_allowed(message, CMD_LEADERBOARD_TIMER_RESET):
         return
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect_db() as db:
         await db.execute("DELETE FROM leaderboard_schedule WHERE peer_id = ?", (message.peer_id,))
         await db.commit()
     log.info("Leaderboard timer reset peer_id=%s user_id=%s", message.peer_id, message.from_id)
     await send_reply(message, "✅ Таймер лидерборда сброшен.")
 
-@bot.on.message()
+@bot.on.message(StartswithRule(CMD_BACKFILL))
+async def backfill_handler(message: Message):
+    if not await ensure_admin_command(message, CMD_BACKFILL):
+        return
+    args = (message.text or "").strip()[len(CMD_BACKFILL):].strip().lower()
+    if args == "статус":
+        await send_reply(message, "\n".join(await describe_backfills()))
+        return
+    if args and not args.lstrip("-").isdigit():
+        await send_reply(message, f"Использование: `{CMD_BACKFILL} [peer_id]` или `{CMD_BACKFILL} статус`")
+        return
+    peer_id = int(args) if args else message.peer_id
+    if ALLOWED_PEER_IDS is not None and peer_id not in ALLOWED_PEER_IDS:
+        await send_reply(message, f"⛔ Чат `{peer_id}` не входит в разрешенные: {format_allowed_peers()}.")
+        return
+    if not await start_backfill(peer_id, reason=f"command user_id={message.from_id}"):
+        await send_reply(message, f"📥 Бэкфилл чата `{peer_id}` уже идет. Прогресс: `{CMD_BACKFILL} статус`")
+        return
+    await send_reply(
+        message,
+        f"📥 Бэкфилл чата `{peer_id}` поставлен в очередь: до {BACKFILL_MAX_MESSAGES} сообщений "
+        f"за {BACKFILL_MAX_DAYS} дн. Прогресс: `{CMD_BACKFILL} статус`",
+    )
+
+@bot.on.message(StartswithRule(CMD_BACKUP))
+async def backup_handler(message: Message):
+    if not await ensure_admin_command(message, CMD_BACKUP):
+        return
+    args = (message.text or "").strip()[len(CMD_BACKUP):].strip().lower()
+    if args == "статус":
+        await send_reply(message, "\n".join(await describe_backups()))
+        return
+    if args:
+        await send_reply(message, f"Использование: `{CMD_BACKUP}` или `{CMD_BACKUP} статус`")
+        return
+    created = await enqueue_job(
+        "backup",
+        message.peer_id,
+        {},
+        dedupe_key=f"backup:manual:{int(time.time())}",
+        max_attempts=2,
+    )
+    log.info("Manual backup requested peer_id=%s user_id=%s", message.peer_id, message.from_id)
+    if created:
+        await send_reply(message, "💾 Бэкап поставлен в очередь, сообщу о результате.")
+    else:
+        await send_reply(message, "💾 Бэкап уже в очереди.")
+
+@bot.on.message(StartswithRule(CMD_PROFILE))
+async def profile_handler(message: Message):
+    if not await ensure_admin_command(message, CMD_PROFILE):
+        return
+    global TRACE_ENABLED, cpu_profile_task
+    args = strip_command(message.text, CMD_PROFILE).lower().split()
+    usage = (
+        f"Использование: `{CMD_PROFILE}` — медленные трассы, `{CMD_PROFILE} вкл|выкл` — трассировка, "
+        f"`{CMD_PROFILE} сброс`, `{CMD_PROFILE} cpu [секунд]` — сэмплирующий профайлер"
+    )
+    if not args:
+        status = "включена" if TRACE_ENABLED else f"выключена (`{CMD_PROFILE} вкл` или TRACE_ENABLED=1)"
+        await send_reply(message, f"🔬 Трассировка: {status}\n\n{format_slow_traces()}")
+        return
+    if args[0] in ("вкл", "выкл") and len(args) == 1:
+        # Только этот процесс: в кластере у каждого воркера свои трассы
+        TRACE_ENABLED = args[0] == "вкл"
+        log.info("Tracing %s by user_id=%s", "enabled" if TRACE_ENABLED else "disabled", message.from_id)
+        await send_reply(message, f"✅ Трассировка {'включена' if TRACE_ENABLED else 'выключена'}.")
+        return
+    if args[0] == "сброс" and len(args) == 1:
+        slow_traces.clear()
+        await send_reply(message, "✅ Медленные трассы очищены.")
+        return
+    if args[0] != "cpu" or len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+        await send_reply(message, usage)
+        return
+    if cpu_profile_task is not None and not cpu_profile_task.done():
+        await send_reply(message, "⏳ Профайлер уже запущен.")
+        return
+    seconds = min(max(int(args[1]) if len(args) == 2 else 30, 1), PROFILE_MAX_SECONDS)
+    log.info("CPU profile requested user_id=%s seconds=%s", message.from_id, seconds)
+    await send_reply(message, f"🔬 Снимаю профиль {seconds} с, шаг {PROFILE_INTERVAL_MS} мс...")
+
+    async def profile_and_report():
+        try:
+            result = await run_cpu_profile(seconds)
+        except Exception as e:
+            log.exception("CPU profile failed: %s", e)
+            await send_reply(message, f"❌ Профиль не снят: {e}")
+            return
+        top = "\n".join(f"• {line}" for line in result["top"])
+        await send_reply(
+            message,
+            f"✅ Профиль: `{result['path']}`, {result['samples']} сэмплов за {result['elapsed']:.0f} с.\n"
+            f"Чаще всего на вершине стека:\n{top}",
+        )
+
+    cpu_profile_task = asyncio.create_task(profile_and_report())
+
+def format_retention_days(days: int) -> str:
+    return f"{days} дн." if days > 0 else "бессрочно"
+
+@bot.on.message(StartswithRule(CMD_DB_STATUS))
+async def db_status_handler(message: Message):
+    if not await ensure_admin_command(message, CMD_DB_STATUS):
+        return
+    args = (message.text or "").strip()[len(CMD_DB_STATUS):].strip().lower()
+    if args == "очистка":
+        if not is_retention_enabled():
+            await send_reply(message, "Хранение бессрочное: задайте RETENTION_MESSAGES_DAYS или RETENTION_BOT_DIALOGS_DAYS.")
+            return
+        await enqueue_job("retention", payload={}, dedupe_key=f"retention:manual:{int(time.time())}", max_attempts=1)
+        log.info("Manual retention requested user_id=%s", message.from_id)
+        await send_reply(message, "🧹 Очистка поставлена в очередь.")
+        return
+    if args:
+        await send_reply(message, f"Использование: `{CMD_DB_STATUS}` или `{CMD_DB_STATUS} очистка`")
+        return
+    tables = await collect_table_sizes()
+    file_size = os.path.getsize(DB_NAME) if os.path.exists(DB_NAME) else 0
+    lines = [f"🗄 **База данных:** `{format_bytes(file_size)}`", ""]
+    for entry in tables:
+        size_label = f", {format_bytes(entry['bytes'])}" if entry["bytes"] is not None else ""
+        lines.append(f"• `{entry['table']}`: {entry['rows']} строк{size_label}")
+    storage = await collect_storage_stats()
+    auto_vacuum_label = {0: "выкл", 1: "full", 2: "incremental"}.get(storage["auto_vacuum"], storage["auto_vacuum"])
+    lines.append("")
+    lines.append(
+        f"Страницы: {storage['page_count']} × {storage['page_size']} Б, свободных {storage['freelist_count']}, "
+        f"auto_vacuum {auto_vacuum_label}"
+    )
+    lines.append(f"WAL: `{format_bytes(storage['wal_bytes'])}`")
+    lines.append(format_compression_stats(await collect_compression_stats()))
+    if MAINTENANCE_ENABLED:
+        lines.append(f"Обслуживание (МСК): `{MAINTENANCE_WINDOW}`")
+        for step, last_run_at, duration_ms, result in storage["steps"]:
+            run_at = datetime.datetime.fromtimestamp(last_run_at, MSK_TZ).strftime("%Y-%m-%d %H:%M")
+            lines.append(f"• `{step}`: {run_at}, {duration_ms} мс, {result}")
+    else:
+        lines.append("Обслуживание: выключено")
+    lines.append("")
+    lines.append(
+        f"Хранение: messages — {format_retention_days(RETENTION_MESSAGES_DAYS)}, "
+        f"bot_dialogs — {format_retention_days(RETENTION_BOT_DIALOGS_DAYS)}"
+    )
+    if is_retention_enabled():
+        archive_label = ARCHIVE_DIR if ARCHIVE_ENABLED else "выключен"
+        lines.append(f"Очистка (МСК): `{RETENTION_TIME}`, архив: `{archive_label}`")
+    if last_retention_result:
+        removed = ", ".join(f"{table}={count}" for table, count in last_retention_result["removed"].items())
+        lines.append(
+            f"Последняя очистка: {last_retention_result['at']}, удалено {removed or 'ничего'}, "
+            f"освобождено страниц {last_retention_result['freed_pages']}"
+        )
+    await send_reply(message, "\n".join(lines))
+
+# Не блокирующий: иначе обработчик без правил забирает все сообщения и logger ниже не вызывается
+@bot.on.message(blocking=False)
 async def mention_reply_handler(message: Message):
     if not message.text:
         return
@@ -1359,58 +5152,61 @@ async def mention_reply_handler(message: Message):
         return
     if cleaned.lstrip().startswith("/"):
         return
-    try:
-        cleaned_for_llm = trim_chat_text(cleaned)
-        if not cleaned_for_llm:
-            await send_reply(message, "Напиши сообщение после упоминания.")
-            return
-        reply_text = extract_reply_text(message)
-        if reply_text:
-            reply_text = trim_chat_text(reply_text)
+    with start_trace("chat", peer_id=message.peer_id):
+        try:
+            cleaned_for_llm = trim_chat_text(cleaned)
+            if not cleaned_for_llm:
+                await send_reply(message, "Напиши сообщение после упоминания.")
+                return
+            reply_text = extract_reply_text(message)
             if reply_text:
-                cleaned_for_llm = f"Контекст реплая: {reply_text}\n\n{cleaned_for_llm}"
-        history_messages = await build_chat_history(message.peer_id, message.from_id)
-        history_user = sum(1 for item in history_messages if item["role"] == "user")
-        history_bot = len(history_messages) - history_user
-        log.debug(
-            "Chatbot context peer_id=%s user_id=%s history_user=%s history_bot=%s",
-            message.peer_id,
-            message.from_id,
-            history_user,
-            history_bot,
-        )
+                reply_text = trim_chat_text(reply_text)
+                if reply_text:
+                    cleaned_for_llm = f"Контекст реплая: {reply_text}\n\n{cleaned_for_llm}"
+            with trace_span("history"):
+                history_messages = await build_chat_history(message.peer_id, message.from_id)
+            history_user = sum(1 for item in history_messages if item["role"] == "user")
+            history_bot = len(history_messages) - history_user
+            log.debug(
+                "Chatbot context peer_id=%s user_id=%s history_user=%s history_bot=%s",
+                message.peer_id,
+                message.from_id,
+                history_user,
+                history_bot,
+            )
 
-        chat_messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
-        chat_messages.extend(history_messages)
-        chat_messages.append({"role": "user", "content": cleaned_for_llm})
-        response_text = await fetch_llm_messages(chat_messages, max_tokens=CHAT_MAX_TOKENS)
-        response_text = trim_text(response_text, CHAT_RESPONSE_MAX_CHARS)
-        if not response_text:
-            await send_reply(message, "❌ Ответ получился пустым. Попробуй позже.")
-            return
-        log.debug(
-            "Chatbot response peer_id=%s user_id=%s chars=%s",
-            message.peer_id,
-            message.from_id,
-            len(response_text),
-        )
-        await send_reply(message, response_text)
-        response_for_store = trim_text(response_text, BOT_REPLY_FULL_MAX_CHARS)
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute(
-                "INSERT INTO bot_dialogs (peer_id, user_id, role, text, timestamp) VALUES (?, ?, ?, ?, ?)",
-                (message.peer_id, message.from_id, "user", trim_chat_text(cleaned), message.date),
+            with trace_span("prompt"):
+                chat_messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
+                chat_messages.extend(history_messages)
+                chat_messages.append({"role": "user", "content": cleaned_for_llm})
+            response_text = await fetch_chat_response(chat_messages, max_tokens=CHAT_MAX_TOKENS)
+            response_text = trim_text(response_text, CHAT_RESPONSE_MAX_CHARS)
+            if not response_text:
+                await send_reply(message, "❌ Ответ получился пустым. Попробуй позже.")
+                return
+            log.debug(
+                "Chatbot response peer_id=%s user_id=%s chars=%s",
+                message.peer_id,
+                message.from_id,
+                len(response_text),
             )
-            if response_for_store:
-                now_ts = int(datetime.datetime.now(MSK_TZ).timestamp())
+            await send_reply(message, response_text, priority=SEND_PRIORITY_CHAT)
+            response_for_store = trim_text(response_text, BOT_REPLY_FULL_MAX_CHARS)
+            async with connect_db() as db:
                 await db.execute(
                     "INSERT INTO bot_dialogs (peer_id, user_id, role, text, timestamp) VALUES (?, ?, ?, ?, ?)",
-                    (message.peer_id, message.from_id, "assistant", response_for_store, now_ts),
+                    (message.peer_id, message.from_id, "user", trim_chat_text(cleaned), message.date),
                 )
-            await db.commit()
-    except Exception as e:
-        log.exception("Mention reply failed: %s", e)
-        await send_reply(message, "❌ Ошибка ответа. Попробуй позже.")
+                if response_for_store:
+                    now_ts = int(datetime.datetime.now(MSK_TZ).timestamp())
+                    await db.execute(
+                        "INSERT INTO bot_dialogs (peer_id, user_id, role, text, timestamp) VALUES (?, ?, ?, ?, ?)",
+                        (message.peer_id, message.from_id, "assistant", response_for_store, now_ts),
+                    )
+                await db.commit()
+        except Exception as e:
+            log.exception("Mention reply failed: %s", e)
+            await send_reply(message, "❌ Ошибка ответа. Попробуй позже.")
 
 @bot.on.message()
 async def logger(message: Message):
@@ -1423,11 +5219,14 @@ async def logger(message: Message):
         except Exception as e:
             log.debug("Failed to resolve username user_id=%s: %s", message.from_id, e)
             username = "Unknown"
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute(
-                "INSERT INTO messages (user_id, peer_id, text, timestamp, username) VALUES (?, ?, ?, ?, ?)",
-                (message.from_id, message.peer_id, message.text, message.date, username)
+        async with connect_db() as db:
+            # OR IGNORE: сообщение могло уже попасть в базу через бэкфилл
+            cursor = await db.execute(
+                "INSERT OR IGNORE INTO messages (user_id, peer_id, text, timestamp, username, conversation_message_id) VALUES (?, ?, ?, ?, ?, ?)",
+                (message.from_id, message.peer_id, message.text, message.date, username, message.conversation_message_id or None)
             )
+            if cursor.rowcount > 0:
+                await record_user_activity(db, message.peer_id, message.from_id, message.text, message.date)
             await db.commit()
 
 async def start_background_tasks():
@@ -1442,18 +5241,589 @@ async def start_background_tasks():
             log.info("Detected BOT_GROUP_ID=%s", BOT_GROUP_ID)
     except Exception as e:
         log.exception("Failed to load group id: %s", e)
+    model_catalog.schedule_refresh(LLM_PROVIDER)
+    if cluster_worker_index is None:
+        # В кластере события пишет ingress: воркеры получают уже разобранный поток
+        start_event_recorder()
+    if METRICS_ENABLED:
+        instrument_handlers()
+        # Воркеры кластера — отдельные процессы со своими счетчиками: порт супервизора + 1 + номер
+        if cluster_worker_index is None:
+            await start_metrics_server(METRICS_PORT)
+        elif METRICS_PORT:
+            await start_metrics_server(METRICS_PORT + 1 + cluster_worker_index)
+    if cluster_worker_index is not None:
+        await renew_scheduler_lease()
+        asyncio.create_task(cluster_heartbeat_loop())
+        asyncio.create_task(settings_sync_loop())
+    else:
+        await recover_jobs()
+    start_job_workers()
+    if BACKFILL_ON_START and ALLOWED_PEER_IDS and (cluster_worker_index is None or cluster_worker_index == 0):
+        for peer_id in ALLOWED_PEER_IDS:
+            await start_backfill(peer_id, reason="startup")
     asyncio.create_task(scheduler_loop())
 
+# ================= CALLBACK API =================
+update_queue = None
+recent_event_ids = OrderedDict()
+RECENT_EVENT_IDS_LIMIT = 1000
+
+async def dispatch_update(update: dict):
+    if cluster_queues:
+        if event_recorder is not None:
+            event_recorder.record_update(update)
+        await forward_update_to_worker(update)
+        return
+    await bot.router.route(update, bot.api)
+
+async def update_consumer():
+    while True:
+        update = await update_queue.get()
+        try:
+            await dispatch_update(update)
+        except Exception as e:
+            log.exception("Update handling failed type=%s: %s", update.get("type"), e)
+        finally:
+            update_queue.task_done()
+
+def is_duplicate_event(event_id) -> bool:
+    # VK повторяет событие, если не получил "ok" вовремя
+    if not event_id:
+        return False
+    if event_id in recent_event_ids:
+        return True
+    recent_event_ids[event_id] = True
+    while len(recent_event_ids) > RECENT_EVENT_IDS_LIMIT:
+        recent_event_ids.popitem(last=False)
+    return False
+
+def create_callback_app(confirmation_code: str, secret: str, group_id: int | None) -> web.Application:
+    async def handle_callback(request: web.Request) -> web.Response:
+        try:
+            payload = await request.json()
+        except Exception:
+            return web.Response(status=400, text="bad request")
+        if not isinstance(payload, dict):
+            return web.Response(status=400, text="bad request")
+        if group_id and payload.get("group_id") != group_id:
+            log.warning("Callback for foreign group_id=%s", payload.get("group_id"))
+            return web.Response(status=403, text="forbidden")
+        event_type = payload.get("type")
+        if event_type == "confirmation":
+            log.info("Callback confirmation requested group_id=%s", payload.get("group_id"))
+            return web.Response(text=confirmation_code)
+        # Пустой секрет не принимает ничего: события без проверки подлинности не обрабатываются
+        if not secret or payload.pop("secret", None) != secret:
+            log.warning("Callback secret mismatch type=%s", event_type)
+            return web.Response(status=403, text="forbidden")
+        if is_duplicate_event(payload.get("event_id")):
+            return web.Response(text="ok")
+        try:
+            update_queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            log.warning("Callback queue is full, asking VK to retry type=%s", event_type)
+            recent_event_ids.pop(payload.get("event_id"), None)
+            return web.Response(status=503, text="busy")
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(VK_CALLBACK_PATH, handle_callback)
+    return app
+
+async def run_callback_server():
+    global update_queue
+    confirmation_code = VK_CALLBACK_CONFIRMATION
+    if not confirmation_code and BOT_GROUP_ID:
+        try:
+            response = await bot.api.groups.get_callback_confirmation_code(group_id=BOT_GROUP_ID)
+            confirmation_code = response.code
+        except Exception as e:
+            log.exception("Failed to get callback confirmation code: %s", e)
+    if not confirmation_code:
+        log.error("Callback confirmation code is unknown, set VK_CALLBACK_CONFIRMATION")
+    update_queue = asyncio.Queue(maxsize=VK_CALLBACK_QUEUE_SIZE)
+    for _ in range(VK_CALLBACK_WORKERS):
+        asyncio.create_task(update_consumer())
+    runner = web.AppRunner(create_callback_app(confirmation_code, VK_CALLBACK_SECRET, BOT_GROUP_ID))
+    await runner.setup()
+    site = web.TCPSite(runner, VK_CALLBACK_HOST, VK_CALLBACK_PORT)
+    await site.start()
+    log.info("Callback API listening on %s:%s%s", VK_CALLBACK_HOST, VK_CALLBACK_PORT, VK_CALLBACK_PATH)
+    await asyncio.Event().wait()
+
+# ================= КЛАСТЕР =================
+# Супервизор принимает события (long poll или callback) и раздает их воркерам по хэшу peer_id.
+# Таймеры запускает только воркер, который держит аренду в таблице cluster_lease.
+cluster_queues = None
+cluster_control_queue = None
+cluster_worker_index = None
+scheduler_lease_until = 0.0
+settings_version = 0
+SCHEDULER_LEASE_NAME = "scheduler"
+RUNTIME_SETTING_NAMES = (
+    "LLM_PROVIDER",
+    "GROQ_MODEL",
+    "VENICE_MODEL",
+    "MOCK_MODEL",
+    "GROQ_TEMPERATURE",
+    "VENICE_TEMPERATURE",
+    "MOCK_TEMPERATURE",
+    "USER_PROMPT_TEMPLATE",
+)
+# Ключи не пишутся в базу (она попадает в бэкапы): воркер отдает их супервизору через
+# cluster_control_queue, тот держит их в памяти и рассылает остальным воркерам через их очереди
+SECRET_SETTING_NAMES = ("GROQ_API_KEY", "VENICE_API_KEY")
+CLUSTER_SETTING_EVENT = "cluster_setting"
+
+def is_scheduler_leader() -> bool:
+    if cluster_worker_index is None:
+        return True
+    return time.monotonic() < scheduler_lease_until
+
+def get_update_peer_id(update: dict) -> int:
+    obj = update.get("object") or {}
+    message = obj.get("message") if isinstance(obj, dict) else None
+    source = message if isinstance(message, dict) else obj
+    if not isinstance(source, dict):
+        return 0
+    peer_id = source.get("peer_id") or source.get("user_id") or source.get("from_id") or 0
+    try:
+        return int(peer_id)
+    except (TypeError, ValueError):
+        return 0
+
+async def forward_update_to_worker(update: dict):
+    index = get_update_peer_id(update) % len(cluster_queues)
+    queue = cluster_queues[index]
+    try:
+        queue.put_nowait(update)
+    except Exception:
+        # Очередь воркера переполнена: ждем в потоке, не блокируя прием событий
+        log.warning("Cluster worker %s queue is full, waiting", index)
+        await asyncio.to_thread(queue.put, update)
+
+async def renew_scheduler_lease():
+    global scheduler_lease_until
+    now = time.time()
+    try:
+        async with connect_db() as db:
+            await db.execute(
+                """
+                INSERT INTO cluster_lease (name, holder, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE cluster_lease.holder = excluded.holder OR cluster_lease.expires_at < ?
+                """,
+                (SCHEDULER_LEASE_NAME, CLUSTER_NODE_ID, now + CLUSTER_LEASE_TTL, now),
+            )
+            await db.commit()
+            cursor = await db.execute("SELECT holder FROM cluster_lease WHERE name = ?", (SCHEDULER_LEASE_NAME,))
+            row = await cursor.fetchone()
+    except Exception as e:
+        log.warning("Lease renewal failed node=%s: %s", CLUSTER_NODE_ID, e)
+        return
+    was_leader = is_scheduler_leader()
+    if row and row[0] == CLUSTER_NODE_ID:
+        # Локальный срок короче серверного, чтобы не пересечься с новым лидером
+        scheduler_lease_until = time.monotonic() + CLUSTER_LEASE_TTL - CLUSTER_HEARTBEAT
+        if not was_leader:
+            log.info("Scheduler leadership acquired node=%s", CLUSTER_NODE_ID)
+    else:
+        scheduler_lease_until = 0.0
+        if was_leader:
+            log.warning("Scheduler leadership lost node=%s holder=%s", CLUSTER_NODE_ID, row[0] if row else None)
+
+async def release_scheduler_lease():
+    async with connect_db() as db:
+        await db.execute(
+            "DELETE FROM cluster_lease WHERE name = ? AND holder = ?",
+            (SCHEDULER_LEASE_NAME, CLUSTER_NODE_ID),
+        )
+        await db.commit()
+
+async def cluster_heartbeat_loop():
+    while True:
+        await asyncio.sleep(CLUSTER_HEARTBEAT)
+        await renew_scheduler_lease()
+
+def apply_runtime_setting(name: str, value: str):
+    global groq_client
+    if name not in RUNTIME_SETTING_NAMES and name not in SECRET_SETTING_NAMES:
+        return
+    if name in ("GROQ_TEMPERATURE", "VENICE_TEMPERATURE", "MOCK_TEMPERATURE"):
+        globals()[name] = float(value)
+    else:
+        globals()[name] = value
+    os.environ[name] = str(value)
+    if name in ("LLM_PROVIDER", "GROQ_API_KEY"):
+        if LLM_PROVIDER == "groq" and GROQ_API_KEY and AsyncGroq is not None:
+            groq_client = AsyncGroq(api_key=GROQ_API_KEY)
+        elif LLM_PROVIDER != "groq":
+            groq_client = None
+    if name == "GROQ_API_KEY":
+        model_catalog.invalidate("groq")
+    elif name == "VENICE_API_KEY":
+        model_catalog.invalidate("venice")
+
+async def publish_runtime_setting(name: str, value):
+    global settings_version
+    if cluster_worker_index is None:
+        return
+    if name in SECRET_SETTING_NAMES:
+        cluster_control_queue.put({"worker": cluster_worker_index, "name": name, "value": str(value)})
+        log.debug("Secret setting sent to supervisor name=%s", name)
+        return
+    try:
+        async with connect_db() as db:
+            cursor = await db.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM runtime_settings")
+            version = (await cursor.fetchone())[0]
+            await db.execute(
+                "INSERT OR REPLACE INTO runtime_settings (name, value, version, updated_by, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (name, str(value), version, CLUSTER_NODE_ID, int(time.time())),
+            )
+            await db.commit()
+    except Exception as e:
+        log.exception("Failed to publish runtime setting %s: %s", name, e)
+        return
+    settings_version = max(settings_version, version)
+    log.debug("Runtime setting published name=%s version=%s", name, version)
+
+async def sync_runtime_settings():
+    global settings_version
+    async with connect_db() as db:
+        cursor = await db.execute(
+            "SELECT name, value, version, updated_by FROM runtime_settings WHERE version > ? ORDER BY version",
+            (settings_version,),
+        )
+        rows = await cursor.fetchall()
+    for name, value, version, updated_by in rows:
+        settings_version = max(settings_version, version)
+        if updated_by == CLUSTER_NODE_ID or name not in RUNTIME_SETTING_NAMES:
+            continue
+        apply_runtime_setting(name, value)
+        log.info("Runtime setting applied name=%s version=%s from=%s", name, version, updated_by)
+
+async def settings_sync_loop():
+    while True:
+        try:
+            await sync_runtime_settings()
+        except Exception as e:
+            log.warning("Runtime settings sync failed: %s", e)
+        await asyncio.sleep(CLUSTER_SETTINGS_POLL)
+
+async def run_cluster_worker(index: int, queue):
+    await start_background_tasks()
+    await sync_runtime_settings()
+    log.info("Cluster worker started index=%s node=%s", index, CLUSTER_NODE_ID)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            if update.get("type") == CLUSTER_SETTING_EVENT:
+                apply_runtime_setting(update["name"], update["value"])
+                log.info("Secret setting applied name=%s", update["name"])
+                continue
+            asyncio.create_task(dispatch_update(update))
+    finally:
+        await release_scheduler_lease()
+
+def reset_forked_worker_state():
+    global cluster_queues, event_recorder
+    # Воркер, перезапущенный супервизором, наследует его очереди и запись событий.
+    # Без сброса dispatch_update пересылал бы события по кругу вместо обработки
+    cluster_queues = None
+    if event_recorder is not None:
+        event_recorder.detach()
+        event_recorder = None
+    # Сессия aiohttp, очередь отправки и окно execute привязаны к циклу супервизора, который
+    # к этому моменту уже ходил в VK. Старый клиент-синглтон не закрываем: его сокеты общие с родителем
+    bot.api.http_client = AiohttpClient()
+    bot.api.pending = []
+    bot.api.flush_handle = None
+    vk_send_queue.queue = None
+    vk_send_queue.worker_tasks = []
+
+def cluster_worker_main(index: int, queue):
+    global cluster_worker_index, CLUSTER_NODE_ID
+    reset_forked_worker_state()
+    # Лимит VK общий на токен сообщества: каждый воркер получает свою долю
+    vk_send_queue.bucket = TokenBucket(VK_SEND_RATE / CLUSTER_WORKERS, max(1, VK_SEND_BURST // CLUSTER_WORKERS))
+    cluster_worker_index = index
+    CLUSTER_NODE_ID = f"{socket.gethostname()}:{os.getpid()}:w{index}"
+    try:
+        asyncio.run(run_cluster_worker(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+async def prepare_cluster_db():
+    await init_db()
+    await recover_jobs()
+    async with connect_db() as db:
+        # Настройки из команд живут, пока жив кластер, как и в одиночном режиме
+        await db.execute("DELETE FROM runtime_settings")
+        await db.commit()
+
+async def relay_cluster_setting(setting: dict):
+    # Супервизор тоже применяет ключ: воркер, перезапущенный через fork, получит его вместе с памятью
+    apply_runtime_setting(setting["name"], setting["value"])
+    event = {"type": CLUSTER_SETTING_EVENT, "name": setting["name"], "value": setting["value"]}
+    for index, queue in enumerate(cluster_queues):
+        if index != setting["worker"]:
+            await asyncio.to_thread(queue.put, event)
+    log.info("Secret setting relayed name=%s from worker %s", setting["name"], setting["worker"])
+
+async def relay_cluster_settings():
+    loop = asyncio.get_running_loop()
+    while True:
+        setting = await loop.run_in_executor(None, cluster_control_queue.get)
+        try:
+            await relay_cluster_setting(setting)
+        except Exception as e:
+            log.exception("Failed to relay secret setting %s: %s", setting.get("name"), e)
+
+def restart_dead_workers(context, processes: list):
+    for index, process in enumerate(processes):
+        if not process.is_alive():
+            log.error("Cluster worker %s exited with code %s, restarting", index, process.exitcode)
+            # Воркер, убитый внутри queue.get, навсегда держит блокировку чтения очереди,
+            # поэтому замена получает новую очередь, а события из старой теряются
+            try:
+                lost = cluster_queues[index].qsize()
+            except NotImplementedError:
+                lost = "unknown"
+            if lost:
+                log.warning("Cluster worker %s dropped %s queued updates", index, lost)
+            cluster_queues[index] = context.Queue(maxsize=CLUSTER_QUEUE_SIZE)
+            processes[index] = context.Process(
+                target=cluster_worker_main,
+                args=(index, cluster_queues[index]),
+                daemon=True,
+            )
+            processes[index].start()
+
+async def run_cluster_ingress(context, processes: list):
+    global BOT_GROUP_ID
+    try:
+        BOT_GROUP_ID = extract_group_id(await bot.api.groups.get_by_id())
+    except Exception as e:
+        log.exception("Failed to load group id: %s", e)
+    start_event_recorder()
+    await start_metrics_server(METRICS_PORT)
+
+    async def watch_workers():
+        while True:
+            await asyncio.sleep(5)
+            restart_dead_workers(context, processes)
+
+    asyncio.create_task(watch_workers())
+    asyncio.create_task(relay_cluster_settings())
+    if VK_CALLBACK_ENABLED:
+        await run_callback_server()
+        return
+    log.info("Cluster ingress polling started workers=%s", len(processes))
+    async for event in bot.polling.listen():
+        for update in event.get("updates", []):
+            await dispatch_update(update)
+
+def run_cluster_supervisor():
+    global cluster_queues, cluster_control_queue
+    asyncio.run(prepare_cluster_db())
+    context = multiprocessing.get_context("fork")
+    cluster_control_queue = context.Queue()
+    queues = [context.Queue(maxsize=CLUSTER_QUEUE_SIZE) for _ in range(CLUSTER_WORKERS)]
+    processes = []
+    for index, queue in enumerate(queues):
+        process = context.Process(target=cluster_worker_main, args=(index, queue), daemon=True)
+        process.start()
+        processes.append(process)
+    cluster_queues = queues
+    log.info("Cluster supervisor started workers=%s", CLUSTER_WORKERS)
+    try:
+        asyncio.run(run_cluster_ingress(context, processes))
+    except KeyboardInterrupt:
+        log.info("Cluster supervisor stopping")
+    finally:
+        for queue in queues:
+            try:
+                queue.put_nowait(None)
+            except Exception:
+                pass
+        for process in processes:
+            process.join(timeout=5)
+
+# ================= ЭКСПОРТ =================
+# python bot.py export --peer 2000000001 --since 2026-01-01 --format jsonl
+# Читает базу через отдельное read-only соединение пачками fetchmany: память не растет
+# с объемом выгрузки, а писатель бота не блокируется (WAL).
+EXPORT_TABLES = {
+    "messages": {
+        "columns": ("user_id", "peer_id", "text", "timestamp", "username", "conversation_message_id"),
+        "time_column": "timestamp",
+    },
+    "daily_game": {
+        "columns": ("peer_id", "date", "winner_id", "reason"),
+        "time_column": "date",
+    },
+    "bot_dialogs": {
+        "columns": ("id", "peer_id", "user_id", "role", "text", "timestamp"),
+        "time_column": "timestamp",
+    },
+}
+EXPORT_BATCH_SIZE = 5000
+EXPORT_TEXT_COLUMNS = {"text", "username", "date", "reason", "role"}
+
+def build_export_query(table: str, peer_id: int | None, since: datetime.date | None, until: datetime.date | None, as_json: bool = False) -> tuple:
+    spec = EXPORT_TABLES[table]
+    expressions = [text_sql() if column == "text" else column for column in spec["columns"]]
+    if as_json:
+        # JSON собирает SQLite: это вдвое быстрее, чем json.dumps на каждую строку в Python
+        select = "json_object(" + ", ".join(f"'{column}', {expression}" for column, expression in zip(spec["columns"], expressions)) + ")"
+    else:
+        select = ", ".join(expressions)
+    time_column = spec["time_column"]
+    conditions = []
+    params = []
+    if peer_id is not None:
+        conditions.append("peer_id = ?")
+        params.append(peer_id)
+    for bound, operator in ((since, ">="), (until, "<")):
+        if bound is None:
+            continue
+        conditions.append(f"{time_column} {operator} ?")
+        if time_column == "date":
+            params.append(bound.isoformat())
+        else:
+            params.append(int(datetime.datetime.combine(bound, datetime.time(), MSK_TZ).timestamp()))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT {select} FROM {table} {where} ORDER BY {time_column}", params
+
+def iter_export_batches(connection, table: str, peer_id, since, until, as_json: bool = False):
+    query, params = build_export_query(table, peer_id, since, until, as_json=as_json)
+    cursor = connection.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        yield rows
+
+def write_export_jsonl(path: str, columns: tuple, batches, level: int) -> int:
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=level) as target:
+        for rows in batches:
+            target.write("\n".join(row[0] for row in rows) + "\n")
+            count += len(rows)
+    return count
+
+def write_export_csv(path: str, columns: tuple, batches, level: int) -> int:
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=level) as target:
+        writer = csv.writer(target)
+        writer.writerow(columns)
+        for rows in batches:
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+def write_export_parquet(path: str, columns: tuple, batches, level: int) -> int:
+    import pyarrow
+    import pyarrow.parquet
+
+    # Схема задается явно: иначе пачка, где колонка целиком NULL, получит другой тип
+    schema = pyarrow.schema(
+        [(column, pyarrow.string() if column in EXPORT_TEXT_COLUMNS else pyarrow.int64()) for column in columns]
+    )
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema, compression="zstd") as writer:
+        for rows in batches:
+            table = pyarrow.Table.from_pydict(
+                {column: [row[index] for row in rows] for index, column in enumerate(columns)},
+                schema=schema,
+            )
+            writer.write_table(table)
+            count += len(rows)
+    return count
+
+EXPORT_WRITERS = {
+    "jsonl": (write_export_jsonl, "jsonl.gz"),
+    "csv": (write_export_csv, "csv.gz"),
+    "parquet": (write_export_parquet, "parquet"),
+}
+
+def parse_export_date(value: str) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается дата YYYY-MM-DD: {value}")
+
+def run_export_cli(argv: list) -> int:
+    parser = argparse.ArgumentParser(prog="bot.py export", description="Выгрузка истории чата и игры")
+    parser.add_argument("--peer", type=int, help="peer_id чата (по умолчанию все)")
+    parser.add_argument("--since", type=parse_export_date, help="с даты включительно, МСК")
+    parser.add_argument("--until", type=parse_export_date, help="до даты не включительно, МСК")
+    parser.add_argument("--tables", default=",".join(EXPORT_TABLES), help="таблицы через запятую")
+    parser.add_argument("--format", choices=tuple(EXPORT_WRITERS), default="jsonl")
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(DB_NAME) or ".", "export"))
+    parser.add_argument("--compresslevel", type=int, default=4, choices=range(1, 10), metavar="1-9")
+    args = parser.parse_args(argv)
+
+    tables = [table.strip() for table in args.tables.split(",") if table.strip()]
+    unknown = [table for table in tables if table not in EXPORT_TABLES]
+    if unknown:
+        parser.error(f"неизвестные таблицы: {', '.join(unknown)}")
+    if args.format == "parquet":
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            parser.error("для --format parquet установите pyarrow")
+    writer, extension = EXPORT_WRITERS[args.format]
+    os.makedirs(args.out, exist_ok=True)
+    # mode=ro: экспорт ничего не пишет и не берет блокировку записи
+    connection = sqlite3.connect(f"file:{os.path.abspath(DB_NAME)}?mode=ro", uri=True)
+    connection.create_function("text_unzip", 2, text_unzip, deterministic=True)
+    try:
+        scope = str(args.peer) if args.peer is not None else "all"
+        range_label = f"{args.since or 'start'}_{args.until or 'now'}"
+        for table in tables:
+            started = time.perf_counter()
+            path = os.path.join(args.out, f"{table}-{scope}-{range_label}.{extension}")
+            batches = iter_export_batches(connection, table, args.peer, args.since, args.until, as_json=args.format == "jsonl")
+            count = writer(path, EXPORT_TABLES[table]["columns"], batches, args.compresslevel)
+            log.info(
+                "Exported table=%s rows=%s path=%s size=%s duration=%.1fs",
+                table,
+                count,
+                path,
+                os.path.getsize(path) if os.path.exists(path) else 0,
+                time.perf_counter() - started,
+            )
+    finally:
+        connection.close()
+    return 0
+
+if __name__ == "__main__" and sys.argv[1:2] == ["export"]:
+    sys.exit(run_export_cli(sys.argv[2:]))
+
 if __name__ == "__main__":
+    validate_startup_config()
     log.info("Starting %s bot...", GAME_TITLE)
     allowed_peers_label = "all" if ALLOWED_PEER_IDS is None else format_allowed_peers()
     log.info(
-        "Config provider=%s allowed_peers=%s chatbot_enabled=%s",
+        "Config provider=%s allowed_peers=%s chatbot_enabled=%s ingest=%s",
         LLM_PROVIDER,
         allowed_peers_label,
         CHATBOT_ENABLED,
+        "callback" if VK_CALLBACK_ENABLED else "longpoll",
     )
+    if CLUSTER_WORKERS > 1:
+        run_cluster_supervisor()
+        sys.exit(0)
     bot.loop_wrapper.on_startup.append(start_background_tasks())
-    bot.run_forever()
+    if VK_CALLBACK_ENABLED:
+        bot.loop_wrapper.add_task(run_callback_server())
+        bot.loop_wrapper.run()
+    else:
+        bot.run_forever()
 
 
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+TEST_DIR = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.setdefault("VK_TOKEN", "test-token")
+os.environ.setdefault("LLM_PROVIDER", "mock")
+os.environ.setdefault("USER_PROMPT_TEMPLATE", "{{CHAT_LOG}}")
+os.environ["DB_PATH"] = os.path.join(TEST_DIR, "bot.db")
+os.environ["EVENT_RECORD_PATH"] = ""
+os.environ["METRICS_PORT"] = "0"
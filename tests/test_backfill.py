@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+import bot as app
+
+PEER_ID = 2000000001
+
+
+@pytest.fixture
+def db_path(monkeypatch, tmp_path):
+    path = str(tmp_path / "backfill.db")
+    monkeypatch.setattr(app, "DB_NAME", path)
+    asyncio.run(app.init_db())
+    return path
+
+
+async def load_jobs():
+    async with app.connect_db() as db:
+        cursor = await db.execute("SELECT dedupe_key, state FROM jobs WHERE kind = 'backfill' ORDER BY id")
+        return await cursor.fetchall()
+
+
+def test_repeated_start_does_not_fork_the_chain(db_path):
+    async def scenario():
+        assert await app.start_backfill(PEER_ID, "command")
+        state = await app.load_backfill_state(PEER_ID)
+        first_key = app.get_backfill_job_key(state)
+        assert await load_jobs() == [(first_key, "queued")]
+        # Повторный /бэкфилл и BACKFILL_ON_START при рестарте
+        assert not await app.start_backfill(PEER_ID, "command")
+        assert not await app.start_backfill(PEER_ID, "startup")
+        assert await load_jobs() == [(first_key, "queued")]
+
+        # Срез прошел две страницы и поставил продолжение тем же форматом ключа
+        async with app.connect_db() as db:
+            await db.execute("UPDATE jobs SET state = 'done'")
+            await db.commit()
+        state["pages"] = 2
+        await app.save_backfill_state(state)
+        assert await app.enqueue_backfill_slice(state)
+        next_key = app.get_backfill_job_key(state)
+        assert not await app.start_backfill(PEER_ID, "startup")
+        assert await load_jobs() == [(first_key, "done"), (next_key, "queued")]
+
+        # Звено упало после всех попыток: запуск перезапускает его, а не строит новую цепочку
+        async with app.connect_db() as db:
+            await db.execute("UPDATE jobs SET state = 'failed', attempts = 3 WHERE dedupe_key = ?", (next_key,))
+            await db.commit()
+        assert await app.start_backfill(PEER_ID, "command")
+        assert await load_jobs() == [(first_key, "done"), (next_key, "queued")]
+
+    asyncio.run(scenario())
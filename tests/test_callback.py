@@ -0,0 +1,63 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot as app
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+from fake_vk_callback import build_message_event  # noqa: E402
+
+GROUP_ID = 1
+
+
+def post_events(secret: str, events: list) -> tuple:
+    async def scenario():
+        app.update_queue = asyncio.Queue()
+        app.recent_event_ids.clear()
+        client = TestClient(TestServer(app.create_callback_app("confirm-code", secret, GROUP_ID)))
+        await client.start_server()
+        try:
+            statuses = []
+            for event in events:
+                response = await client.post(app.VK_CALLBACK_PATH, json=event)
+                statuses.append((response.status, await response.text()))
+            return statuses, app.update_queue.qsize()
+        finally:
+            await client.close()
+
+    return asyncio.run(scenario())
+
+
+def forged_admin_command(secret):
+    return build_message_event(GROUP_ID, 2000000001, app.ADMIN_USER_ID or 1, "/бэкап", 1, secret)
+
+
+def test_callback_rejects_events_without_matching_secret(monkeypatch):
+    monkeypatch.setattr(app, "update_queue", None)
+    statuses, queued = post_events("s3cret", [
+        {"type": "confirmation", "group_id": GROUP_ID},
+        forged_admin_command(None),
+        forged_admin_command("wrong"),
+        forged_admin_command("s3cret"),
+    ])
+    assert statuses == [(200, "confirm-code"), (403, "forbidden"), (403, "forbidden"), (200, "ok")]
+    assert queued == 1
+
+
+def test_callback_without_secret_drops_every_event(monkeypatch):
+    monkeypatch.setattr(app, "update_queue", None)
+    statuses, queued = post_events("", [forged_admin_command(None), forged_admin_command("")])
+    assert statuses == [(403, "forbidden"), (403, "forbidden")]
+    assert queued == 0
+
+
+def test_callback_mode_requires_secret_to_start(monkeypatch):
+    monkeypatch.setattr(app, "VK_CALLBACK_ENABLED", True)
+    monkeypatch.setattr(app, "VK_CALLBACK_SECRET", "")
+    with pytest.raises(SystemExit):
+        app.validate_startup_config()
+    monkeypatch.setattr(app, "VK_CALLBACK_SECRET", "s3cret")
+    app.validate_startup_config()
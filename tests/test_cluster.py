@@ -0,0 +1,128 @@
+import asyncio
+import gzip
+import json
+import multiprocessing
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from vkbottle.http import AiohttpClient
+
+import bot as app
+
+
+class FakeVKHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.calls.append(self.path.split("?")[0].rsplit("/", 1)[-1])
+        body = json.dumps({"response": 1 if self.path.startswith("/method/messages.send") else []}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_vk(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeVKHandler)
+    server.calls = multiprocessing.Manager().list()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(app.bot.api, "API_URL", f"http://127.0.0.1:{server.server_port}/method/")
+    monkeypatch.setattr(app.bot.api, "http_client", AiohttpClient())
+    monkeypatch.setattr(app, "vk_send_queue", app.VkSendQueue(100, 5, 1, 0, 0))
+    yield server
+    server.shutdown()
+
+
+def test_replacement_worker_routes_updates(monkeypatch, tmp_path, fake_vk):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+
+    async def fake_run_cluster_worker(index, queue):
+        async def route(update, api):
+            # Ответ идет через очередь отправки и HTTP-клиент, унаследованные от супервизора
+            sent = await app.vk_send_queue.send(update["object"]["message"]["peer_id"], "ответ")
+            results.put(("routed", index, app.event_recorder is None, sent))
+
+        async def forward(update):
+            results.put(("forwarded", index, app.event_recorder is None, False))
+
+        app.bot.router.route = route
+        app.forward_update_to_worker = forward
+        bucket = app.vk_send_queue.bucket
+        assert (bucket.rate, bucket.capacity) == (app.VK_SEND_RATE / 4, 1)
+        update = await asyncio.get_running_loop().run_in_executor(None, queue.get)
+        await app.dispatch_update(update)
+
+    monkeypatch.setattr(app, "run_cluster_worker", fake_run_cluster_worker)
+    monkeypatch.setattr(app, "CLUSTER_WORKERS", 4)
+    queues = [context.Queue()]
+    processes = [context.Process(target=app.cluster_worker_main, args=(0, queues[0]), daemon=True)]
+    processes[0].start()
+
+    # Состояние супервизора после старта воркеров: очереди и запись событий
+    recorder = app.EventRecorder(str(tmp_path / "events.jsonl.gz"), 1024 * 1024)
+    assert recorder.open()
+    monkeypatch.setattr(app, "cluster_queues", queues)
+    monkeypatch.setattr(app, "event_recorder", recorder)
+
+    async def supervisor():
+        # Как run_cluster_ingress: супервизор уже ходил в VK, и сессия привязана к его циклу
+        await app.bot.api.request("groups.getById", {})
+        assert await app.vk_send_queue.send(2000000002, "из супервизора")
+        processes[0].kill()
+        processes[0].join(5)
+        app.restart_dead_workers(context, processes)
+        queues[0].put({"type": "message_new", "object": {"message": {"peer_id": 2000000001}}})
+        try:
+            return await asyncio.to_thread(results.get, True, 15)
+        finally:
+            await app.bot.api.http_client.close()
+
+    try:
+        assert asyncio.run(supervisor()) == ("routed", 0, True, True)
+    finally:
+        processes[0].join(5)
+        if processes[0].is_alive():
+            processes[0].kill()
+    assert list(fake_vk.calls) == ["groups.getById", "messages.send", "messages.send"]
+
+    # Копия gzip-файла в воркере не должна была ничего дописать в файл супервизора
+    recorder.close()
+    with gzip.open(tmp_path / "events.jsonl.gz", "rt", encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 1 and lines[0]["format"] == 1
+
+
+def test_secret_settings_skip_database(monkeypatch):
+    control = multiprocessing.get_context("fork").Queue()
+    monkeypatch.setattr(app, "cluster_worker_index", 1)
+    monkeypatch.setattr(app, "cluster_control_queue", control)
+    monkeypatch.setattr(app, "VENICE_API_KEY", app.VENICE_API_KEY)
+    monkeypatch.setenv("VENICE_API_KEY", "")
+
+    async def scenario():
+        await app.init_db()
+        await app.publish_runtime_setting("VENICE_API_KEY", "secret-key")
+        await app.publish_runtime_setting("VENICE_MODEL", app.VENICE_MODEL)
+        async with app.connect_db() as db:
+            cursor = await db.execute("SELECT name FROM runtime_settings")
+            return [row[0] for row in await cursor.fetchall()]
+
+    assert asyncio.run(scenario()) == ["VENICE_MODEL"]
+    setting = control.get(timeout=5)
+    assert setting == {"worker": 1, "name": "VENICE_API_KEY", "value": "secret-key"}
+
+    queues = [multiprocessing.get_context("fork").Queue() for _ in range(3)]
+    monkeypatch.setattr(app, "cluster_queues", queues)
+    asyncio.run(app.relay_cluster_setting(setting))
+    assert app.VENICE_API_KEY == "secret-key"
+    event = {"type": app.CLUSTER_SETTING_EVENT, "name": "VENICE_API_KEY", "value": "secret-key"}
+    assert queues[0].get(timeout=5) == event
+    assert queues[2].get(timeout=5) == event
+    assert queues[1].empty()
@@ -0,0 +1,34 @@
+import asyncio
+import gzip
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+import bot as app
+
+
+def test_export_runs_without_bot_secrets(monkeypatch, tmp_path):
+    db_path = str(tmp_path / "export.db")
+    monkeypatch.setattr(app, "DB_NAME", db_path)
+    asyncio.run(app.init_db())
+    connection = sqlite3.connect(db_path)
+    connection.execute("INSERT INTO messages (user_id, peer_id, text, timestamp, username) VALUES (7, 2000000001, 'привет', 1767225600, 'user7')")
+    connection.commit()
+    connection.close()
+
+    env = {key: value for key, value in os.environ.items() if key not in ("VK_TOKEN", "GROQ_API_KEY", "VENICE_API_KEY", "USER_PROMPT_TEMPLATE")}
+    env.update({"DB_PATH": db_path, "LLM_PROVIDER": "groq"})
+    out_dir = tmp_path / "out"
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(app.__file__), "export", "--tables", "messages", "--out", str(out_dir)],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr[-2000:]
+    with gzip.open(out_dir / "messages-all-start_now.jsonl.gz", "rt", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f]
+    assert [(row["user_id"], row["text"]) for row in rows] == [(7, "привет")]
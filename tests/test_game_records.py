@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+
+import pytest
+
+import bot as app
+
+PEER_ID = 2000000001
+
+
+def play(dates_and_winners):
+    record = {}
+    for date_value in dates_and_winners:
+        app.apply_game_win(record, date_value)
+    return record
+
+
+def test_apply_game_win_counts_consecutive_days():
+    record = play(["2026-03-01", "2026-03-02", "2026-03-03"])
+    assert record["current_streak"] == 3
+    assert record["best_streak"] == 3
+    assert record["total_wins"] == 3
+    assert record["new_best_streak"] is True
+
+
+def test_apply_game_win_gap_resets_streak_and_keeps_best():
+    record = play(["2026-03-01", "2026-03-02", "2026-03-04"])
+    assert record["current_streak"] == 1
+    assert record["best_streak"] == 2
+    assert record["new_best_streak"] is False
+    assert record["last_win_date"] == "2026-03-04"
+
+
+def test_apply_game_win_streak_crosses_month_and_year():
+    record = play(["2025-12-30", "2025-12-31", "2026-01-01"])
+    assert record["current_streak"] == 3
+    assert record["current_month"] == "2026-01"
+    assert record["current_month_wins"] == 1
+    assert (record["best_month"], record["best_month_wins"]) == ("2025-12", 2)
+
+
+def test_apply_game_win_month_rollover_tracks_best_month():
+    record = play(["2026-01-05", "2026-01-20", "2026-02-01", "2026-02-02", "2026-02-10"])
+    assert (record["current_month"], record["current_month_wins"]) == ("2026-02", 3)
+    assert (record["best_month"], record["best_month_wins"]) == ("2026-02", 3)
+    # Ничья по месяцам оставляет рекордом более ранний месяц
+    record = play(["2026-01-05", "2026-01-20", "2026-02-01", "2026-02-10"])
+    assert (record["best_month"], record["best_month_wins"]) == ("2026-01", 2)
+
+
+@pytest.fixture
+def db_path(monkeypatch, tmp_path):
+    path = str(tmp_path / "records.db")
+    monkeypatch.setattr(app, "DB_NAME", path)
+    asyncio.run(app.init_db())
+    return path
+
+
+def rebuild(games):
+    async def scenario():
+        async with app.connect_db() as db:
+            await db.executemany(
+                "INSERT INTO daily_game (peer_id, date, winner_id, reason) VALUES (?, ?, ?, '')",
+                [(PEER_ID, date_value, winner_id) for date_value, winner_id in games],
+            )
+            await app.rebuild_game_records(db, PEER_ID)
+            await db.commit()
+            cursor = await db.execute(
+                f"SELECT user_id, {', '.join(app.GAME_RECORD_COLUMNS)} FROM game_records WHERE peer_id = ?",
+                (PEER_ID,),
+            )
+            return {row[0]: dict(zip(app.GAME_RECORD_COLUMNS, row[1:])) for row in await cursor.fetchall()}
+
+    return asyncio.run(scenario())
+
+
+def test_rebuild_game_records_resets_interrupted_streak(db_path):
+    records = rebuild([
+        ("2026-01-30", 1),
+        ("2026-01-31", 1),
+        ("2026-02-01", 1),
+        ("2026-02-02", 2),
+        ("2026-02-03", 2),
+    ])
+    assert (records[1]["current_streak"], records[1]["best_streak"]) == (0, 3)
+    assert (records[1]["best_month"], records[1]["best_month_wins"]) == ("2026-01", 2)
+    assert (records[2]["current_streak"], records[2]["total_wins"]) == (2, 2)
+
+
+def test_rebuild_game_records_skips_days_without_winner(db_path):
+    records = rebuild([
+        ("2026-02-01", 1),
+        ("2026-02-02", None),
+        ("2026-02-03", 1),
+        ("2026-02-04", 1),
+    ])
+    # День без победителя рвет серию, но чужой победой не считается
+    assert (records[1]["current_streak"], records[1]["best_streak"], records[1]["total_wins"]) == (2, 2, 3)
+
+
+def test_delete_game_result_recomputes_streaks(db_path):
+    rebuild([("2026-02-01", 1), ("2026-02-02", 2), ("2026-02-03", 1)])
+
+    async def scenario():
+        async with app.connect_db() as db:
+            assert await app.delete_game_result(db, PEER_ID, "2026-02-02")
+            await db.commit()
+            cursor = await db.execute("SELECT user_id, current_streak, best_streak FROM game_records WHERE peer_id = ?", (PEER_ID,))
+            return sorted(await cursor.fetchall())
+
+    assert asyncio.run(scenario()) == [(1, 1, 1)]
+
+
+def test_records_text_hides_stale_current_streak(monkeypatch, db_path):
+    async def fake_resolve_user_names(user_ids):
+        return {uid: f"user{uid}" for uid in user_ids}
+
+    monkeypatch.setattr(app, "resolve_user_names", fake_resolve_user_names)
+    today = datetime.datetime.now(app.MSK_TZ).date()
+    days = [(today - datetime.timedelta(days=offset)).isoformat() for offset in range(10, 0, -1)]
+    # Серия из трех побед закончилась неделю назад: дальше никто не выигрывал
+    rebuild([(date_value, 1) for date_value in days[:3]])
+    text = asyncio.run(app.build_records_text(PEER_ID, 1))
+    assert "Текущая серия" not in text
+    assert "лучшая серия 3 дн." in text
+
+    rebuild([(date_value, 2) for date_value in days[-2:]])
+    text = asyncio.run(app.build_records_text(PEER_ID, 1))
+    assert "🔥 Текущая серия: [id2|user2] — 2 дн." in text
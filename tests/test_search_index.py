@@ -0,0 +1,81 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import bot as app
+
+PEER_ID = 2000000001
+WORDS = ("кот", "пицца", "дождь", "футбол", "сериал", "кофе", "поезд", "отпуск", "ремонт", "гитара")
+
+
+@pytest.fixture
+def db_path(monkeypatch, tmp_path):
+    path = str(tmp_path / "search.db")
+    monkeypatch.setattr(app, "DB_NAME", path)
+    monkeypatch.setattr(app, "text_dicts", {})
+    monkeypatch.setattr(app, "text_compress_cursor", {})
+    return path
+
+
+def insert_messages(path: str, count: int, age_days: int = 30):
+    timestamp = int(time.time()) - age_days * 86400
+    rows = [
+        (index % 7, PEER_ID, f"сообщение {index}: {WORDS[index % 10]}, обсуждаем весь вечер", timestamp + index, f"user{index % 7}")
+        for index in range(count)
+    ]
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT INTO messages (user_id, peer_id, text, timestamp, username) VALUES (?, ?, ?, ?, ?)", rows)
+    connection.commit()
+    connection.close()
+
+
+def count_matches(word: str) -> int:
+    async def scenario():
+        return (await app.search_messages(PEER_ID, word))["total"]
+
+    return asyncio.run(scenario())
+
+
+def test_plain_index_works_without_bot_functions(monkeypatch, db_path):
+    monkeypatch.setattr(app, "TEXT_COMPRESSION_ENABLED", False)
+    asyncio.run(app.init_db())
+    insert_messages(db_path, 10)
+    assert count_matches("гитара") == 1
+
+    # Внешний клиент SQLite не знает text_unzip, но удалять и менять строки может
+    connection = sqlite3.connect(db_path)
+    connection.execute("DELETE FROM messages WHERE text LIKE '%гитара%'")
+    connection.execute("UPDATE messages SET text = 'про гитару' WHERE rowid = 1")
+    connection.commit()
+    connection.close()
+    assert count_matches("гитара") == 0
+    assert count_matches("гитару") == 1
+
+
+def test_compressed_rows_leave_index_on_prune(monkeypatch, db_path):
+    monkeypatch.setattr(app, "TEXT_COMPRESSION_ENABLED", True)
+    monkeypatch.setattr(app, "ARCHIVE_ENABLED", False)
+    asyncio.run(app.init_db())
+    insert_messages(db_path, 1000)
+    insert_messages(db_path, 10, age_days=0)
+    result = asyncio.run(app.run_text_compression())
+    assert result["compressed"] > 0
+    assert count_matches("гитара") == 101
+
+    connection = sqlite3.connect(db_path)
+    connection.execute("DELETE FROM messages WHERE text IS NOT NULL AND timestamp > ?", (int(time.time()) - 86400,))
+    connection.commit()
+    connection.close()
+    assert count_matches("гитара") == 100
+
+    # После выключения сжатия индекс остается в режиме распаковки: сжатые строки никуда не делись
+    monkeypatch.setattr(app, "TEXT_COMPRESSION_ENABLED", False)
+    asyncio.run(app.init_db())
+    assert asyncio.run(app.prune_table("messages", 1)) == 1000
+    assert count_matches("гитара") == 0
+
+    connection = sqlite3.connect(db_path)
+    assert connection.execute("SELECT COUNT(*) FROM messages_fts_docsize").fetchone()[0] == 0
+    connection.close()
@@ -0,0 +1,68 @@
+import asyncio
+import json
+
+from vkbottle import VKAPIError
+
+import bot as app
+
+
+class RecordingHTTPClient:
+    def __init__(self, responses: dict):
+        self.responses = responses
+        self.calls = []
+
+    async def request_text(self, url: str, method: str = "GET", data: dict | None = None, **kwargs) -> str:
+        name = url.rsplit("/", 1)[-1]
+        self.calls.append((name, dict(data or {})))
+        return json.dumps(self.responses[name], ensure_ascii=False)
+
+    async def close(self):
+        pass
+
+
+def make_api(responses: dict):
+    api = app.CoalescingAPI("token", window=0.05, methods={"messages.send", "users.get"})
+    api.http_client = RecordingHTTPClient(responses)
+    return api
+
+
+def test_execute_returns_results_and_errors_per_caller():
+    api = make_api({
+        "execute": {
+            "response": [101, False, [{"id": 1, "first_name": "Анна", "last_name": "К"}]],
+            "execute_errors": [{"method": "messages.send", "error_code": 901, "error_msg": "Can't send messages"}],
+        }
+    })
+
+    async def scenario():
+        return await asyncio.gather(
+            api.messages.send(peer_id=2000000001, random_id=1, message="первое"),
+            api.request("messages.send", {"peer_id": 2000000002, "random_id": 2, "message": "второе"}),
+            api.request("users.get", {"user_ids": "1"}),
+            return_exceptions=True,
+        )
+
+    sent, failed, users = asyncio.run(scenario())
+    assert [name for name, _ in api.http_client.calls] == ["execute"]
+    assert "API.messages.send(" in api.http_client.calls[0][1]["code"]
+    assert sent == 101
+    assert isinstance(failed, VKAPIError) and failed.code == 901
+    assert users == {"response": [{"id": 1, "first_name": "Анна", "last_name": "К"}]}
+    assert (api.execute_stats["execute"], api.execute_stats["coalesced"], api.execute_stats["single"]) == (1, 3, 0)
+
+
+def test_execute_error_falls_back_to_single_calls():
+    api = make_api({
+        "execute": {"error": {"error_code": 13, "error_msg": "Runtime error", "request_params": []}},
+        "messages.send": {"response": 7},
+    })
+
+    async def scenario():
+        return await asyncio.gather(
+            api.request("messages.send", {"peer_id": 2000000001, "random_id": 1, "message": "a"}),
+            api.request("messages.send", {"peer_id": 2000000001, "random_id": 2, "message": "b"}),
+        )
+
+    assert asyncio.run(scenario()) == [{"response": 7}, {"response": 7}]
+    assert [name for name, _ in api.http_client.calls] == ["execute", "messages.send", "messages.send"]
+    assert (api.execute_stats["execute_failed"], api.execute_stats["single"]) == (1, 2)
@@ -0,0 +1,446 @@
+"""
+Воспроизводимый бенчмарк бота без сети.
+
+Настоящие обработчики (logger, mention_reply_handler, run_game_logic, build_leaderboard_text,
+тик планировщика) получают синтетические события. VK подменяется HTTP-клиентом внутри процесса,
+LLM — локальным OpenAI-совместимым сервером с настраиваемой задержкой. База создается во
+временном каталоге и заполняется историей заданной глубины.
+
+Запуск: python tools/bench.py --peers 10 --rate 50 --duration 10 --history 2000 --out bench.json
+Результат — JSON с пропускной способностью, p50/p95/p99 задержек и пиковым RSS по каждому сценарию.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from fake_vk_callback import build_message_event
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("messages", "game", "leaderboard", "scheduler")
+GROUP_ID = 1
+FIRST_PEER_ID = 2000000001
+WORDS = (
+    "привет как дела сегодня игра победитель чат бот завтра вечер работа кофе погода "
+    "смешно лол кек опять понедельник кто пойдет обед скинь мем видел новость"
+).split()
+ALIAS_RE = re.compile(r"\bU\d+\b")
+BATCH_KEY_RE = re.compile(r"^### (C\d+)$", re.MULTILINE)
+
+# ================= ФЕЙКОВЫЙ VK =================
+def parse_execute_calls(code: str) -> list:
+    # CoalescingAPI собирает код вида: return [API.method({...}),API.method({...})];
+    decoder = json.JSONDecoder()
+    calls = []
+    position = 0
+    while True:
+        start = code.find("API.", position)
+        if start < 0:
+            return calls
+        paren = code.index("(", start)
+        params, end = decoder.raw_decode(code, paren + 1)
+        calls.append((code[start + 4:paren], params))
+        position = end + 1
+
+class FakeVKHTTPClient:
+    """
+    HTTP-клиент для vkbottle: отвечает на методы VK из памяти с заданной задержкой.
+    API vkbottle ходит только через request_text/request_json, сырой ответ (request_raw) не нужен.
+    """
+
+    def __init__(self, latency: float, group_id: int):
+        self.latency = latency
+        self.group_id = group_id
+        self.calls = Counter()
+        self.message_ids = iter(range(1, 1 << 62))
+
+    def respond(self, method: str, data: dict):
+        self.calls[method] += 1
+        if method == "execute":
+            return [self.respond(name, params) for name, params in parse_execute_calls(data["code"])]
+        if method == "users.get":
+            user_ids = data.get("user_ids") or ""
+            if isinstance(user_ids, str):
+                user_ids = [item for item in user_ids.split(",") if item]
+            return [
+                {"id": int(uid), "first_name": "User", "last_name": str(uid), "can_access_closed": True, "is_closed": False}
+                for uid in user_ids
+            ]
+        if method == "groups.getById":
+            return {"groups": [{"id": self.group_id, "name": "bench", "screen_name": f"club{self.group_id}", "is_closed": 0, "type": "group"}]}
+        if method == "messages.send":
+            if data.get("peer_ids"):
+                return [{"peer_id": int(peer_id), "message_id": next(self.message_ids)} for peer_id in str(data["peer_ids"]).split(",")]
+            return next(self.message_ids)
+        if method == "messages.getConversationMembers":
+            return {"count": 0, "items": [], "profiles": []}
+        return 1
+
+    async def request_text(self, url: str, method: str = "GET", data: dict | None = None, **kwargs) -> str:
+        return json.dumps(await self.request_json(url, method, data, **kwargs), ensure_ascii=False)
+
+    async def request_json(self, url: str, method: str = "GET", data: dict | None = None, **kwargs) -> dict:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return {"response": self.respond(url.rsplit("/", 1)[-1], dict(data or {}))}
+
+    async def request_content(self, url: str, method: str = "GET", data: dict | None = None, **kwargs) -> bytes:
+        return (await self.request_text(url, method, data, **kwargs)).encode("utf-8")
+
+    async def close(self):
+        pass
+
+# ================= ЗАГЛУШКА LLM =================
+def build_llm_reply(payload: dict, rng: random.Random) -> str:
+    messages = payload.get("messages") or []
+    system = messages[0]["content"] if messages else ""
+    prompt = messages[-1]["content"] if messages else ""
+    schema = ((payload.get("response_format") or {}).get("json_schema") or {}).get("schema") or {}
+    batch_keys = list((schema.get("properties") or {})) if schema.get("title") == "winners" else BATCH_KEY_RE.findall(prompt)
+    if batch_keys:
+        sections = re.split(r"^### C\d+$", prompt, flags=re.MULTILINE)[1:]
+        result = {}
+        for key, section in zip(batch_keys, sections):
+            aliases = ALIAS_RE.findall(section) or ["U1"]
+            result[key] = {"user_id": rng.choice(aliases), "reason": "бенчмарк"}
+        return json.dumps(result, ensure_ascii=False)
+    if schema or "JSON" in system:
+        aliases = ALIAS_RE.findall(prompt) or ["U1"]
+        return json.dumps({"user_id": rng.choice(aliases), "reason": "бенчмарк"}, ensure_ascii=False)
+    return " ".join(rng.choices(WORDS, k=rng.randint(8, 40)))
+
+def create_llm_app(latency: float, jitter: float, seed: int, stats: Counter) -> web.Application:
+    rng = random.Random(seed)
+
+    async def chat_completions(request: web.Request) -> web.Response:
+        payload = await request.json()
+        stats["requests"] += 1
+        delay = max(rng.gauss(latency, jitter), 0.0) if jitter else latency
+        await asyncio.sleep(delay)
+        content = build_llm_reply(payload, rng)
+        return web.json_response(
+            {
+                "id": f"bench-{stats['requests']}",
+                "object": "chat.completion",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+        )
+
+    async def models(request: web.Request) -> web.Response:
+        return web.json_response({"data": [{"id": "bench-model", "context_length": 32768}]})
+
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.router.add_post("/chat/completions", chat_completions)
+    app.router.add_get("/models", models)
+    return app
+
+def start_llm_stub(port: int, latency: float, jitter: float, seed: int) -> Counter:
+    # Отдельный поток со своим циклом: заглушка не делит event loop с измеряемым ботом
+    stats = Counter()
+    ready = threading.Event()
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(create_llm_app(latency, jitter, seed, stats), access_log=None)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, name="llm-stub", daemon=True).start()
+    ready.wait()
+    return stats
+
+# ================= ДАННЫЕ =================
+def random_text(rng: random.Random) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(2, 14)))
+
+def seed_database(path: str, peers: list, history: int, users: int, rng: random.Random):
+    now = int(time.time())
+    today = datetime.date.today()
+    connection = sqlite3.connect(path)
+    try:
+        for peer_id in peers:
+            # Треть истории — сегодняшние сообщения, чтобы игре было из чего выбирать
+            rows = []
+            for index in range(history):
+                age = rng.randint(0, 12 * 3600) if index % 3 == 0 else rng.randint(0, 90 * 86400)
+                user_id = rng.randint(1, users)
+                rows.append((user_id, peer_id, random_text(rng), now - age, f"User {user_id}"))
+            connection.executemany("INSERT INTO messages (user_id, peer_id, text, timestamp, username) VALUES (?, ?, ?, ?, ?)", rows)
+            connection.executemany(
+                "INSERT INTO bot_dialogs (peer_id, user_id, role, text, timestamp) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (peer_id, rng.randint(1, users), role, random_text(rng), now - rng.randint(0, 30 * 86400))
+                    for _ in range(history // 10)
+                    for role in ("user", "assistant")
+                ],
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO daily_game (peer_id, date, winner_id, reason) VALUES (?, ?, ?, ?)",
+                [(peer_id, (today - datetime.timedelta(days=day)).isoformat(), rng.randint(1, users), "история") for day in range(1, 366)],
+            )
+            minute = rng.randrange(24 * 60)
+            connection.execute("INSERT OR REPLACE INTO schedules (peer_id, time) VALUES (?, ?)", (peer_id, f"{minute // 60:02d}:{minute % 60:02d}"))
+            connection.execute(
+                "INSERT OR REPLACE INTO leaderboard_schedule (peer_id, day, time, last_run_month) VALUES (?, ?, ?, NULL)",
+                (peer_id, rng.randint(1, 28), f"{(minute + 30) // 60 % 24:02d}:{(minute + 30) % 60:02d}"),
+            )
+        connection.commit()
+    finally:
+        connection.close()
+
+# ================= ИЗМЕРЕНИЯ =================
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    index = max(int(round(share * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+def peak_rss_mb() -> float:
+    # В Linux ru_maxrss в килобайтах
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    values = sorted(latency * 1000 for latency in latencies)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(values, 0.50), 3),
+            "p95": round(percentile(values, 0.95), 3),
+            "p99": round(percentile(values, 0.99), 3),
+            "max": round(values[-1], 3) if values else 0.0,
+            "mean": round(sum(values) / len(values), 3) if values else 0.0,
+        },
+        "rss_peak_mb": peak_rss_mb(),
+    }
+
+async def timed(call, latencies: list, errors: Counter, key: str = "errors"):
+    started = time.perf_counter()
+    try:
+        await call
+    except Exception as e:
+        errors[key] += 1
+        logging.getLogger("bench").warning("%s failed: %s", key, e)
+        return
+    latencies.append(time.perf_counter() - started)
+
+# ================= СЦЕНАРИИ =================
+async def scenario_messages(app, args, peers: list, rng: random.Random) -> dict:
+    # Открытая нагрузка: события приходят по расписанию rate в секунду независимо от скорости обработки
+    total = int(args.rate * args.duration)
+    cmids = Counter()
+    plain, mentions = [], []
+    errors = Counter()
+    tasks = []
+    started = time.perf_counter()
+    for index in range(total):
+        delay = started + index / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        peer_id = rng.choice(peers)
+        cmids[peer_id] += 1
+        text = random_text(rng)
+        is_mention = rng.random() < args.mention_ratio
+        if is_mention:
+            text = f"[club{GROUP_ID}|@bench] {text}"
+        event = build_message_event(GROUP_ID, peer_id, rng.randint(1, args.users), text, args.history + cmids[peer_id], "")
+        target = mentions if is_mention else plain
+        tasks.append(asyncio.create_task(timed(app.bot.router.route(event, app.bot.api), target, errors, "mention_errors" if is_mention else "errors")))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    result = summarize(plain, errors["errors"], elapsed)
+    result["offered_rate"] = args.rate
+    result["mentions"] = summarize(mentions, errors["mention_errors"], elapsed)
+    return result
+
+async def scenario_game(app, args, peers: list, rng: random.Random) -> dict:
+    latencies = []
+    errors = Counter()
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(app.run_game_logic(peer_id, reset_if_exists=True), latencies, errors) for peer_id in peers))
+    return summarize(latencies, errors["errors"], time.perf_counter() - started)
+
+async def scenario_leaderboard(app, args, peers: list, rng: random.Random) -> dict:
+    latencies = []
+    errors = Counter()
+    started = time.perf_counter()
+    for _ in range(args.leaderboard_calls):
+        await timed(app.build_leaderboard_text(rng.choice(peers), page=rng.randint(1, 2), requester_id=rng.randint(1, args.users)), latencies, errors)
+    return summarize(latencies, errors["errors"], time.perf_counter() - started)
+
+async def scenario_scheduler(app, args, peers: list, rng: random.Random) -> dict:
+    # Тик планировщика на каждую минуту суток: то же, что scheduler_loop делает раз в минуту
+    latencies = []
+    errors = Counter()
+    day = datetime.datetime.now(app.MSK_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+    started = time.perf_counter()
+    for minute in range(24 * 60):
+        await timed(app.scheduler_tick(day + datetime.timedelta(minutes=minute)), latencies, errors)
+    result = summarize(latencies, errors["errors"], time.perf_counter() - started)
+    async with app.connect_db() as db:
+        cursor = await db.execute("SELECT kind, COUNT(*) FROM jobs GROUP BY kind")
+        result["jobs_enqueued"] = dict(await cursor.fetchall())
+    return result
+
+SCENARIO_RUNNERS = {
+    "messages": scenario_messages,
+    "game": scenario_game,
+    "leaderboard": scenario_leaderboard,
+    "scheduler": scenario_scheduler,
+}
+
+# ================= ЗАПУСК =================
+def find_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def read_git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def configure_environment(args, db_path: str, llm_port: int):
+    # Окружение задается до импорта bot: настройки читаются при импорте модуля.
+    # Явно заданные переменные (VK_SEND_RATE, TEXT_COMPRESSION_ENABLED, ...) не перезаписываем.
+    os.environ["DB_PATH"] = db_path
+    if args.llm == "mock":
+        # Встроенный mock-провайдер: без HTTP, задержка и сбои задаются MOCK_*
+        os.environ["LLM_PROVIDER"] = "mock"
+        os.environ.setdefault("MOCK_LATENCY", f"normal:{args.llm_latency},{args.llm_jitter}")
+        os.environ.setdefault("MOCK_SEED", str(args.seed))
+    else:
+        os.environ["LLM_PROVIDER"] = "venice"
+        os.environ["VENICE_API_KEY"] = "bench"
+        os.environ["VENICE_BASE_URL"] = f"http://127.0.0.1:{llm_port}/"
+    os.environ["VK_TOKEN"] = "bench"
+    os.environ.pop("ALLOWED_PEER_ID", None)
+    os.environ.pop("VK_CALLBACK_ENABLED", None)
+    os.environ.setdefault("USER_PROMPT_TEMPLATE", "Лог чата:\n{{CHAT_LOG}}")
+    os.environ.setdefault("MAINTENANCE_ENABLED", "1")
+    os.environ.setdefault("BACKUP_INTERVAL_HOURS", "24")
+
+async def run(args, llm_stats: Counter) -> dict:
+    rng = random.Random(args.seed)
+    import bot as app
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    # Router глотает исключения обработчиков и передает их error_handler — считаем их здесь
+    router_errors = Counter()
+
+    async def count_router_error(error: Exception):
+        router_errors[type(error).__name__] += 1
+        logging.getLogger("bench").warning("Handler failed: %r", error)
+
+    app.bot.error_handler.register_undefined_error_handler(count_router_error)
+    if app.METRICS_ENABLED:
+        # Те же обертки, что в боте: METRICS_ENABLED=1 показывает накладные расходы метрик
+        app.instrument_handlers()
+    app.bot.api.http_client = FakeVKHTTPClient(args.vk_latency, GROUP_ID)
+    await app.init_db()
+    app.BOT_GROUP_ID = app.extract_group_id(await app.bot.api.groups.get_by_id())
+    peers = [FIRST_PEER_ID + index for index in range(args.peers)]
+    seed_started = time.perf_counter()
+    await asyncio.to_thread(seed_database, app.DB_NAME, peers, args.history, args.users, rng)
+    async with app.connect_db() as db:
+        await app.rebuild_game_records(db)
+        await db.commit()
+    seed_elapsed = time.perf_counter() - seed_started
+
+    results = {}
+    for name in args.scenarios:
+        router_errors.clear()
+        results[name] = await SCENARIO_RUNNERS[name](app, args, peers, rng)
+        if router_errors:
+            results[name]["handler_errors"] = dict(router_errors)
+        print(f"{name}: {json.dumps(results[name], ensure_ascii=False)}", file=sys.stderr)
+    return {
+        "meta": {
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "git_commit": read_git_commit(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "seed_s": round(seed_elapsed, 3),
+            "params": {key: value for key, value in vars(args).items() if key not in ("out", "verbose", "keep_db")},
+        },
+        "scenarios": results,
+        "vk_calls": dict(app.bot.api.http_client.calls),
+        "llm_requests": app.MOCK_STATS["requests"] if args.llm == "mock" else llm_stats["requests"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def parse_scenarios(value: str) -> list:
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"неизвестные сценарии: {', '.join(unknown)}")
+    return names
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков бота на синтетической нагрузке")
+    parser.add_argument("--scenarios", type=parse_scenarios, default=list(SCENARIOS), help=f"через запятую: {','.join(SCENARIOS)}")
+    parser.add_argument("--peers", type=int, default=10, help="число чатов")
+    parser.add_argument("--users", type=int, default=30, help="участников в чате")
+    parser.add_argument("--rate", type=float, default=50.0, help="входящих сообщений в секунду")
+    parser.add_argument("--duration", type=float, default=10.0, help="длительность сценария messages, с")
+    parser.add_argument("--history", type=int, default=2000, help="сообщений истории на чат")
+    parser.add_argument("--mention-ratio", type=float, default=0.05, help="доля сообщений с упоминанием бота")
+    parser.add_argument("--leaderboard-calls", type=int, default=200)
+    parser.add_argument("--llm", choices=("stub", "mock"), default="stub", help="stub — HTTP-сервер, mock — провайдер LLM_PROVIDER=mock")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="средняя задержка LLM, с")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="стандартное отклонение задержки LLM, с")
+    parser.add_argument("--vk-latency", type=float, default=0.02, help="задержка ответа VK API, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="куда записать JSON (по умолчанию stdout)")
+    parser.add_argument("--keep-db", action="store_true", help="не удалять временную базу")
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    args = parser.parse_args()
+    if args.rate <= 0 or args.peers <= 0:
+        parser.error("--rate и --peers должны быть больше нуля")
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    llm_port = find_free_port()
+    configure_environment(args, os.path.join(workdir, "bench.db"), llm_port)
+    sys.path.insert(0, ROOT_DIR)
+    llm_stats = start_llm_stub(llm_port, args.llm_latency, args.llm_jitter, args.seed) if args.llm == "stub" else Counter()
+    report = asyncio.run(run(args, llm_stats))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as target:
+            target.write(output + "\n")
+    else:
+        print(output)
+    if args.keep_db:
+        print(f"База: {workdir}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
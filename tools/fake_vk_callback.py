@@ -0,0 +1,114 @@
+"""
+Локальный «VK» для проверки Callback API режима.
+
+Запуск бота: VK_CALLBACK_ENABLED=true VK_CALLBACK_CONFIRMATION=abc VK_CALLBACK_SECRET=s3cret python bot.py
+Проверка:    python tools/fake_vk_callback.py --url http://127.0.0.1:8080/callback --confirmation abc --secret s3cret
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+import uuid
+
+import httpx
+
+DEFAULT_CLIENT_INFO = {
+    "button_actions": ["text"],
+    "keyboard": True,
+    "inline_keyboard": True,
+    "carousel": True,
+    "lang_id": 0,
+}
+
+def build_message_event(group_id: int, peer_id: int, from_id: int, text: str, cmid: int, secret: str) -> dict:
+    event = {
+        "type": "message_new",
+        "event_id": uuid.uuid4().hex,
+        "v": "5.199",
+        "group_id": group_id,
+        "object": {
+            "message": {
+                "date": int(time.time()),
+                "from_id": from_id,
+                "id": 0,
+                "out": 0,
+                "peer_id": peer_id,
+                "text": text,
+                "conversation_message_id": cmid,
+                "fwd_messages": [],
+                "important": False,
+                "is_hidden": False,
+                "attachments": [],
+                "random_id": 0,
+                "version": 0,
+            },
+            "client_info": DEFAULT_CLIENT_INFO,
+        },
+    }
+    if secret:
+        event["secret"] = secret
+    return event
+
+async def run(args) -> int:
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.post(args.url, json={"type": "confirmation", "group_id": args.group_id})
+        confirmed = response.text == args.confirmation if args.confirmation else response.status_code == 200
+        print(f"confirmation: status={response.status_code} body={response.text!r} ok={confirmed}")
+        if not confirmed:
+            return 1
+
+        bad_secret = build_message_event(args.group_id, args.peer_id, args.from_id, "secret check", 1, "wrong")
+        response = await client.post(args.url, json=bad_secret)
+        print(f"wrong secret: status={response.status_code} (ожидается 403)")
+        if response.status_code != 403:
+            return 1
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+        statuses = {}
+
+        async def send_one(index: int):
+            event = build_message_event(
+                args.group_id,
+                args.peer_id,
+                args.from_id + random.randint(0, args.users - 1),
+                f"тестовое сообщение {index}",
+                index + 2,
+                args.secret,
+            )
+            async with semaphore:
+                started = time.perf_counter()
+                reply = await client.post(args.url, content=json.dumps(event, ensure_ascii=False))
+                latencies.append(time.perf_counter() - started)
+            statuses[reply.status_code] = statuses.get(reply.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send_one(index) for index in range(args.count)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+    print(
+        f"events={args.count} statuses={statuses} rps={args.count / elapsed:.0f} "
+        f"ack_p50={statistics.median(latencies) * 1000:.1f}ms ack_p95={p95 * 1000:.1f}ms"
+    )
+    return 0 if set(statuses) == {200} else 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправляет в бота события как VK Callback API")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/callback")
+    parser.add_argument("--group-id", type=int, default=1)
+    parser.add_argument("--peer-id", type=int, default=2000000001)
+    parser.add_argument("--from-id", type=int, default=100)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--secret", required=True, help="VK_CALLBACK_SECRET бота")
+    parser.add_argument("--confirmation", default="")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Повтор записанного трафика (EVENT_RECORD_PATH) на заглушках VK и LLM.
+
+Запись: EVENT_RECORD_PATH=data/events.jsonl.gz python bot.py
+Повтор: python tools/replay.py data/events.jsonl.gz --speed 4 --out replay.json --baseline prev.json
+
+События подаются в настоящий router бота с исходными интервалами, деленными на --speed
+(0 — без пауз). Таймеры игры и лидерборда из записи запускаются в те же моменты.
+В отчете — задержки по каждому обработчику и расхождение с --baseline.
+"""
+import argparse
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter, defaultdict
+
+from bench import (
+    FakeVKHTTPClient,
+    ROOT_DIR,
+    configure_environment,
+    find_free_port,
+    peak_rss_mb,
+    read_git_commit,
+    seed_database,
+    start_llm_stub,
+    summarize,
+)
+
+DIFF_METRICS = ("p50", "p95", "p99")
+
+def load_trace(paths: list, limit: int | None) -> tuple:
+    header = {}
+    entries = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as source:
+            try:
+                for line in source:
+                    entry = json.loads(line)
+                    if "format" in entry:
+                        header = header or entry
+                        continue
+                    entries.append(entry)
+            except (EOFError, zlib.error, json.JSONDecodeError):
+                # Бот мог остановиться посреди записи: хвост после последнего сброса отбрасываем
+                print(f"{path}: запись оборвана, прочитано {len(entries)} событий", file=sys.stderr)
+    entries.sort(key=lambda entry: entry["t"])
+    if limit:
+        entries = entries[:limit]
+    return header, entries
+
+def collect_peers(entries: list) -> list:
+    peers = set()
+    for entry in entries:
+        if "timer" in entry:
+            peers.add(entry["peer_id"])
+            continue
+        message = (entry["update"].get("object") or {}).get("message") or {}
+        if (message.get("peer_id") or 0) >= 2000000000:
+            peers.add(message["peer_id"])
+    return sorted(peers)
+
+def shift_dates(value, offset: int):
+    # Даты сдвигаются к текущему времени: иначе игра не увидит «сегодняшних» сообщений
+    if isinstance(value, dict):
+        return {key: (item + offset if key == "date" and isinstance(item, int) else shift_dates(item, offset)) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shift_dates(item, offset) for item in value]
+    return value
+
+async def replay(app, args, entries: list, latencies: dict, errors: Counter) -> dict:
+    trace_start = entries[0]["t"]
+    date_offset = int(time.time() - trace_start)
+    lags = []
+    tasks = []
+
+    async def run_entry(entry: dict):
+        started = time.perf_counter()
+        try:
+            if "timer" in entry:
+                if entry["timer"] == "game":
+                    await app.run_game_logic(entry["peer_id"], reset_if_exists=bool(entry["payload"].get("reset")))
+                else:
+                    await app.post_leaderboard(entry["peer_id"], entry["payload"]["month"])
+                latencies[f"timer:{entry['timer']}"].append(time.perf_counter() - started)
+            else:
+                await app.bot.router.route(shift_dates(entry["update"], date_offset), app.bot.api)
+                latencies["route"].append(time.perf_counter() - started)
+        except Exception as e:
+            errors[type(e).__name__] += 1
+            logging.getLogger("replay").warning("Replay entry failed: %r", e)
+
+    started = time.perf_counter()
+    for entry in entries:
+        if args.speed > 0:
+            target = started + (entry["t"] - trace_start) / args.speed
+            delay = target - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Отставание от расписания: растет, когда бот не успевает за трафиком
+            lags.append(max(time.perf_counter() - target, 0.0))
+        tasks.append(asyncio.create_task(run_entry(entry)))
+    await asyncio.gather(*tasks)
+    return {
+        "elapsed_s": round(time.perf_counter() - started, 3),
+        "schedule_lag": summarize(lags, 0, 1.0)["latency_ms"] if lags else None,
+    }
+
+def diff_reports(baseline: dict, current: dict) -> dict:
+    diff = {}
+    old_handlers = baseline.get("handlers") or {}
+    new_handlers = current["handlers"]
+    for name in sorted(set(old_handlers) | set(new_handlers)):
+        old, new = old_handlers.get(name), new_handlers.get(name)
+        if old is None or new is None:
+            diff[name] = {"only_in": "current" if old is None else "baseline"}
+            continue
+        entry = {"count": [old["count"], new["count"]]}
+        for metric in DIFF_METRICS:
+            before, after = old["latency_ms"][metric], new["latency_ms"][metric]
+            change = round((after - before) / before * 100, 1) if before else None
+            entry[f"{metric}_ms"] = [before, after, change]
+        diff[name] = entry
+    # Разные вызовы VK при том же трафике — поведенческое расхождение, а не только скорость
+    old_calls, new_calls = baseline.get("vk_calls") or {}, current["vk_calls"]
+    diff["vk_calls"] = {
+        method: [old_calls.get(method, 0), new_calls.get(method, 0)]
+        for method in sorted(set(old_calls) | set(new_calls))
+        if old_calls.get(method, 0) != new_calls.get(method, 0)
+    }
+    diff["llm_requests"] = [baseline.get("llm_requests"), current["llm_requests"]]
+    diff["baseline_commit"] = (baseline.get("meta") or {}).get("git_commit")
+    return diff
+
+def print_diff(diff: dict):
+    print(f"Сравнение с {diff['baseline_commit'] or 'baseline'}:", file=sys.stderr)
+    for name, entry in diff.items():
+        if name in ("vk_calls", "llm_requests", "baseline_commit"):
+            continue
+        if "only_in" in entry:
+            print(f"  {name}: только в {entry['only_in']}", file=sys.stderr)
+            continue
+        metrics = " ".join(
+            f"{metric} {entry[f'{metric}_ms'][0]:.1f}→{entry[f'{metric}_ms'][1]:.1f}мс"
+            + (f" ({entry[f'{metric}_ms'][2]:+.0f}%)" if entry[f"{metric}_ms"][2] is not None else "")
+            for metric in DIFF_METRICS
+        )
+        print(f"  {name}: n {entry['count'][0]}→{entry['count'][1]} {metrics}", file=sys.stderr)
+    if diff["vk_calls"]:
+        print(f"  вызовы VK изменились: {diff['vk_calls']}", file=sys.stderr)
+
+async def run(args, header: dict, entries: list, llm_stats: Counter) -> dict:
+    import bot as app
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    group_id = header.get("group_id") or 1
+    app.bot.api.http_client = FakeVKHTTPClient(args.vk_latency, group_id)
+    app.BOT_GROUP_ID = group_id
+    await app.init_db()
+    peers = collect_peers(entries)
+    if args.history:
+        await asyncio.to_thread(seed_database, app.DB_NAME, peers, args.history, args.users, random.Random(args.seed))
+        async with app.connect_db() as db:
+            await app.rebuild_game_records(db)
+            await db.commit()
+
+    latencies = defaultdict(list)
+    errors = Counter()
+    router_errors = Counter()
+
+    async def count_router_error(error: Exception):
+        router_errors[type(error).__name__] += 1
+        logging.getLogger("replay").warning("Handler failed: %r", error)
+
+    app.bot.error_handler.register_undefined_error_handler(count_router_error)
+    app.instrument_handlers(lambda name, elapsed: latencies[name].append(elapsed))
+    timing = await replay(app, args, entries, latencies, errors)
+    return {
+        "meta": {
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "git_commit": read_git_commit(),
+            "trace": [os.path.abspath(path) for path in args.trace],
+            "trace_started_at": entries[0]["t"],
+            "trace_duration_s": round(entries[-1]["t"] - entries[0]["t"], 3),
+            "params": {key: value for key, value in vars(args).items() if key not in ("trace", "out", "baseline", "verbose")},
+        },
+        "events": len(entries),
+        "peers": len(peers),
+        **timing,
+        "handlers": {name: summarize(values, 0, timing["elapsed_s"]) for name, values in sorted(latencies.items())},
+        "errors": dict(errors),
+        "handler_errors": dict(router_errors),
+        "vk_calls": dict(app.bot.api.http_client.calls),
+        "llm_requests": app.MOCK_STATS["requests"] if args.llm == "mock" else llm_stats["requests"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Повтор записанных событий VK на заглушках")
+    parser.add_argument("trace", nargs="+", help="файлы EVENT_RECORD_PATH (.jsonl.gz)")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение: 1 — как в записи, 0 — без пауз")
+    parser.add_argument("--limit", type=int, help="повторить только первые N событий")
+    parser.add_argument("--history", type=int, default=0, help="синтетических сообщений истории на чат перед повтором")
+    parser.add_argument("--users", type=int, default=30, help="участников в синтетической истории")
+    parser.add_argument("--llm", choices=("stub", "mock"), default="stub", help="stub — HTTP-сервер, mock — провайдер LLM_PROVIDER=mock")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--vk-latency", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", help="отчет прошлого прогона для сравнения")
+    parser.add_argument("--out", help="куда записать JSON (по умолчанию stdout)")
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed не может быть отрицательным")
+
+    header, entries = load_trace(args.trace, args.limit)
+    if not entries:
+        parser.error("в записи нет событий")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as source:
+            baseline = json.load(source)
+
+    workdir = tempfile.mkdtemp(prefix="bot-replay-")
+    llm_port = find_free_port()
+    configure_environment(args, os.path.join(workdir, "replay.db"), llm_port)
+    sys.path.insert(0, ROOT_DIR)
+    llm_stats = start_llm_stub(llm_port, args.llm_latency, args.llm_jitter, args.seed) if args.llm == "stub" else Counter()
+    try:
+        report = asyncio.run(run(args, header, entries, llm_stats))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if baseline is not None:
+        report["diff"] = diff_reports(baseline, report)
+        print_diff(report["diff"])
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as target:
+            target.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()